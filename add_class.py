@@ -0,0 +1,200 @@
+"""Add a class to a trained SDIM without retraining the encoder.
+
+The Gaussian head grows by one class whose mean and variance are fit in closed form on the
+embeddings of the new class's train samples (the encoder is frozen). Optionally the head
+alone is fine-tuned for a few epochs with the nll and margin losses on cached embeddings of
+the new class and of a replay sample of the old classes. Only the rejection threshold of the
+new class is calibrated; the thresholds of the old classes are unchanged.
+
+    python add_class.py --problem fashion --n_classes 10 --new_problem mnist --new_label 0
+
+The samples with label new_label of new_problem become class n_classes. The grown model is
+saved as sdim_<encoder>_<problem>_d<rep_size>_plus_<new_problem><new_label>.pth (load it with
+n_classes + 1 classes) and the threshold of the new class as a json file next to it.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from torch.optim import Adam
+
+from sdim import SDIM, ClassStatistics
+from utils import get_dataset, cal_parameters
+from loaders import get_loader, add_loader_args
+from eval_worker import class_thresholds
+
+
+@torch.no_grad()
+def embed(model, loader, device):
+    """Encoder embeddings and labels of all the samples of loader."""
+    reps, ys = [], []
+    for x, y in loader:
+        reps.append(model.encoder(x.to(device), return_full_list=True)[-1])
+        ys.append(y.to(device))
+    return torch.cat(reps), torch.cat(ys)
+
+
+def finetune_head(model, reps, ys, hps):
+    """Train the Gaussian head only (beta * nll + gamma * margin) on cached embeddings."""
+    optimizer = Adam(model.class_conditional.parameters(), lr=hps.finetune_lr)
+    for epoch in range(1, hps.finetune_epochs + 1):
+        total, n_batches = 0., 0
+        for idx in torch.randperm(ys.size(0), device=ys.device).split(hps.n_batch_train):
+            optimizer.zero_grad()
+            ll = model.class_conditional(reps[idx]) / model.rep_size
+            nll_loss, ll_margin = model.likelihood_losses(ll, ys[idx])
+            loss = model.beta * nll_loss + model.gamma * ll_margin
+            loss.backward()
+            optimizer.step()
+            total, n_batches = total + loss.item(), n_batches + 1
+        print('Head fine-tune epoch {}, loss: {:.4f}'.format(epoch, total / max(n_batches, 1)))
+
+
+@torch.no_grad()
+def accuracy(model, reps, ys):
+    return (model.class_conditional(reps).argmax(dim=1) == ys).float().mean().item()
+
+
+def add_class(model, hps):
+    checkpoint_path = os.path.join(hps.log_dir, 'sdim_{}_{}_d{}.pth'.format(model.encoder_name,
+                                                                            hps.problem,
+                                                                            hps.rep_size))
+    model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
+    model.eval()
+    new_id = hps.n_classes
+
+    # Embeddings of the new class (no data augmentation), relabeled as new_id.
+    dataset = get_dataset(data_name=hps.new_problem, data_dir=hps.data_dir, train=True, label_id=hps.new_label,
+                          crop_flip=False, uint8=hps.uint8_inputs)
+    new_reps, _ = embed(model, get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps), hps.device)
+    new_ys = torch.full((new_reps.size(0),), new_id, dtype=torch.long, device=hps.device)
+    dataset = get_dataset(data_name=hps.new_problem, data_dir=hps.data_dir, train=False, label_id=hps.new_label,
+                          uint8=hps.uint8_inputs)
+    new_test_reps, _ = embed(model, get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps),
+                             hps.device)
+    new_test_ys = torch.full((new_test_reps.size(0),), new_id, dtype=torch.long, device=hps.device)
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs)
+    old_test_reps, old_test_ys = embed(model, get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False,
+                                                         hps=hps), hps.device)
+    print('{} test accuracy before: {:.4f}'.format(hps.problem, accuracy(model, old_test_reps, old_test_ys)))
+
+    model.add_classes(1)
+    stats = ClassStatistics(model.n_classes, model.rep_size, device=hps.device)
+    stats.update(new_reps, new_ys)
+    model.class_conditional.refit(stats)  # only the new class has samples
+    print('==> Added class {} ({} label {}, {} samples)'.format(new_id, hps.new_problem, hps.new_label,
+                                                                new_reps.size(0)))
+
+    if hps.finetune_epochs > 0:
+        # Replay sample of the old classes, so that the head keeps separating them.
+        dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=True, crop_flip=False,
+                              uint8=hps.uint8_inputs)
+        old_reps, old_ys = embed(model, get_loader(dataset, batch_size=hps.n_batch_test, shuffle=True, hps=hps),
+                                 hps.device)
+        keep = torch.randperm(old_ys.size(0), device=hps.device)[:hps.n_replay]
+        finetune_head(model, torch.cat([old_reps[keep], new_reps]), torch.cat([old_ys[keep], new_ys]), hps)
+
+    print('{} test accuracy after: {:.4f}'.format(hps.problem, accuracy(model, old_test_reps, old_test_ys)))
+    print('new class test accuracy: {:.4f}'.format(accuracy(model, new_test_reps, new_test_ys)))
+
+    # Threshold of the new class only.
+    with torch.no_grad():
+        scores = model.class_conditional(new_reps)
+    thresh = class_thresholds(scores, new_ys, hps.percentile)[new_id].item()
+    print('new class threshold at percentile {}: {:.3f}'.format(hps.percentile, thresh))
+
+    name = 'sdim_{}_{}_d{}_plus_{}{}'.format(model.encoder_name, hps.problem, hps.rep_size,
+                                             hps.new_problem, hps.new_label)
+    torch.save(model.state_dict(), os.path.join(hps.log_dir, name + '.pth'))
+    with open(os.path.join(hps.log_dir, name + '_threshold.json'), 'w') as f:
+        json.dump({'class_id': new_id, 'percentile': hps.percentile, 'threshold': thresh}, f)
+    print('==> Model with {} classes saved to {}'.format(model.n_classes, os.path.join(hps.log_dir, name + '.pth')))
+
+
+if __name__ == "__main__":
+    # This enables a ctr-C without triggering errors
+    import signal
+
+    signal.signal(signal.SIGINT, lambda x, y: sys.exit(0))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log_dir", type=str,
+                        default='./logs', help="Location to save logs")
+
+    # Dataset hyperparams:
+    parser.add_argument("--problem", type=str, default='cifar10',
+                        help="Problem the model was trained on (mnist/fashion/cifar10/svhn/shards)")
+    parser.add_argument("--n_classes", type=int,
+                        default=10, help="number of classes of the trained model.")
+    parser.add_argument("--new_problem", type=str, default='mnist',
+                        help="Dataset of the new class")
+    parser.add_argument("--new_label", type=int, default=0,
+                        help="Label of the new class in new_problem")
+    parser.add_argument("--data_dir", type=str, default='data',
+                        help="Location of data")
+    parser.add_argument("--uint8_inputs", action="store_true",
+                        help="Load images as uint8 tensors, converted to float inside the model")
+
+    # Fine-tune hyperparams:
+    parser.add_argument("--finetune_epochs", type=int, default=0,
+                        help="Epochs of head-only fine-tuning on cached embeddings, 0 to only fit the new class")
+    parser.add_argument("--finetune_lr", type=float, default=0.001,
+                        help="Learning rate of head-only fine-tuning")
+    parser.add_argument("--n_replay", type=int, default=5000,
+                        help="Number of old-class train samples replayed in head-only fine-tuning")
+    parser.add_argument("--n_batch_train", type=int,
+                        default=128, help="Minibatch size")
+    parser.add_argument("--n_batch_test", type=int,
+                        default=200, help="Minibatch size")
+
+    # Inference hyperparams:
+    parser.add_argument("--percentile", type=float, default=0.01,
+                        help="percentile value for inference with rejection.")
+
+    # Model hyperparams:
+    parser.add_argument("--mi_units", type=int,
+                        default=256, help="output size of 1x1 conv network for mutual information estimation")
+    parser.add_argument("--rep_size", type=int,
+                        default=64, help="size of the global representation from encoder")
+    parser.add_argument("--margin", type=float, default=5,
+                        help="likelihood margin.")
+    parser.add_argument("--beta", type=float, default=0.33,
+                        help="coefficient for nll loss")
+    parser.add_argument("--gamma", type=float, default=0.33,
+                        help="coefficient for likelihood margin loss")
+    parser.add_argument("--encoder_name", type=str, default='resnet26',
+                        help="encoder name: resnet#")
+    parser.add_argument('--no-cuda', action='store_true', default=False,
+                        help='disables CUDA training')
+    parser.add_argument("--seed", type=int, default=1234, help="Random seed")
+    add_loader_args(parser)
+    hps = parser.parse_args()  # So error if typo
+
+    use_cuda = not hps.no_cuda and torch.cuda.is_available()
+    torch.manual_seed(hps.seed)
+    np.random.seed(hps.seed)
+    hps.device = torch.device("cuda" if use_cuda else "cpu")
+
+    if hps.problem in ('mnist', 'fashion'):
+        hps.image_channel = 1
+    elif hps.problem == 'shards':
+        from shard_dataset import read_manifest
+        hps.image_channel = 1 if read_manifest(os.path.join(hps.data_dir, 'train')).get('mode') == 'L' else 3
+    else:
+        hps.image_channel = 3
+
+    model = SDIM(rep_size=hps.rep_size,
+                 n_classes=hps.n_classes,
+                 mi_units=hps.mi_units,
+                 encoder_name=hps.encoder_name,
+                 image_channel=hps.image_channel,
+                 margin=hps.margin,
+                 beta=hps.beta,
+                 gamma=hps.gamma).to(hps.device)
+    print('==>  # Model parameters: {}.'.format(cal_parameters(model)))
+
+    add_class(model, hps)
@@ -0,0 +1,117 @@
+"""Cheap adversarial training: single-step FGSM with random start, and "free" adversarial training.
+
+fgsm: every batch is replaced by an FGSM example crafted from a random point of the eps-ball
+    (Wong et al. 2020, "Fast is better than free"), one extra forward/backward per step.
+free: every batch is replayed `free_replays` times; the input gradient of each training
+    backward updates a perturbation kept across replays and batches (Shafahi et al. 2019,
+    "Adversarial training for free!"), no extra forward/backward. Train for about
+    epochs / free_replays epochs to keep the cost of clean training.
+
+Inputs are taken in [clip_min, clip_max] (images in [0, 1]); uint8 batches are converted first.
+Attacks use the cross entropy of the model outputs (SDIM class log-likelihoods or logits).
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from cleverhans_torch.utils import optimize_linear, clip_eta
+
+
+def add_adversarial_training_args(parser):
+    """Add adversarial training hyperparams to an argparse parser.
+    Args:
+        parser: argparse.ArgumentParser.
+    """
+    parser.add_argument("--adv_train", type=str, default='none', choices=['none', 'fgsm', 'free'],
+                        help="Adversarial training mode: none, fgsm (random start) or free")
+    parser.add_argument("--adv_eps", type=float, default=8. / 255,
+                        help="L-inf radius of the training perturbations")
+    parser.add_argument("--adv_alpha", type=float, default=0.,
+                        help="FGSM step size, 0 for 1.25 * adv_eps")
+    parser.add_argument("--free_replays", type=int, default=4,
+                        help="Number of replays of every batch in free adversarial training")
+
+
+def _as_float_input(x):
+    return x.float().div_(255.) if x.dtype == torch.uint8 else x
+
+
+def fgsm_random_init(model_fn, x, y, eps, alpha, norm=np.inf, clip_min=0., clip_max=1.):
+    """
+    FGSM step of size alpha from a uniformly random point of the eps-ball around x, projected
+    back onto the ball. Only the input gradient is computed, parameter gradients are untouched.
+    :param model_fn: callable returning class scores.
+    :param x: input tensor.
+    :param y: true labels.
+    :param eps: float, radius of the ball.
+    :param alpha: float, step size.
+    :param norm: np.inf or 2.
+    :return: detached adversarial example.
+    """
+    x = _as_float_input(x).detach()
+    delta = clip_eta(torch.empty_like(x).uniform_(-eps, eps), norm, eps)
+    x_init = torch.clamp(x + delta, clip_min, clip_max).requires_grad_(True)
+    loss = F.cross_entropy(model_fn(x_init), y)
+    grad, = torch.autograd.grad(loss, x_init)
+    delta = clip_eta(x_init.detach() + optimize_linear(grad, alpha, norm) - x, norm, eps)
+    return torch.clamp(x + delta, clip_min, clip_max).detach()
+
+
+class FGSMAdversary(object):
+    """FGSM with random start, crafted before each training step.
+    """
+    replays = 1
+
+    def __init__(self, eps, alpha, clip_min=0., clip_max=1.):
+        self.eps = eps
+        self.alpha = alpha
+        self.clip_min = clip_min
+        self.clip_max = clip_max
+
+    def perturb(self, model_fn, x, y):
+        return fgsm_random_init(model_fn, x, y, self.eps, self.alpha, clip_min=self.clip_min, clip_max=self.clip_max)
+
+    def update(self, x_adv):
+        pass
+
+
+class FreeAdversary(object):
+    """Perturbation of free adversarial training, kept across replays and batches.
+    """
+    def __init__(self, eps, replays, clip_min=0., clip_max=1.):
+        self.eps = eps
+        self.replays = replays
+        self.clip_min = clip_min
+        self.clip_max = clip_max
+        self.delta = None
+
+    def perturb(self, model_fn, x, y):
+        """
+        :return: leaf tensor x + delta requiring grad; train on it, backward, then call `update`.
+        """
+        x = _as_float_input(x)
+        if self.delta is None or self.delta.shape != x.shape:
+            self.delta = torch.zeros_like(x)  # e.g. smaller last batch
+        return torch.clamp(x + self.delta, self.clip_min, self.clip_max).requires_grad_(True)
+
+    def update(self, x_adv):
+        """Ascend the loss with the input gradient left by the training backward on x_adv."""
+        self.delta = torch.clamp(self.delta + self.eps * x_adv.grad.sign(), -self.eps, self.eps)
+
+
+def get_adversary(hps):
+    """
+    Every batch is trained on `replays` times, each time on adversary.perturb(model, x, y),
+    and adversary.update(x_adv) is called after the backward.
+    :param hps: hyperparameters, see `add_adversarial_training_args`.
+    :return: None, FGSMAdversary or FreeAdversary.
+    """
+    if hps.adv_train == 'none':
+        return None
+    if hps.adv_train == 'fgsm':
+        alpha = hps.adv_alpha if hps.adv_alpha > 0 else 1.25 * hps.adv_eps
+        return FGSMAdversary(hps.adv_eps, alpha)
+    if hps.adv_train == 'free':
+        return FreeAdversary(hps.adv_eps, hps.free_replays)
+    raise ValueError('unknown adversarial training mode {}, expected none, fgsm or free'.format(hps.adv_train))
@@ -5,7 +5,6 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 
 from resnet import build_resnet_32x32
@@ -15,13 +14,16 @@ import numpy as np
 from advertorch.attacks import LinfPGDAttack, CarliniWagnerL2Attack, GradientSignAttack, JacobianSaliencyMapAttack
 
 from utils import get_dataset, cal_parameters
+from loaders import get_loader, add_loader_args
+from rejection import RejectingClassifier
+from score_cache import cached_scores
 
 
 def attack_run(model, adversary, hps):
     model.eval()
     dataset = get_dataset(data_name=hps.problem, train=False)
     # hps.n_batch_test = 1
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
     test_clnloss = 0
     clncorrect = 0
@@ -92,37 +94,12 @@ def attack_run_rejection_policy(model, adversary, hps):
     model.eval()
 
     # Get thresholds
-    threshold_list1 = []
-    threshold_list2 = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            ll = model(x)
-
-            correct_idx = ll.argmax(dim=1) == y
-
-            ll_, y_ = ll[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(ll_[:, label_id].detach().cpu().numpy())
-
-        thresh_idx = int(0.01 * len(in_ll_list))
-        thresh1 = sorted(in_ll_list)[thresh_idx]
-        thresh_idx = int(0.02 * len(in_ll_list))
-        thresh2 = sorted(in_ll_list)[thresh_idx]
-        threshold_list1.append(thresh1)  # class mean as threshold
-        threshold_list2.append(thresh2)  # class mean as threshold
-        print('1st & 2nd percentile thresholds: {:.3f}, {:.3f}'.format(thresh1, thresh2))
+    classifier = RejectingClassifier.calibrated(model, hps, [0.01, 0.02])
 
     # Evaluation
     dataset = get_dataset(data_name=hps.problem, train=False)
     # hps.n_batch_test = 1
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
     n_correct = 0   # total number of correct classified samples by clean classifier
     n_successful_adv = 0  # total number of successful adversarial examples generated
@@ -133,34 +110,25 @@ def attack_run_rejection_policy(model, adversary, hps):
     if not os.path.exists(attack_path):
         os.mkdir(attack_path)
 
-    thresholds1 = torch.tensor(threshold_list1).to(hps.device)
-    thresholds2 = torch.tensor(threshold_list2).to(hps.device)
+    # clean predictions from the cached test scores, in the order of test_loader
+    clean_batches = cached_scores(model, hps, train=False).batches(hps.n_batch_test, hps.device)
 
     l2_distortion_list = []
-    for batch_id, (x, y) in enumerate(test_loader):
+    for batch_id, ((x, y), (clean_ll, _)) in enumerate(zip(test_loader, clean_batches)):
         # Note that images are scaled to [0., 1.0]
         x, y = x.to(hps.device), y.to(hps.device)
-        with torch.no_grad():
-            output = model(x)
-
-        pred = output.argmax(dim=1)
-        correct_idx = pred == y
+        correct_idx = clean_ll.argmax(dim=1) == y
         x, y = x[correct_idx], y[correct_idx]  # Only evaluate on the correct classified samples by clean classifier.
         n_correct += correct_idx.sum().item()
 
         adv_x = adversary.perturb(x, y)
-        with torch.no_grad():
-            output = model(adv_x)
+        pred, reject, _ = classifier(adv_x)
 
         diff = adv_x - x
         l2_distortion = diff.norm(p=2, dim=-1).mean().item()  # mean l2 distortion
 
-        pred = output.argmax(dim=1)
         successful_idx = pred != y   # idx of successful adversarial examples.
-        values, pred = output[successful_idx].max(dim=1)
-        # confidence_idx = values >= thresholds[pred]
-        reject_idx1 = values < thresholds1[pred]  # idx of successfully rejected samples.
-        reject_idx2 = values < thresholds2[pred]  # idx of successfully rejected samples.
+        reject_idx1, reject_idx2 = reject[:, successful_idx]  # idx of successfully rejected samples.
 
         # adv_correct += pred[confidence_idx].eq(y[confidence_idx]).sum().item()
         n_successful_adv += successful_idx.float().sum().item()
@@ -314,6 +282,7 @@ if __name__ == "__main__":
 
     # Ablation
     parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
@@ -0,0 +1,177 @@
+"""asyncio batching engine of the SDIM rejection classifier, for in-process use by Python services.
+
+    async with AsyncBatchingEngine(classifier, (3, 32, 32), max_batch=64, max_wait=0.005) as engine:
+        label, reject, log_likelihoods = await engine.predict(image, timeout=1.)
+
+Single-image requests are queued and coalesced, on the event loop, into batches closed at
+max_batch images or max_wait seconds after their first request; batches run on a dedicated
+thread pool, so the event loop never blocks on the model. At most n_workers batches are in
+flight; while they run, requests accumulate into the next batch, and once max_queue requests
+are waiting `predict` blocks (backpressure) until the engine catches up or its timeout expires.
+A request cancelled or timed out before its batch starts is dropped from the batch. Images not
+of the model input shape are refused by `predict`, before they can join (and fail) a batch.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from serve import ServerStats
+
+
+class AsyncBatchingEngine(object):
+    """Queues single-image requests into batches run by a RejectingClassifier on a thread pool.
+    """
+    def __init__(self, classifier, input_shape, max_batch=64, max_wait=0.005, max_queue=1024, n_workers=2,
+                 device=None, stats=None):
+        """
+        Args:
+            classifier: RejectingClassifier.
+            input_shape: (C, H, W) of the model inputs.
+            max_batch: Maximum number of images of a batch.
+            max_wait: Seconds a batch waits for more requests after its first one.
+            max_queue: Number of waiting requests over which `predict` blocks.
+            n_workers: Number of threads, and of batches in flight.
+            device: Device of the classifier.
+            stats: serve.ServerStats, latency percentiles and batch size histogram.
+        """
+        self.classifier = classifier
+        self.input_shape = tuple(input_shape)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.n_workers = n_workers
+        self.device = device
+        self.stats = stats or ServerStats()
+        self.queue = None
+        self.executor = None
+        self.collector = None
+        self.slots = None
+        self.running = set()
+        self.held = []  # requests taken from the queue by the collector, not yet dispatched to a batch
+        self.closed = False
+
+    async def start(self):
+        """Start the engine on the running event loop."""
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.slots = asyncio.Semaphore(self.n_workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix='sdim-batch')
+        self.collector = asyncio.get_running_loop().create_task(self._collect())
+        return self
+
+    async def close(self):
+        """Finish the batches in flight, fail the waiting requests and release the threads."""
+        self.closed = True
+        self.collector.cancel()
+        try:
+            await self.collector
+        except asyncio.CancelledError:
+            pass
+        if self.running:
+            await asyncio.wait(self.running)
+        waiting, self.held = self.held, []
+        while True:
+            while not self.queue.empty():
+                waiting.append(self.queue.get_nowait())
+            for _, future, _ in waiting:
+                if not future.done():
+                    future.set_exception(RuntimeError('the batching engine is closed'))
+            waiting = []
+            # every get wakes a `predict` blocked on the full queue, let them put before draining again
+            await asyncio.sleep(0)
+            if self.queue.empty():
+                break
+        self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def predict(self, image, timeout=None):
+        """
+        Args:
+            image: C x H x W image, torch.Tensor or np.ndarray, uint8 in [0, 255] or float in [0, 1].
+            timeout: Optional seconds, including the wait for queue space, after which asyncio.TimeoutError is raised.
+        Returns:
+            (label, reject, log_likelihoods): int, bool (at the first rejection level) and n_classes tensor.
+        Raises:
+            ValueError: if the image is not of input_shape.
+            RuntimeError: if the engine is closed.
+        """
+        received = time.perf_counter()
+        if self.closed:
+            raise RuntimeError('the batching engine is closed')
+        x = torch.as_tensor(image)
+        if tuple(x.shape) != self.input_shape:
+            raise ValueError('expected a {} image, got shape {}'.format(
+                ' x '.join(str(d) for d in self.input_shape), tuple(x.shape)))
+        x = x.float().div_(255.) if x.dtype == torch.uint8 else x.float()
+        future = asyncio.get_running_loop().create_future()
+        # backpressure: waits for space in the queue
+        await asyncio.wait_for(self.queue.put((x, future, received)), timeout)
+        if self.closed:
+            # woken by `close` draining the queue: nothing will read the request
+            future.cancel()
+            raise RuntimeError('the batching engine is closed')
+        remaining = None if timeout is None else max(timeout - (time.perf_counter() - received), 0.)
+        # on timeout or cancellation of the caller, the future is cancelled and skipped by its batch
+        label, reject, log_likelihoods = await asyncio.wait_for(future, remaining)
+        self.stats.record_request(1, time.perf_counter() - received)
+        return label, reject, log_likelihoods
+
+    async def _next_batch(self):
+        # dequeued requests are kept in self.held, so that `close` can fail them
+        self.held = batch = []
+        batch.append(await self.queue.get())
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch:
+            if self.queue.empty():
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            await self.slots.acquire()
+            self.held = []
+            batch = [request for request in batch if not request[1].done()]
+            if not batch:
+                self.slots.release()
+                continue
+            task = loop.create_task(self._run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch):
+        try:
+            start = time.perf_counter()
+            self.stats.record_batch(len(batch), [start - received for _, _, received in batch])
+            x = torch.stack([x for x, _, _ in batch])
+            labels, reject, ll = await asyncio.get_running_loop().run_in_executor(self.executor, self._infer, x)
+        except Exception as e:  # inference failed, fail the requests of the batch
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for i, (_, future, _) in enumerate(batch):
+                if not future.done():
+                    future.set_result((labels[i], reject[i], ll[i]))
+        finally:
+            self.slots.release()
+
+    def _infer(self, x):
+        labels, reject, ll = self.classifier(x.to(self.device))
+        return labels.tolist(), reject[0].tolist(), ll.cpu()
@@ -0,0 +1,76 @@
+"""Batched data augmentation applied to whole tensors instead of single PIL images.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+# Datasets for which `get_dataset` uses crop_flip augmentation on the train split.
+CROP_FLIP_DATASETS = ('fashion', 'cifar10', 'svhn')
+
+
+def batch_crop_flip(x, padding=4, flip=True, generator=None):
+    """Random crop with zero padding and random horizontal flip on a batch.
+    Equivalent to RandomCrop(size, padding=padding) + RandomHorizontalFlip() per sample,
+    but done with a single pad and a single gather for the whole batch.
+    Args:
+        x: Image batch of shape (N, C, H, W), uint8 or float.
+        padding: Number of zero pixels padded on each border.
+        flip: Whether to randomly flip samples horizontally with probability 0.5.
+        generator: torch.Generator (on cpu) used to draw crop offsets and flips.
+    Returns:
+        torch.Tensor: augmented batch, same shape, dtype and device as x.
+    """
+    n, c, h, w = x.size()
+
+    # Offsets and flips are drawn on cpu so that a seeded generator gives the same
+    # augmentation regardless of the device of x.
+    top = torch.randint(0, 2 * padding + 1, (n,), generator=generator)
+    left = torch.randint(0, 2 * padding + 1, (n,), generator=generator)
+    if flip:
+        flip_mask = torch.rand(n, generator=generator) < 0.5
+    else:
+        flip_mask = torch.zeros(n, dtype=torch.bool)
+
+    rows = top.unsqueeze(dim=1) + torch.arange(h)   # (N, H)
+    cols = left.unsqueeze(dim=1) + torch.arange(w)  # (N, W)
+    cols = torch.where(flip_mask.unsqueeze(dim=1), cols.flip(dims=[1]), cols)
+
+    rows, cols = rows.to(x.device), cols.to(x.device)
+    padded = F.pad(x, (padding, padding, padding, padding))
+
+    batch_idx = torch.arange(n, device=x.device)[:, None, None, None]
+    channel_idx = torch.arange(c, device=x.device)[None, :, None, None]
+    return padded[batch_idx, channel_idx, rows[:, None, :, None], cols[:, None, None, :]]
+
+
+class BatchCropFlip(object):
+    """Callable batched crop_flip augmentation with its own seeded random stream.
+    """
+    def __init__(self, padding=4, flip=True, seed=None):
+        """
+        Args:
+            padding: Number of zero pixels padded on each border.
+            flip: Whether to randomly flip samples horizontally.
+            seed: None or int, seed of the augmentation random stream.
+        """
+        self.padding = padding
+        self.flip = flip
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    def __call__(self, x):
+        return batch_crop_flip(x, padding=self.padding, flip=self.flip, generator=self.generator)
+
+
+def get_batch_augmentation(data_name, seed=None):
+    """
+    Get the batched counterpart of the crop_flip transform `get_dataset` uses for data_name.
+    :param data_name: str, name of dataset.
+    :param seed: None or int, seed of the augmentation random stream.
+    :return: BatchCropFlip, or None if data_name is trained without augmentation.
+    """
+    if data_name not in CROP_FLIP_DATASETS:
+        return None
+    return BatchCropFlip(padding=4, flip=True, seed=seed)
@@ -0,0 +1,91 @@
+"""Throughput and memory of gradient accumulation versus real large batches for SDIM.
+
+Every configuration (micro-batch size, accumulation steps) with the same effective batch size
+runs in its own process, so that the peak memory of one does not hide the others':
+
+    python benchmark_accumulation.py --batch_size 512 --micro_batch_sizes 512 256 128 64
+
+Inputs are random, only the cost of a training step is measured.
+"""
+
+import argparse
+import resource
+import sys
+import time
+
+import torch
+import torch.multiprocessing as mp
+from torch.optim import Adam
+
+from sdim import SDIM
+
+
+def _peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _run(micro_batch_size, hps, results):
+    torch.manual_seed(hps.seed)
+    torch.set_num_threads(hps.threads)
+    device = torch.device(hps.device)
+    accumulation_steps = hps.batch_size // micro_batch_size
+
+    model = SDIM(rep_size=hps.rep_size, mi_units=hps.mi_units, encoder_name=hps.encoder_name,
+                 image_channel=hps.image_channel).to(device)
+    optimizer = Adam(model.parameters(), lr=1e-3)
+    x = torch.rand(hps.batch_size, hps.image_channel, 32, 32, device=device)
+    y = torch.randint(0, 10, (hps.batch_size,), device=device)
+    base_memory = _peak_memory_mb(device)
+
+    def optimizer_step():
+        optimizer.zero_grad()
+        for i in range(accumulation_steps):
+            micro = slice(i * micro_batch_size, (i + 1) * micro_batch_size)
+            loss, _, _, _ = model.eval_losses(x[micro], y[micro])
+            (loss / accumulation_steps).backward()
+        optimizer.step()
+
+    optimizer_step()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(hps.steps):
+        optimizer_step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    results.put((micro_batch_size, accumulation_steps, hps.steps * hps.batch_size / elapsed,
+                 _peak_memory_mb(device) - base_memory))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=512, help="Effective batch size of an optimizer step")
+    parser.add_argument("--micro_batch_sizes", type=int, nargs='+', default=[512, 256, 128, 64],
+                        help="Micro-batch sizes compared, divisors of batch_size")
+    parser.add_argument("--steps", type=int, default=5, help="Number of timed optimizer steps")
+    parser.add_argument("--encoder_name", type=str, default='resnet10', help="encoder name: resnet#")
+    parser.add_argument("--rep_size", type=int, default=64, help="size of the global representation from encoder")
+    parser.add_argument("--mi_units", type=int, default=32,
+                        help="output size of 1x1 conv network for mutual information estimation")
+    parser.add_argument("--image_channel", type=int, default=3, help="Number of image channels")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads(), help="Number of cpu threads")
+    parser.add_argument("--device", type=str, default='cpu', help="cpu or cuda")
+    parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    hps = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    print('effective batch size {}, {} steps'.format(hps.batch_size, hps.steps))
+    print('{:>12} {:>12} {:>14} {:>16}'.format('micro batch', 'accum steps', 'samples/s', 'peak memory MB'))
+    for micro_batch_size in hps.micro_batch_sizes:
+        assert hps.batch_size % micro_batch_size == 0, 'micro batch sizes must divide batch_size'
+        process = ctx.Process(target=_run, args=(micro_batch_size, hps, results))
+        process.start()
+        micro, accumulation_steps, throughput, memory = results.get()
+        process.join()
+        print('{:>12} {:>12} {:>14.1f} {:>16.1f}'.format(micro, accumulation_steps, throughput, memory))
@@ -0,0 +1,137 @@
+"""Time to robust accuracy of cheap adversarial training (fgsm, free) against PGD training.
+
+Every mode trains the same model from the same seed; after each epoch the cumulative training
+time (evaluation excluded), clean accuracy and PGD accuracy on the first n_eval test samples
+are printed:
+
+    python benchmark_adversarial_training.py --model sdim --problem cifar10 --epochs 10
+
+Free training replays every batch free_replays times and runs epochs // free_replays epochs,
+so that all modes but pgd cost about the same per epoch of data.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.optim import Adam
+
+from adversarial_training import get_adversary, add_adversarial_training_args
+from cleverhans_torch.attacks.projected_gradient_descent import projected_gradient_descent
+from loaders import get_loader, add_loader_args
+from utils import get_dataset
+
+
+def _build(hps):
+    if hps.model == 'sdim':
+        from main import build_model
+    else:
+        from discriminative_classifiers_main import build_model
+    return build_model(hps)
+
+
+def _loss(model, x, y, hps):
+    if hps.model == 'sdim':
+        return model.eval_losses(x, y)[0]
+    return F.cross_entropy(model(x), y)
+
+
+def _pgd(model, x, y, eps, nb_iter):
+    return projected_gradient_descent(model, x, eps=eps, eps_iter=2.5 * eps / nb_iter, nb_iter=nb_iter,
+                                      norm=np.inf, clip_min=0., clip_max=1., y=y, sanity_checks=False).detach()
+
+
+def evaluate(model, test_x, test_y, hps):
+    model.eval()
+    clean, robust = 0, 0
+    for x, y in zip(test_x.split(hps.n_batch_test), test_y.split(hps.n_batch_test)):
+        with torch.no_grad():
+            clean += (model(x).argmax(dim=1) == y).sum().item()
+        x_adv = _pgd(model, x, y, hps.adv_eps, hps.eval_pgd_iter)
+        with torch.no_grad():
+            robust += (model(x_adv).argmax(dim=1) == y).sum().item()
+    model.zero_grad()  # the attack leaves parameter gradients behind
+    return clean / test_y.size(0), robust / test_y.size(0)
+
+
+def run(mode, train_loader, test_x, test_y, hps):
+    torch.manual_seed(hps.seed)
+    hps.adv_train = 'none' if mode == 'pgd' else mode
+    adversary = get_adversary(hps)
+    model = _build(hps)
+    optimizer = Adam(model.parameters(), lr=hps.lr)
+    epochs = max(1, hps.epochs // hps.free_replays) if mode == 'free' else hps.epochs
+
+    train_seconds = 0.
+    for epoch in range(1, epochs + 1):
+        model.train()
+        start = time.perf_counter()
+        for x, y in train_loader:
+            x, y = x.to(hps.device), y.to(hps.device)
+            if x.dtype == torch.uint8:
+                x = x.float().div_(255.)
+            if mode == 'pgd':
+                x = _pgd(model, x, y, hps.adv_eps, hps.train_pgd_iter)
+            n_replays = adversary.replays if adversary is not None else 1
+            for replay in range(n_replays):
+                optimizer.zero_grad()
+                x_in = adversary.perturb(model, x, y) if adversary is not None else x
+                loss = _loss(model, x_in, y, hps)
+                loss.backward()
+                if adversary is not None:
+                    adversary.update(x_in)
+                optimizer.step()
+        train_seconds += time.perf_counter() - start
+
+        clean_acc, robust_acc = evaluate(model, test_x, test_y, hps)
+        print('{:>6} {:>6} {:>10.1f} {:>10.4f} {:>10.4f}'.format(mode, epoch, train_seconds, clean_acc, robust_acc))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default='sdim', help="sdim or discriminative")
+    parser.add_argument("--modes", type=str, nargs='+', default=['none', 'fgsm', 'free', 'pgd'],
+                        help="Training modes compared: none, fgsm, free, pgd")
+    parser.add_argument("--problem", type=str, default='cifar10', help="Problem (mnist/fashion/cifar10/svhn/shards)")
+    parser.add_argument("--data_dir", type=str, default='data', help="Location of data")
+    parser.add_argument("--uint8_inputs", action="store_true",
+                        help="Load images as uint8 tensors, converted to float inside the model")
+    parser.add_argument("--n_classes", type=int, default=10, help="number of classes of dataset.")
+    parser.add_argument("--image_channel", type=int, default=3, help="Number of image channels")
+    parser.add_argument("--n_batch_train", type=int, default=128, help="Minibatch size")
+    parser.add_argument("--n_batch_test", type=int, default=200, help="Minibatch size")
+    parser.add_argument("--lr", type=float, default=0.001, help="Base learning rate")
+    parser.add_argument("--epochs", type=int, default=10, help="Number of training epochs per mode")
+    parser.add_argument("--train_pgd_iter", type=int, default=7, help="PGD iterations of pgd training")
+    parser.add_argument("--eval_pgd_iter", type=int, default=10, help="PGD iterations of the robust evaluation")
+    parser.add_argument("--n_eval", type=int, default=1000, help="Number of test samples evaluated")
+    parser.add_argument("--encoder_name", type=str, default='resnet10', help="encoder name: resnet#")
+    parser.add_argument("--rep_size", type=int, default=64, help="size of the global representation from encoder")
+    parser.add_argument("--mi_units", type=int, default=32,
+                        help="output size of 1x1 conv network for mutual information estimation")
+    parser.add_argument("--margin", type=float, default=5, help="likelihood margin.")
+    parser.add_argument("--alpha", type=float, default=0.33, help="coefficient for mutual information loss")
+    parser.add_argument("--beta", type=float, default=0.33, help="coefficient for nll loss")
+    parser.add_argument("--gamma", type=float, default=0.33, help="coefficient for likelihood margin loss")
+    parser.add_argument("--dim_negatives", type=str, default='local', help="DIM negatives, see distributed.py")
+    parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_adversarial_training_args(parser)
+    add_loader_args(parser)
+    hps = parser.parse_args()
+    hps.device = torch.device('cpu')
+
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=True, uint8=hps.uint8_inputs)
+    train_loader = get_loader(dataset, batch_size=hps.n_batch_train, shuffle=True, hps=hps)
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs)
+    test_x, test_y = [], []
+    for x, y in get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps):
+        test_x.append(x.float().div_(255.) if x.dtype == torch.uint8 else x)
+        test_y.append(y)
+    test_x, test_y = torch.cat(test_x)[:hps.n_eval], torch.cat(test_y)[:hps.n_eval]
+
+    print('{} on {}, eps {:.4f}'.format(hps.model, hps.problem, hps.adv_eps))
+    print('{:>6} {:>6} {:>10} {:>10} {:>10}'.format('mode', 'epoch', 'train s', 'clean acc', 'pgd acc'))
+    for mode in hps.modes:
+        run(mode, train_loader, test_x, test_y, hps)
@@ -0,0 +1,88 @@
+"""Throughput and latency of the asyncio batching engine against offline batched inference.
+
+    python benchmark_async_batching.py --problem cifar10 --n_concurrent 256 --max_batch 64 --max_wait_ms 5
+
+Offline: the classifier on back-to-back batches of max_batch random images. Engine: n_concurrent
+coroutines each awaiting `AsyncBatchingEngine.predict` on single random images, n_images in total.
+Prints images/s of both, the engine request latency percentiles and its batch size histogram.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+import torch
+
+from async_batching import AsyncBatchingEngine
+from serve import ServerStats, add_model_args, load_classifier
+
+
+def offline_throughput(classifier, images, batch_size, device):
+    start = time.perf_counter()
+    for i in range(0, images.size(0), batch_size):
+        classifier(images[i:i + batch_size].to(device))
+    return images.size(0) / (time.perf_counter() - start)
+
+
+async def engine_throughput(engine, images, n_concurrent, timeout):
+    latencies, n_timeouts = [], 0
+    next_image = iter(range(images.size(0)))
+
+    async def client():
+        nonlocal n_timeouts
+        for i in next_image:
+            start = time.perf_counter()
+            try:
+                await engine.predict(images[i], timeout=timeout)
+            except asyncio.TimeoutError:
+                n_timeouts += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(n_concurrent)])
+    return len(latencies) / (time.perf_counter() - start), latencies, n_timeouts
+
+
+async def run(classifier, images, hps):
+    async with AsyncBatchingEngine(classifier, images.size()[1:], max_batch=hps.max_batch,
+                                   max_wait=hps.max_wait_ms / 1000., max_queue=hps.max_queue, n_workers=hps.n_workers,
+                                   device=hps.device) as engine:
+        await engine_throughput(engine, images[:hps.max_batch], hps.n_concurrent, None)  # warm up
+        engine.stats = ServerStats()
+        return await engine_throughput(engine, images, hps.n_concurrent, hps.timeout) + (engine.stats.summary(),)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=5000, help="Number of requests of the engine")
+    parser.add_argument("--n_concurrent", type=int, default=256, help="Number of concurrent requests")
+    parser.add_argument("--max_batch", type=int, default=64, help="Maximum number of images of a batch")
+    parser.add_argument("--max_wait_ms", type=float, default=5.,
+                        help="Milliseconds a batch waits for more requests after its first one")
+    parser.add_argument("--max_queue", type=int, default=1024, help="Number of waiting requests before backpressure")
+    parser.add_argument("--n_workers", type=int, default=2, help="Number of inference threads")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds before a request times out")
+    add_model_args(parser)
+    hps = parser.parse_args()
+    hps.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    classifier, checkpoint_path = load_classifier(hps)
+    images = torch.rand(hps.n_images, hps.image_channel, hps.image_size, hps.image_size,
+                        generator=torch.Generator().manual_seed(hps.seed))
+    offline_throughput(classifier, images[:hps.max_batch], hps.max_batch, hps.device)  # warm up
+    offline = offline_throughput(classifier, images, hps.max_batch, hps.device)
+    throughput, latencies, n_timeouts, stats = asyncio.run(run(classifier, images, hps))
+
+    print('==================== Async Batching ====================')
+    print('{}: {} requests, {} concurrent, max_batch {}, max_wait {}ms, {} workers'.format(
+        checkpoint_path, hps.n_images, hps.n_concurrent, hps.max_batch, hps.max_wait_ms, hps.n_workers))
+    print('Offline batches: {:.1f} images/s'.format(offline))
+    print('Engine: {:.1f} images/s ({:.1%} of offline), {} timeouts'.format(throughput, throughput / offline,
+                                                                          n_timeouts))
+    if latencies:
+        p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+        print('Request latency (ms): p50 {:.2f}, p90 {:.2f}, p99 {:.2f}'.format(p50, p90, p99))
+    print('Batch sizes: {}'.format(json.dumps(stats['batch_sizes'])))
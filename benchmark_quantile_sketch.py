@@ -0,0 +1,102 @@
+"""Accuracy of the per-class KLL sketch thresholds against the exact ones, for a trained SDIM.
+
+The train set log-likelihoods feed an exact ThresholdCalibrator and n_workers SketchCalibrators
+(batches dealt round-robin, as to data-parallel workers), whose pickled copies are merged:
+
+    python benchmark_quantile_sketch.py --problem cifar10 --sketch_size 2000 --n_workers 4
+
+For every class and percentile, the exact and sketch thresholds are printed with the true
+percentile of the sketch threshold and the bound on its error.
+"""
+
+import argparse
+import os
+import pickle
+
+import torch
+
+from calibration import ThresholdCalibrator, SketchCalibrator, calibrate
+from loaders import get_loader, add_loader_args
+from main import build_model
+from utils import get_dataset
+
+
+class _Fanout(object):
+    """Feeds the exact calibrator every batch and the worker sketches one batch each in turn."""
+    def __init__(self, exact, sketches):
+        self.exact = exact
+        self.sketches = sketches
+        self.n_batches = 0
+
+    def update(self, scores, y):
+        self.exact.update(scores, y)
+        self.sketches[self.n_batches % len(self.sketches)].update(scores, y)
+        self.n_batches += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--problem", type=str, default='cifar10', help="Problem (mnist/fashion/cifar10/svhn/shards)")
+    parser.add_argument("--data_dir", type=str, default='data', help="Location of data")
+    parser.add_argument("--log_dir", type=str, default='./logs', help="Location of the SDIM checkpoint")
+    parser.add_argument("--uint8_inputs", action="store_true",
+                        help="Load images as uint8 tensors, converted to float inside the model")
+    parser.add_argument("--n_classes", type=int, default=10, help="number of classes of dataset.")
+    parser.add_argument("--image_channel", type=int, default=3, help="Number of image channels")
+    parser.add_argument("--n_batch_test", type=int, default=200, help="Minibatch size")
+    parser.add_argument("--encoder_name", type=str, default='resnet18', help="encoder name: resnet#")
+    parser.add_argument("--rep_size", type=int, default=64, help="size of the global representation from encoder")
+    parser.add_argument("--mi_units", type=int, default=256,
+                        help="output size of 1x1 conv network for mutual information estimation")
+    parser.add_argument("--margin", type=float, default=5, help="likelihood margin.")
+    parser.add_argument("--alpha", type=float, default=0.33, help="coefficient for mutual information loss")
+    parser.add_argument("--beta", type=float, default=0.33, help="coefficient for nll loss")
+    parser.add_argument("--gamma", type=float, default=0.33, help="coefficient for likelihood margin loss")
+    parser.add_argument("--dim_negatives", type=str, default='local', help="DIM negatives, see distributed.py")
+    parser.add_argument("--sketch_size", type=int, default=2000, help="KLL sketch size k")
+    parser.add_argument("--n_workers", type=int, default=4, help="Number of merged worker sketches")
+    parser.add_argument("--percentiles", type=float, nargs='+', default=[0.01, 0.02],
+                        help="Percentiles of the thresholds compared")
+    parser.add_argument("--delta", type=float, default=0.01, help="Failure probability of the error bound")
+    parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
+    hps = parser.parse_args()
+    hps.device = torch.device('cpu')
+
+    model = build_model(hps)
+    checkpoint_path = os.path.join(hps.log_dir, 'sdim_{}_{}_d{}.pth'.format(hps.encoder_name, hps.problem,
+                                                                            hps.rep_size))
+    model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
+    model.eval()
+
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=True, crop_flip=False,
+                          uint8=hps.uint8_inputs)
+    loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
+    fanout = _Fanout(ThresholdCalibrator(hps.n_classes, capacity=len(dataset)),
+                     [SketchCalibrator(hps.n_classes, k=hps.sketch_size, seed=hps.seed + 1000 * worker)
+                      for worker in range(hps.n_workers)])
+    calibrate(model, loader, hps.n_classes, device=hps.device, calibrator=fanout)
+
+    exact = fanout.exact
+    sketch = pickle.loads(pickle.dumps(fanout.sketches[0]))
+    for worker_sketch in fanout.sketches[1:]:
+        sketch.merge(pickle.loads(pickle.dumps(worker_sketch)))
+
+    exact_thresholds, sketch_thresholds = exact.thresholds(hps.percentiles), sketch.thresholds(hps.percentiles)
+    counts, bounds = exact.counts(), sketch.rank_error_bounds(hps.delta)
+    values, labels = exact.values[:exact.n], exact.labels[:exact.n]
+    n_items = sum(s.size() for s in sketch.sketches)
+    print('{} samples kept by the exact calibration, {} by the sketches (k={}, {} workers)'.format(
+        exact.n, n_items, hps.sketch_size, hps.n_workers))
+    print('{:>6} {:>8} {:>6} {:>12} {:>12} {:>12} {:>12}'.format(
+        'class', 'count', 'p', 'exact', 'sketch', 'true p', 'bound'))
+    for label_id in range(hps.n_classes):
+        class_values = values[labels == label_id]
+        for i, p in enumerate(hps.percentiles):
+            # percentile of the sketch threshold among the exact class scores
+            true_p = (class_values < sketch_thresholds[i, label_id]).double().mean().item() \
+                if class_values.numel() > 0 else float('nan')
+            print('{:>6} {:>8} {:>6g} {:>12.3f} {:>12.3f} {:>12.4f} {:>12}'.format(
+                label_id, counts[label_id].item(), p, exact_thresholds[i, label_id].item(),
+                sketch_thresholds[i, label_id].item(), true_p,
+                '+-{:.4f}'.format(bounds[label_id].item() / max(counts[label_id].item(), 1))))
@@ -0,0 +1,87 @@
+"""Load generator of the inference server (serve.py), on localhost.
+
+n_clients threads each send n_requests POST /predict of batch_size random uint8 images, as .npy
+bodies, back to back:
+
+    python serve.py --problem cifar10 --max_batch 64 --max_wait_ms 5 &
+    python benchmark_serve.py --n_clients 32 --n_requests 100 --batch_size 1
+
+The client-side throughput and latency percentiles are printed, then the server /metrics
+(server-side latency and queueing percentiles, micro-batch size histogram).
+"""
+
+import argparse
+import io
+import json
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+
+def post_images(url, images):
+    buffer = io.BytesIO()
+    np.save(buffer, images, allow_pickle=False)
+    request = urllib.request.Request(url + '/predict', data=buffer.getvalue(),
+                                     headers={'Content-Type': 'application/x-npy'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode())
+
+
+def get_metrics(url):
+    with urllib.request.urlopen(url + '/metrics') as response:
+        return json.loads(response.read().decode())
+
+
+def client(url, shape, n_requests, seed, latencies, errors):
+    rng = np.random.RandomState(seed)
+    for _ in range(n_requests):
+        images = rng.randint(0, 256, size=shape, dtype=np.uint8)
+        start = time.perf_counter()
+        try:
+            outs = post_images(url, images)
+            assert len(outs['labels']) == shape[0]
+        except Exception as e:
+            errors.append(e)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default='http://127.0.0.1:8000', help="Address of the server")
+    parser.add_argument("--n_clients", type=int, default=32, help="Number of concurrent clients")
+    parser.add_argument("--n_requests", type=int, default=100, help="Number of requests of every client")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of images of a request")
+    parser.add_argument("--image_channel", type=int, default=3, help="Number of image channels")
+    parser.add_argument("--image_size", type=int, default=32, help="Height and width of the images")
+    parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    hps = parser.parse_args()
+
+    shape = (hps.batch_size, hps.image_channel, hps.image_size, hps.image_size)
+    post_images(hps.url, np.zeros(shape, dtype=np.uint8))  # warm up
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(hps.url, shape, hps.n_requests, hps.seed + i, latencies, errors))
+               for i in range(hps.n_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print('==================== Load Generator ====================')
+    print('{} clients x {} requests of {} images, {} errors'.format(hps.n_clients, hps.n_requests, hps.batch_size,
+                                                                    len(errors)))
+    if errors:
+        print('First error: {}'.format(errors[0]))
+    print('Throughput: {:.1f} requests/s, {:.1f} images/s'.format(
+        len(latencies) / elapsed, len(latencies) * hps.batch_size / elapsed))
+    if latencies:
+        p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+        print('Client latency (ms): p50 {:.2f}, p90 {:.2f}, p99 {:.2f}'.format(p50, p90, p99))
+
+    print('==================== Server Metrics ====================')
+    print(json.dumps(get_metrics(hps.url), indent=2))
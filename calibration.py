@@ -0,0 +1,402 @@
+"""Per-class rejection thresholds from a single pass over the (train) data.
+
+The threshold of class c at percentile p is the score of class c ranked int(p * n_c) among the
+n_c correctly classified samples of class c, sorted ascending. Scores are gathered in one pass
+over the whole dataset into preallocated tensors, then a single sort gives the thresholds of
+every class at any number of percentiles at once.
+
+For calibration sets too large to keep every score, SketchCalibrator keeps a mergeable KLL
+quantile sketch per class instead (memory O(k) per class), at the cost of a bounded rank error,
+see `KLLSketch.rank_error_bound`. Sketches of disjoint parts of the data, e.g. built by different
+worker processes, merge into the sketch of the whole.
+
+`load_or_calibrate` saves the thresholds of a grid of percentiles as a json artifact in the log
+directory, keyed by a hash of the model weights and of the calibration config, so that later
+runs with the same checkpoint and config load them instead of recalibrating.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from distributed import is_distributed
+from score_cache import cached_scores, dataset_fingerprint, weights_hash
+
+
+def _correct_class_scores(scores, y):
+    """True-class scores and labels of the correctly classified samples."""
+    scores, y = scores.detach(), y.to(scores.device)
+    correct = scores.argmax(dim=1) == y
+    return scores[correct].gather(1, y[correct].unsqueeze(1)).squeeze(1), y[correct]
+
+
+def print_thresholds(percentiles, thresholds, counts):
+    """
+    :param percentiles: list of P floats.
+    :param thresholds: torch.Tensor, P x n_classes.
+    :param counts: torch.Tensor, n_classes numbers of correctly classified samples.
+    """
+    counts = counts.tolist()
+    for label_id in range(len(counts)):
+        print('label_id {}, correctly classified: {}, thresholds at {}: {}'.format(
+            label_id, counts[label_id], ', '.join('{:g}'.format(p) for p in percentiles),
+            ', '.join('{:.3f}'.format(t) for t in thresholds[:, label_id].tolist())))
+
+
+class ThresholdCalibrator(object):
+    """Collects the true-class scores of correctly classified samples.
+    """
+    def __init__(self, n_classes, capacity=1024, device=None):
+        """
+        Args:
+            n_classes: Number of classes.
+            capacity: Initial number of preallocated scores, e.g. the dataset size (grows if needed).
+            device: Device of the buffers, the one of the scores.
+        """
+        self.n_classes = n_classes
+        self.values = torch.empty(max(capacity, 1), device=device)
+        self.labels = torch.empty(max(capacity, 1), dtype=torch.long, device=device)
+        self.n = 0
+
+    def update(self, scores, y):
+        """
+        Args:
+            scores: N x n_classes model outputs (log-likelihoods, logits or probabilities).
+            y: N labels.
+        """
+        values, labels = _correct_class_scores(scores, y)
+        n_new = values.numel()
+        if self.n + n_new > self.values.numel():
+            capacity = max(2 * self.values.numel(), self.n + n_new)
+            self.values = torch.cat([self.values[:self.n], self.values.new_empty(capacity - self.n)])
+            self.labels = torch.cat([self.labels[:self.n], self.labels.new_empty(capacity - self.n)])
+        self.values[self.n:self.n + n_new] = values.to(self.values)
+        self.labels[self.n:self.n + n_new] = labels.to(self.labels.device)
+        self.n += n_new
+
+    def counts(self):
+        """Number of correctly classified samples per class."""
+        return torch.bincount(self.labels[:self.n], minlength=self.n_classes)
+
+    def order_statistics(self, ranks):
+        """
+        Args:
+            ranks: LongTensor, R x n_classes (or R, same for every class) ranks in the ascending scores
+                of each class, clamped to the number of scores of the class.
+        Returns:
+            torch.Tensor: R x n_classes scores, -inf for classes without any score.
+        """
+        values, labels = self.values[:self.n], self.labels[:self.n]
+        # Group by class with a stable sort of the sorted scores: scores ascend within each class.
+        values, order = torch.sort(values)
+        labels, order_by_class = torch.sort(labels[order], stable=True)
+        values = values[order_by_class]
+
+        counts = self.counts()
+        offsets = torch.cumsum(counts, 0) - counts
+        ranks = torch.as_tensor(ranks, dtype=torch.long, device=counts.device)
+        if ranks.dim() == 1:
+            ranks = ranks.unsqueeze(1).expand(-1, self.n_classes)
+        ranks = torch.min(ranks, (counts - 1).clamp(min=0)).clamp(min=0)
+        out = values[(offsets + ranks).clamp(max=max(self.n - 1, 0))] if self.n > 0 else \
+            torch.zeros(ranks.size(), device=values.device)
+        out[:, counts == 0] = float('-inf')
+        return out
+
+    def thresholds(self, percentiles):
+        """
+        Args:
+            percentiles: List of floats in [0, 1).
+        Returns:
+            torch.Tensor: len(percentiles) x n_classes thresholds.
+        """
+        counts = self.counts().double()
+        percentiles = torch.as_tensor(percentiles, dtype=torch.float64, device=counts.device)
+        ranks = (percentiles.unsqueeze(1) * counts.unsqueeze(0)).long()
+        return self.order_statistics(ranks)
+
+    def report(self, percentiles):
+        """Print the thresholds of every class."""
+        print_thresholds(percentiles, self.thresholds(percentiles), self.counts())
+
+
+class KLLSketch(object):
+    """KLL quantile sketch of a stream of floats (Karnin, Lang & Liberty 2016).
+
+    Level h holds items of weight 2 ** h. A level over capacity is sorted and compacted: every
+    other item, from a random offset, is promoted to the next level. Each compaction at level h
+    moves the rank of any query by at most 2 ** h, zero on average.
+    """
+    def __init__(self, k=200, c=2. / 3, seed=None):
+        """
+        Args:
+            k: Capacity of the top level, the rank error is about n / k.
+            c: Capacity decay from one level to the one below.
+            seed: Seed of the compaction offsets.
+        """
+        self.k = k
+        self.c = c
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.weight_sum = 0.  # sum of the weights of all compactions
+        self.sq_weight_sum = 0.  # sum of their squares
+        self.rng = np.random.RandomState(seed)
+
+    def _capacity(self, level):
+        return max(int(np.ceil(self.k * self.c ** (len(self.levels) - level - 1))), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items.size > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                odd = items.size % 2  # the smallest item stays when the count is odd
+                promoted = items[odd + self.rng.randint(2)::2]
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.weight_sum += 2 ** level
+                self.sq_weight_sum += 4 ** level
+            level += 1
+
+    def update(self, values):
+        """
+        Args:
+            values: array-like of floats.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += values.size
+        self._compress()
+
+    def merge(self, other):
+        """Merge the sketch of another (disjoint) stream into this one."""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self.weight_sum += other.weight_sum
+        self.sq_weight_sum += other.sq_weight_sum
+        self._compress()
+
+    def quantiles(self, percentiles):
+        """
+        Args:
+            percentiles: List of floats in [0, 1).
+        Returns:
+            np.ndarray: the items ranked about int(p * n) in the stream, -inf for an empty stream.
+        """
+        if self.n == 0:
+            return np.full(len(percentiles), -np.inf)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(items.size, 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, cum_weights = values[order], np.cumsum(weights[order])
+        ranks = (np.asarray(percentiles, dtype=np.float64) * self.n).astype(np.int64)
+        idx = np.searchsorted(cum_weights, ranks, side='right')
+        return values[np.minimum(idx, values.size - 1)]
+
+    def rank_error_bound(self, delta=0.01):
+        """
+        Bound on the rank error of a quantile holding with probability 1 - delta: Hoeffding
+        bound of the sum of the independent, zero mean compaction errors, or the worst case
+        (the sum of the compaction weights) when smaller. Zero while no item was compacted.
+        """
+        return min(np.sqrt(2. * self.sq_weight_sum * np.log(2. / delta)), self.weight_sum)
+
+    def size(self):
+        """Number of items held."""
+        return sum(items.size for items in self.levels)
+
+
+class SketchCalibrator(object):
+    """ThresholdCalibrator with a KLL sketch per class instead of all the scores.
+    """
+    def __init__(self, n_classes, k=200, seed=None):
+        """
+        Args:
+            n_classes: Number of classes.
+            k: KLL sketch size, see `KLLSketch`.
+            seed: Seed of the sketches.
+        """
+        self.n_classes = n_classes
+        self.sketches = [KLLSketch(k, seed=None if seed is None else seed + label_id)
+                         for label_id in range(n_classes)]
+
+    def update(self, scores, y):
+        """
+        Args:
+            scores: N x n_classes model outputs (log-likelihoods, logits or probabilities).
+            y: N labels.
+        """
+        values, labels = _correct_class_scores(scores, y)
+        values, labels = values.cpu().double().numpy(), labels.cpu().numpy()
+        order = np.argsort(labels, kind='stable')
+        values, labels = values[order], labels[order]
+        bounds = np.searchsorted(labels, np.arange(self.n_classes + 1))
+        for label_id in range(self.n_classes):
+            if bounds[label_id + 1] > bounds[label_id]:
+                self.sketches[label_id].update(values[bounds[label_id]:bounds[label_id + 1]])
+
+    def merge(self, other):
+        """Merge the calibrator of another (disjoint) part of the data into this one."""
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+
+    def counts(self):
+        """Number of correctly classified samples per class."""
+        return torch.tensor([sketch.n for sketch in self.sketches], dtype=torch.long)
+
+    def thresholds(self, percentiles):
+        """
+        Args:
+            percentiles: List of floats in [0, 1).
+        Returns:
+            torch.Tensor: len(percentiles) x n_classes thresholds.
+        """
+        return torch.from_numpy(np.stack([sketch.quantiles(percentiles) for sketch in self.sketches], axis=1)).float()
+
+    def rank_error_bounds(self, delta=0.01):
+        """Per class rank error bound, see `KLLSketch.rank_error_bound`."""
+        return torch.tensor([sketch.rank_error_bound(delta) for sketch in self.sketches], dtype=torch.float64)
+
+    def report(self, percentiles, delta=0.01):
+        """Print the thresholds of every class, with the bound on their percentile error."""
+        thresholds = self.thresholds(percentiles)
+        counts = self.counts().tolist()
+        bounds = self.rank_error_bounds(delta).tolist()
+        for label_id in range(self.n_classes):
+            print('label_id {}, correctly classified: {}, thresholds at {}: {} (percentile error <= {:.4f} '
+                  'w.p. {:g}, sketch size {})'.format(
+                      label_id, counts[label_id], ', '.join('{:g}'.format(p) for p in percentiles),
+                      ', '.join('{:.3f}'.format(t) for t in thresholds[:, label_id].tolist()),
+                      bounds[label_id] / max(counts[label_id], 1), 1 - delta, self.sketches[label_id].size()))
+
+
+def merge_across_ranks(calibrator):
+    """
+    Merge the SketchCalibrator of every data-parallel rank, each fed a different part of the data.
+    :param calibrator: SketchCalibrator.
+    :return: SketchCalibrator of all the data, on every rank.
+    """
+    if not is_distributed():
+        return calibrator
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, calibrator)
+    merged = gathered[0]
+    for other in gathered[1:]:
+        merged.merge(other)
+    return merged
+
+
+@torch.no_grad()
+def calibrate(score_fn, loader, n_classes, device=None, calibrator=None):
+    """
+    :param score_fn: callable mapping a batch of inputs to N x n_classes scores.
+    :param loader: iterable of (x, y) batches.
+    :param n_classes: int, number of classes.
+    :param device: device batches are moved to.
+    :param calibrator: calibrator to fill, default an exact ThresholdCalibrator.
+    :return: calibrator filled with one pass over loader.
+    """
+    dataset = getattr(loader, 'dataset', None)
+    capacity = len(dataset) if dataset is not None and hasattr(dataset, '__len__') else 1024
+    for x, y in loader:
+        x, y = x.to(device), y.to(device)
+        scores = score_fn(x)
+        if calibrator is None:
+            calibrator = ThresholdCalibrator(n_classes, capacity=capacity, device=scores.device)
+        calibrator.update(scores, y)
+    return calibrator if calibrator is not None else ThresholdCalibrator(n_classes, device=device)
+
+
+def get_train_calibrator(model, hps, score_fn=None, score_name='model', data_name=None):
+    """
+    Calibrate on the train set of data_name (default hps.problem), without data augmentation,
+    from its cached scores (see `score_cache.cached_scores`).
+    With hps.sketch_size > 0, per-class KLL sketches of that size replace the exact calibration.
+    :param model: torch.nn.Module, in eval mode.
+    :param hps: hyperparameters with n_classes, n_batch_test and device.
+    :param score_fn: callable, scores of a batch, default model.
+    :param score_name: str, identifies score_fn in the score cache.
+    :param data_name: str, dataset name.
+    :return: ThresholdCalibrator or SketchCalibrator.
+    """
+    data_name = data_name or hps.problem
+    print('Calibrating thresholds on {} train set'.format(data_name))
+    cache = cached_scores(model, hps, data_name=data_name, train=True, score_fn=score_fn, score_name=score_name)
+    if getattr(hps, 'sketch_size', 0) > 0:
+        calibrator = SketchCalibrator(hps.n_classes, k=hps.sketch_size, seed=getattr(hps, 'seed', None))
+    else:
+        calibrator = ThresholdCalibrator(hps.n_classes, capacity=len(cache))
+    for scores, y in cache.batches(hps.n_batch_test):
+        calibrator.update(scores, y)
+    return calibrator
+
+
+# Percentiles of every threshold artifact, on top of the requested ones
+PERCENTILE_GRID = [0.001, 0.005, 0.01, 0.02, 0.05, 0.1]
+
+
+def calibration_config(hps, data_name, score_name):
+    """Everything besides the weights the thresholds depend on."""
+    config = {'data_name': data_name, 'data': dataset_fingerprint(data_name, getattr(hps, 'data_dir', 'data'), True),
+              'n_classes': hps.n_classes, 'score': score_name, 'uint8_inputs': getattr(hps, 'uint8_inputs', False),
+              'sketch_size': getattr(hps, 'sketch_size', 0)}
+    if config['sketch_size'] > 0:
+        config['seed'] = getattr(hps, 'seed', None)
+    return config
+
+
+def load_or_calibrate(model, hps, percentiles, score_fn=None, score_name='model', data_name=None, artifact_dir=None):
+    """
+    Thresholds from the artifact of the current weights and config when it has all the percentiles,
+    else calibrated with `get_train_calibrator` at the percentiles and PERCENTILE_GRID and saved.
+    :param model: torch.nn.Module with the evaluated weights loaded, in eval mode.
+    :param hps: hyperparameters, see `get_train_calibrator`.
+    :param percentiles: list of floats in [0, 1).
+    :param score_fn: callable, scores of a batch, default model.
+    :param score_name: str, identifies score_fn in the artifact key, e.g. 'softmax'.
+    :param data_name: str, dataset name, default hps.problem.
+    :param artifact_dir: directory of the artifacts, default hps.log_dir, next to the checkpoints.
+    :return: torch.Tensor, len(percentiles) x n_classes thresholds.
+    """
+    data_name = data_name or hps.problem
+    artifact_dir = artifact_dir or getattr(hps, 'log_dir', '.')
+    config = calibration_config(hps, data_name, score_name)
+    key = hashlib.sha256((weights_hash(model) + json.dumps(config, sort_keys=True)).encode()).hexdigest()
+    path = os.path.join(artifact_dir, 'thresholds_{}_{}.json'.format(data_name, key[:16]))
+
+    grid = set(PERCENTILE_GRID) | set(percentiles)
+    if os.path.exists(path):
+        with open(path) as f:
+            artifact = json.load(f)
+        grid |= set(artifact['percentiles'])  # keep the percentiles of earlier runs
+        if artifact['key'] == key and all(p in artifact['percentiles'] for p in percentiles):
+            print('Loaded thresholds from {}'.format(path))
+            rows = [artifact['thresholds'][artifact['percentiles'].index(p)] for p in percentiles]
+            thresholds = torch.tensor(rows, dtype=torch.float)
+            print_thresholds(percentiles, thresholds, torch.tensor(artifact['counts']))
+            return thresholds
+
+    grid = sorted(grid)
+    calibrator = get_train_calibrator(model, hps, score_fn=score_fn, score_name=score_name, data_name=data_name)
+    calibrator.report(percentiles)
+    artifact = {'key': key, 'config': config, 'percentiles': grid, 'counts': calibrator.counts().tolist(),
+                'thresholds': calibrator.thresholds(grid).tolist()}
+    if isinstance(calibrator, SketchCalibrator):
+        artifact['rank_error_bounds'] = calibrator.rank_error_bounds().tolist()
+    os.makedirs(artifact_dir, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(artifact, f)
+    os.replace(tmp_path, path)
+    print('Saved thresholds to {}'.format(path))
+    return calibrator.thresholds(percentiles).cpu()
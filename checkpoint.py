@@ -0,0 +1,188 @@
+"""Resumable training checkpoints, written in the background.
+
+A checkpoint holds everything needed to continue a run exactly where it stopped: model and
+optimizer state, epoch and position in the epoch, best loss so far, and the state of every
+random number generator. It is snapshotted to CPU memory on the training thread (cheap) and
+serialized by a background thread (slow), then atomically renamed into place.
+"""
+
+import glob
+import os
+import queue
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+CHECKPOINT_PATTERN = 'ckpt_{:09d}.pth'
+
+
+def _to_cpu(obj):
+    """Deep copy of obj with every tensor detached and copied to cpu."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {'torch': torch.get_rng_state(),
+             'numpy': np.random.get_state(),
+             'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file renamed over path, so path is never left half written."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointer(object):
+    """Serializes checkpoints in a background thread and keeps the most recent ones.
+    """
+    def __init__(self, checkpoint_dir, keep=3):
+        """
+        Args:
+            checkpoint_dir: Directory of the resumable checkpoints.
+            keep: Number of most recent resumable checkpoints kept on disk.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        # At most one write pending: a new snapshot waits for the previous write to finish
+        # instead of piling up copies of the model in memory.
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            obj, path, retain = item
+            try:
+                atomic_save(obj, path)
+                if retain:
+                    self._apply_retention()
+            except Exception as e:  # reported on the training thread
+                self.error = e
+            self.pending.task_done()
+
+    def _apply_retention(self):
+        for path in list_checkpoints(self.checkpoint_dir)[:-self.keep]:
+            os.remove(path)
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, obj, path):
+        """Write a cpu snapshot of obj to path in the background."""
+        self._check_error()
+        self.pending.put((_to_cpu(obj), path, False))
+
+    def save_checkpoint(self, state, step):
+        """Write a cpu snapshot of a resumable checkpoint for global step `step` in the background."""
+        self._check_error()
+        path = os.path.join(self.checkpoint_dir, CHECKPOINT_PATTERN.format(step))
+        self.pending.put((_to_cpu(state), path, True))
+
+    def wait(self):
+        """Block until all pending writes are on disk."""
+        self.pending.join()
+        self._check_error()
+
+    def close(self):
+        self.wait()
+        self.pending.put(None)
+        self.thread.join()
+
+
+def list_checkpoints(checkpoint_dir):
+    """
+    :param checkpoint_dir: str, directory of the resumable checkpoints.
+    :return: list of str, paths of the checkpoints, oldest first.
+    """
+    paths = glob.glob(os.path.join(checkpoint_dir, 'ckpt_*.pth'))
+    paths = [p for p in paths if re.match(r'ckpt_\d+\.pth$', os.path.basename(p))]
+    return sorted(paths)
+
+
+def load_latest_checkpoint(checkpoint_dir):
+    """
+    :param checkpoint_dir: str, directory of the resumable checkpoints.
+    :return: dict, most recent checkpoint, or None if there is none.
+    """
+    paths = list_checkpoints(checkpoint_dir)
+    if len(paths) == 0:
+        return None
+    print('==> Resuming from {}'.format(paths[-1]))
+    return torch.load(paths[-1], map_location=lambda storage, loc: storage, weights_only=False)
+
+
+class ResumableSampler(Sampler):
+    """Sampler with a deterministic order per (seed, epoch) that can start in the middle
+    of an epoch. Optionally takes only the share of one rank, like DistributedSampler.
+    """
+    def __init__(self, data_source, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.n = len(data_source)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """
+        Args:
+            epoch: Epoch number, selects the order.
+            start: Number of this rank's samples of the epoch already consumed.
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def _rank_indices(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.n, generator=g).tolist()
+        else:
+            indices = list(range(self.n))
+        if self.num_replicas > 1:
+            # Pad so that every rank gets the same number of samples.
+            total = -(-self.n // self.num_replicas) * self.num_replicas
+            indices += indices[:total - len(indices)]
+            indices = indices[self.rank:total:self.num_replicas]
+        return indices
+
+    def __iter__(self):
+        return iter(self._rank_indices()[self.start:])
+
+    def __len__(self):
+        return -(-self.n // self.num_replicas) - self.start
@@ -7,7 +7,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 from torchvision.utils import save_image
 from torch.optim import Adam
@@ -17,13 +16,17 @@ from sdim import SDIM
 
 from cleverhans_torch import fast_gradient_method, projected_gradient_descent
 from utils import get_dataset, cal_parameters
+from loaders import get_loader, add_loader_args
+from calibration import get_train_calibrator
+from rejection import RejectingClassifier, decide
+from score_cache import cached_scores
 
 
 def attack_run(model, hps, eps):
     model.eval()
     dataset = get_dataset(data_name=hps.problem, train=False)
     # hps.n_batch_test = 1
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
     test_clnloss = 0
     clncorrect = 0
@@ -115,32 +118,15 @@ def attack_run(model, hps, eps):
 def attack_run_rejection_policy(model, hps, eps):
     model.eval()
     # Get thresholds
-    threshold_list = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            ll = model(x)
-
-            correct_idx = ll.argmax(dim=1) == y
-
-            ll_, y_ = ll[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(ll_[:, label_id].detach().cpu().numpy())
-
-        thresh = sorted(in_ll_list)[50]
-        print('len: {}, threshold (min ll): {:.4f}'.format(len(in_ll_list), thresh))
-        threshold_list.append(thresh)  # class mean as threshold
+    calibrator = get_train_calibrator(model, hps)
+    classifier = RejectingClassifier(model, calibrator.order_statistics([50])).to(hps.device)
+    for label_id, (count, thresh) in enumerate(zip(calibrator.counts().tolist(), classifier.thresholds[0].tolist())):
+        print('label_id {}, len: {}, threshold (min ll): {:.4f}'.format(label_id, count, thresh))
 
     # Evaluation
     dataset = get_dataset(data_name=hps.problem, train=False)
     # hps.n_batch_test = 1
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
     clncorrect = 0
     cln_reject = 0
@@ -152,23 +138,18 @@ def attack_run_rejection_policy(model, hps, eps):
     if not os.path.exists(attack_path):
         os.mkdir(attack_path)
 
-    thresholds = torch.tensor(threshold_list).to(hps.device)
+    # clean predictions from the cached test scores, in the order of test_loader
+    clean_batches = cached_scores(model, hps, train=False).batches(hps.n_batch_test, hps.device)
 
-    for batch_id, (clndata, target) in enumerate(test_loader):
+    for batch_id, ((clndata, target), (clean_ll, _)) in enumerate(zip(test_loader, clean_batches)):
         # Note that images are scaled to [-1.0, 1.0]
         clndata, target = clndata.to(hps.device), target.to(hps.device)
         path = os.path.join(attack_path, 'original_{}.png'.format(batch_id))
         save_image(clndata, path, normalize=True)
 
-        with torch.no_grad():
-            output = model(clndata)
-
-        # print('original logits ', output.detach().cpu().numpy())
-        # test_clnloss += F.cross_entropy(
-        #     output, target, reduction='sum').item()
-        values, pred = output.max(dim=1)
-        confidence_idx = values >= thresholds[pred]
-        reject_idx = values < thresholds[pred]
+        pred, reject = decide(clean_ll, classifier.thresholds)
+        reject_idx = reject[0]
+        confidence_idx = ~reject_idx
 
         clncorrect += pred[confidence_idx].eq(target[confidence_idx]).sum().item()
         cln_reject += reject_idx.float().sum().item()
@@ -199,15 +180,9 @@ def attack_run_rejection_policy(model, hps, eps):
         path = os.path.join(attack_path, '{}perturbed_{}.png'.format(prefix, batch_id))
         save_image(advdata, path, normalize=True)
 
-        with torch.no_grad():
-            output = model(advdata)
-        # print('adv logits ', output.detach().cpu().numpy())
-
-        # test_advloss += F.cross_entropy(
-        #     output, target, reduction='sum').item()
-        values, pred = output.max(dim=1)
-        confidence_idx = values >= thresholds[pred]
-        reject_idx = values < thresholds[pred]
+        pred, reject, _ = classifier(advdata)
+        reject_idx = reject[0]
+        confidence_idx = ~reject_idx
 
         # pred = output.max(1, keepdim=True)[1]
         advcorrect += pred[confidence_idx].eq(target[confidence_idx]).sum().item()
@@ -292,6 +267,7 @@ if __name__ == "__main__":
 
     # Ablation
     parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
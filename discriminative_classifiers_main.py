@@ -1,19 +1,37 @@
 import argparse
 import sys
 import os
+from functools import partial
 
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 from torch.optim import Adam
 
 from resnet import build_resnet_32x32
 
 from utils import get_dataset, cal_parameters
+from loaders import get_loader, add_loader_args
+from shard_dataset import read_manifest
+from metrics import MetricAccumulator
+from adversarial_training import get_adversary, add_adversarial_training_args
+from eval_worker import EvalWorker, add_eval_worker_args, print_eval_results
+from rejection import RejectingClassifier
+from ood_suite import run_ood_suite, add_ood_args
+from score_cache import cached_scores
+from augmentation import get_batch_augmentation
+
+
+def build_model(hps):
+    n_encoder_layers = int(hps.encoder_name.strip('resnet'))
+    model = build_resnet_32x32(n=n_encoder_layers,
+                               fc_size=hps.n_classes,
+                               image_channel=hps.image_channel
+                               ).to(hps.device)
+    return model
 
 
 def train(model, optimizer, hps):
@@ -25,52 +43,75 @@ def train(model, optimizer, hps):
     if not os.path.exists(logdir):
         os.mkdir(logdir)
 
-    dataset = get_dataset(data_name=hps.problem, train=True)
-    train_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_train, shuffle=True)
+    # With batch_augment, crop_flip is applied to whole batches instead of per sample in the dataset.
+    augment = get_batch_augmentation(hps.problem, seed=hps.seed) if hps.batch_augment else None
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=True, crop_flip=not hps.batch_augment,
+                          uint8=hps.uint8_inputs)
+    train_loader = get_loader(dataset, batch_size=hps.n_batch_train, shuffle=True, hps=hps)
 
-    dataset = get_dataset(data_name=hps.problem, train=False)
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
+    eval_worker = EvalWorker(build_model, hps) if hps.eval_worker else None
+    adversary = get_adversary(hps)
     min_loss = 1e3
 
     for epoch in range(1, hps.epochs + 1):
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)  # streaming shards reshuffle per epoch
         model.train()
-        loss_list = []
-        acc_list = []
+        metrics = MetricAccumulator()
 
         for batch_id, (x, y) in enumerate(train_loader):
             x = x.to(hps.device)
             y = y.to(hps.device)
-
-            optimizer.zero_grad()
-            logits = model(x)
-            loss = F.nll_loss(F.log_softmax(logits, dim=1), y)
-            loss.backward()
-            optimizer.step()
-
-            loss_list.append(loss.item())
-            acc = (logits.argmax(dim=1) == y).float().mean()
-            acc_list.append(acc.item())
-
+            if augment is not None:
+                x = augment(x)
+
+            # Free adversarial training replays every batch, see adversarial_training.py.
+            n_replays = adversary.replays if adversary is not None else 1
+            for replay in range(n_replays):
+                optimizer.zero_grad()
+                x_in = adversary.perturb(model, x, y) if adversary is not None else x
+                logits = model(x_in)
+                loss = F.nll_loss(F.log_softmax(logits, dim=1), y)
+                loss.backward()
+                if adversary is not None:
+                    adversary.update(x_in)
+                optimizer.step()
+
+            metrics.update('loss', loss)
+            metrics.update('acc', (logits.argmax(dim=1) == y).sum(), y.size(0))
+
+        epoch_metrics = metrics.compute()
         print('===> Epoch: {}'.format(epoch))
-        print('loss: {:.4f}, train accuracy: {:.4f}'.format(np.mean(loss_list), np.mean(acc_list)))
-        if np.mean(loss_list) < min_loss:
-            min_loss = np.mean(loss_list)
+        print('loss: {:.4f}, train accuracy: {:.4f}'.format(epoch_metrics['loss'], epoch_metrics['acc']))
+        if epoch_metrics['loss'] < min_loss:
+            min_loss = epoch_metrics['loss']
             torch.save(model.state_dict(),
                        os.path.join(hps.log_dir, '{}_{}.pth'.format(hps.encoder_name, hps.problem)))
 
         model.eval()
         # Evaluate accuracy on test set.
-        if epoch > 10:
-            acc_list = []
+        if eval_worker is not None:
+            for results in eval_worker.poll():
+                print_eval_results(results)
+            if epoch > 10:
+                eval_worker.submit(model, epoch, epoch)
+        elif epoch > 10:
+            test_metrics = MetricAccumulator()
             for batch_id, (x, y) in enumerate(test_loader):
                 x = x.to(hps.device)
                 y = y.to(hps.device)
 
                 preds = model(x).argmax(dim=1)
-                acc = (preds == y).float().mean()
-                acc_list.append(acc.item())
-            print('Test accuracy: {:.3f}'.format(np.mean(acc_list)))
+                test_metrics.update('acc', (preds == y).sum(), y.size(0))
+            print('Test accuracy: {:.3f}'.format(test_metrics.compute()['acc']))
+
+    if eval_worker is not None:
+        eval_worker.close()
+        for results in eval_worker.poll():
+            print_eval_results(results)
 
 
 def inference(model, hps):
@@ -82,34 +123,11 @@ def inference(model, hps):
                                                                             
     model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
 
-    dataset = get_dataset(data_name=hps.problem, train=True)
-    # test_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False)
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=True)
-
-    acc_list = []
-    for batch_id, (x, y) in enumerate(test_loader):
-        x = x.to(hps.device)
-        y = y.to(hps.device)
-
-        preds = model(x).argmax(dim=1)
-        acc = (preds == y).float().mean()
-        acc_list.append(acc.item())
-
-    print('Train accuracy: {:.4f}'.format(np.mean(acc_list)))
+    cache = cached_scores(model, hps, train=True)
+    print('Train accuracy: {:.4f}'.format(np.mean(np.argmax(cache.scores, axis=1) == cache.labels)))
 
-    dataset = get_dataset(data_name=hps.problem, train=False)
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-    acc_list = []
-    for batch_id, (x, y) in enumerate(test_loader):
-        x = x.to(hps.device)
-        y = y.to(hps.device)
-
-        preds = model(x).argmax(dim=1)
-        acc = (preds == y).float().mean()
-        acc_list.append(acc.item())
-
-    print('Test accuracy: {:.4f}'.format(np.mean(acc_list)))
+    cache = cached_scores(model, hps, train=False)
+    print('Test accuracy: {:.4f}'.format(np.mean(np.argmax(cache.scores, axis=1) == cache.labels)))
 
 
 def noise_ood_inference(model, hps):
@@ -120,81 +138,14 @@ def noise_ood_inference(model, hps):
     checkpoint_path = os.path.join(hps.log_dir, '{}_{}.pth'.format(hps.encoder_name, hps.problem))
     model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
 
-    threshold_list = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    if hps.use_prob:
+        classifier = RejectingClassifier.calibrated(model, hps, [hps.percentile], transform=partial(F.softmax, dim=-1),
+                                                    score_name='softmax')
+    else:
+        classifier = RejectingClassifier.calibrated(model, hps, [hps.percentile], score_name='logits')
 
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            outs = model(x)
-            if hps.use_prob:
-                outs = F.softmax(outs, dim=-1)
-
-            correct_idx = outs.argmax(dim=1) == y
-
-            outs_, y_ = outs[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(outs_[:, label_id].detach().cpu().numpy())
-
-        thresh_idx = int(hps.percentile * len(in_ll_list))
-        thresh = sorted(in_ll_list)[thresh_idx]
-        print('threshold_idx/total_size: {}/{}, threshold: {:.3f}'.format(thresh_idx, len(in_ll_list), thresh))
-        threshold_list.append(thresh)  # class mean as threshold
-
-    shape = x.size()
-
-    batch_size = 100
-    n_batches = 100
-
-    reject_acc_dict = dict([(str(label_id), []) for label_id in range(hps.n_classes)])
-    # Noise as out-distribution samples
-    for batch_id in range(n_batches):
-        noises = torch.randn((batch_size, shape[1], shape[2], shape[3])).uniform_(0., 1.).to(hps.device) # sample noise
-        outs = model(noises)
-        if hps.use_prob:
-            outs = F.softmax(outs, dim=-1)
-
-        for label_id in range(hps.n_classes):
-            # samples whose ll lower than threshold will be successfully rejected.
-            acc = (outs[:, label_id] < threshold_list[label_id]).float().mean().item()
-            reject_acc_dict[str(label_id)].append(acc)
-
-    print('==================== Noise OOD Summary ====================')
-    print('In-distribution dataset: {}, Out-distribution dataset: Noise ~ Uniform[0, 1]'.format(hps.problem))
-    rate_list = []
-    for label_id in range(hps.n_classes):
-        acc = np.mean(reject_acc_dict[str(label_id)])
-        rate_list.append(acc)
-        print('Label id: {}, reject success rate: {:.4f}'.format(label_id, acc))
-
-    print('Mean reject success rate: {:.4f}'.format(np.mean(rate_list)))
-    print('===========================================================')
-
-    reject_acc_dict = dict([(str(label_id), []) for label_id in range(hps.n_classes)])
-    # Noise as out-distribution samples
-    for batch_id in range(n_batches):
-        noises = 0.5 + torch.randn((batch_size, shape[1], shape[2], shape[3])).clamp_(min=-0.5, max=0.5).to(hps.device)  # sample noise
-        ll = model(noises)
-
-        for label_id in range(hps.n_classes):
-            # samples whose ll lower than threshold will be successfully rejected.
-            acc = (ll[:, label_id] < threshold_list[label_id]).float().mean().item()
-            reject_acc_dict[str(label_id)].append(acc)
-
-    print('==================== Noise OOD Summary ====================')
-    print('In-distribution dataset: {}, Out-distribution dataset: Noise ~ Normal(0.5, 1) clamped to [0, 1]'.format(hps.problem))
-    rate_list = []
-    for label_id in range(hps.n_classes):
-        acc = np.mean(reject_acc_dict[str(label_id)])
-        rate_list.append(acc)
-        print('Label id: {}, reject success rate: {:.4f}'.format(label_id, acc))
-
-    print('Mean reject success rate: {:.4f}'.format(np.mean(rate_list)))
-    print('===========================================================')
+    run_ood_suite(classifier, hps, hps.ood_sources or ['uniform', 'gaussian'],
+                  score_name='softmax' if hps.use_prob else 'logits')
 
 
 if __name__ == "__main__":
@@ -216,11 +167,13 @@ if __name__ == "__main__":
 
     # Dataset hyperparams:
     parser.add_argument("--problem", type=str, default='cifar10',
-                        help="Problem (mnist/fashion/cifar10")
+                        help="Problem (mnist/fashion/cifar10/svhn/shards)")
     parser.add_argument("--n_classes", type=int,
                         default=10, help="number of classes of dataset.")
     parser.add_argument("--data_dir", type=str, default='data',
                         help="Location of data")
+    parser.add_argument("--uint8_inputs", action="store_true",
+                        help="Load images as uint8 tensors, converted to float inside the model")
 
     # Optimization hyperparams:
     parser.add_argument("--n_batch_train", type=int,
@@ -236,12 +189,16 @@ if __name__ == "__main__":
                         help="Nr of averaging epochs for Polyak and beta2")
     parser.add_argument("--weight_decay", type=float, default=1.,
                         help="Weight decay. Switched off by default.")
+    parser.add_argument("--batch_augment", action="store_true",
+                        help="Apply crop_flip augmentation on whole batches instead of per sample")
     parser.add_argument("--epochs", type=int, default=500,
                         help="Total number of training epochs")
 
     # Inference hyperparams:
     parser.add_argument("--percentile", type=float, default=0.01,
                         help="percentile value for inference with rejection.")
+    parser.add_argument("--sketch_size", type=int, default=0,
+                        help="KLL sketch size k of the threshold calibration (e.g. 2000), 0 for exact thresholds")
 
     # Model hyperparams:
     parser.add_argument("--image_size", type=int,
@@ -253,6 +210,10 @@ if __name__ == "__main__":
 
     # Ablation
     parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
+    add_eval_worker_args(parser)
+    add_ood_args(parser)
+    add_adversarial_training_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
@@ -269,12 +230,10 @@ if __name__ == "__main__":
         hps.image_channel = 1
     elif hps.problem == 'fashion':
         hps.image_channel = 1
+    elif hps.problem == 'shards':
+        hps.image_channel = 1 if read_manifest(os.path.join(hps.data_dir, 'train')).get('mode') == 'L' else 3
 
-    n_encoder_layers = int(hps.encoder_name.strip('resnet'))
-    model = build_resnet_32x32(n=n_encoder_layers,
-                               fc_size=hps.n_classes,
-                               image_channel=hps.image_channel
-                               ).to(hps.device)
+    model = build_model(hps)
 
     optimizer = Adam(model.parameters(), lr=hps.lr)
 
@@ -0,0 +1,214 @@
+"""Multi-process data-parallel training on CPU nodes with torch.distributed (gloo backend).
+
+Every process holds a full model replica and a shard of each epoch (ResumableSampler,
+or per-rank shards for streaming datasets). After backward, gradients are averaged over
+all ranks with a single flattened all-reduce, so every replica takes the same step.
+
+BatchNorm statistics are synchronized with `DistributedBatchNorm` (torch.nn.SyncBatchNorm
+only runs on GPU). For the DIM loss, negatives are local to the rank by default; with
+`--dim_negatives global` the global features of all ranks are all-gathered (with gradient)
+and every local feature is contrasted against them, as with a single batch of size
+world_size * n_batch_train.
+"""
+
+import os
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.distributed.nn.functional as dist_nn
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def add_distributed_args(parser):
+    """Add data-parallel hyperparams to an argparse parser.
+    Args:
+        parser: argparse.ArgumentParser.
+    """
+    parser.add_argument("--nproc_per_node", type=int, default=1,
+                        help="Number of training processes per node, >1 enables data-parallel training")
+    parser.add_argument("--nnodes", type=int, default=1,
+                        help="Number of nodes")
+    parser.add_argument("--node_rank", type=int, default=0,
+                        help="Rank of this node, in [0, nnodes)")
+    parser.add_argument("--master_addr", type=str, default='127.0.0.1',
+                        help="Address of the node with node_rank 0")
+    parser.add_argument("--master_port", type=int, default=29500,
+                        help="Free port on the master node")
+    parser.add_argument("--dim_negatives", type=str, default='local', choices=['local', 'global'],
+                        help="DIM negatives in data-parallel training: local (per rank) or global (all-gathered)")
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def _worker(local_rank, fn, hps):
+    hps.rank = hps.node_rank * hps.nproc_per_node + local_rank
+    hps.world_size = hps.nnodes * hps.nproc_per_node
+    dist.init_process_group('gloo', init_method='tcp://{}:{}'.format(hps.master_addr, hps.master_port),
+                            world_size=hps.world_size, rank=hps.rank)
+    # Split the cores of the node between its processes instead of oversubscribing them.
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // hps.nproc_per_node))
+    try:
+        fn(hps)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, hps):
+    """
+    Run fn(hps) in hps.nproc_per_node processes on this node, each one a rank of the process group.
+    :param fn: picklable function taking hps, run in every process.
+    :param hps: hyperparameters, see `add_distributed_args`. hps.rank and hps.world_size are set per process.
+    """
+    mp.spawn(_worker, args=(fn, hps), nprocs=hps.nproc_per_node, join=True)
+
+
+class DistributedBatchNorm(nn.modules.batchnorm._BatchNorm):
+    """BatchNorm whose training statistics are computed over the batches of all ranks.
+    Works with any backend (gloo on CPU); the reduction is differentiable. Parameters and
+    buffers have the same names as nn.BatchNorm*d, so checkpoints are interchangeable.
+    """
+    def _check_input_dim(self, input):
+        if input.dim() < 2:
+            raise ValueError('expected at least 2D input (got {}D input)'.format(input.dim()))
+
+    def forward(self, input):
+        if not (self.training and is_distributed()):
+            return super().forward(input)
+
+        self._check_input_dim(input)
+        reduce_dims = [0] + list(range(2, input.dim()))
+        count = torch.full((1,), input.numel() / input.size(1), dtype=input.dtype, device=input.device)
+        stats = torch.cat([input.sum(reduce_dims), input.pow(2).sum(reduce_dims), count])
+        stats = dist_nn.all_reduce(stats)
+        total_sum, total_sq_sum, n = torch.split(stats, [input.size(1), input.size(1), 1])
+
+        mean = total_sum / n
+        var = total_sq_sum / n - mean.pow(2)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                momentum = 1. / float(self.num_batches_tracked) if self.momentum is None else self.momentum
+                unbiased_var = var * n / (n - 1).clamp(min=1.)
+                self.running_mean.mul_(1 - momentum).add_(momentum * mean)
+                self.running_var.mul_(1 - momentum).add_(momentum * unbiased_var)
+
+        shape = [1, input.size(1)] + [1] * (input.dim() - 2)
+        out = (input - mean.view(shape)) * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            out = out * self.weight.view(shape) + self.bias.view(shape)
+        return out
+
+
+def convert_batchnorm(module):
+    """
+    Recursively replace BatchNorm1d/2d layers by DistributedBatchNorm, keeping their state.
+    :param module: torch.nn.Module.
+    :return: torch.nn.Module, the converted module.
+    """
+    converted = module
+    if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d)):
+        converted = DistributedBatchNorm(module.num_features, module.eps, module.momentum,
+                                         module.affine, module.track_running_stats)
+        converted.load_state_dict(module.state_dict())
+    for name, child in module.named_children():
+        converted.add_module(name, convert_batchnorm(child))
+    return converted
+
+
+def broadcast_model(model, src=0):
+    """Copy parameters and buffers of rank src to all ranks, so every replica starts identical."""
+    if not is_distributed():
+        return
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src=src)
+
+
+def average_gradients(model):
+    """Average the gradients of model over all ranks with a single all-reduce."""
+    if not is_distributed():
+        return
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    for grad, synced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        grad.copy_(synced)
+
+
+def all_reduce_mean(values):
+    """
+    Average a list of python floats over all ranks.
+    :param values: list of float.
+    :return: list of float.
+    """
+    if not is_distributed():
+        return values
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t)
+    return (t / get_world_size()).tolist()
+
+
+def all_reduce_min(value):
+    """
+    Minimum of a python int over all ranks.
+    :param value: int.
+    :return: int.
+    """
+    if not is_distributed():
+        return value
+    t = torch.tensor([value], dtype=torch.int64)
+    dist.all_reduce(t, op=dist.ReduceOp.MIN)
+    return int(t.item())
+
+
+def synchronized_batches(batches):
+    """
+    Yields the batches of a rank while every rank still has one, so that all ranks run the same
+    number of steps even when their loaders yield different numbers of batches (e.g. streaming
+    shards split across loader workers, each dropping its own last partial batch).
+    :param batches: iterable of batches of this rank.
+    :return: iterator of batches.
+    """
+    if not is_distributed():
+        yield from batches
+        return
+    iterator = iter(batches)
+    while True:
+        batch = next(iterator, None)
+        has_batch = torch.tensor([0 if batch is None else 1], dtype=torch.int64)
+        dist.all_reduce(has_batch, op=dist.ReduceOp.MIN)
+        if has_batch.item() == 0:
+            return
+        yield batch
+
+
+def all_gather_with_grad(tensor):
+    """
+    Concatenate tensor of all ranks along dim 0, gradients flow back to every rank.
+    Every rank must pass a tensor of the same shape.
+    :param tensor: torch.Tensor.
+    :return: (torch.Tensor, int), gathered tensor and offset of the local rows in it.
+    """
+    if not is_distributed():
+        return tensor, 0
+    gathered = dist_nn.all_gather(tensor)
+    return torch.cat(gathered, dim=0), get_rank() * tensor.size(0)
@@ -0,0 +1,207 @@
+"""Evaluation of training snapshots in a separate process, off the training critical path.
+
+The trainer submits a cpu copy of the model weights after an epoch and goes on training.
+A low-priority worker process with a bounded number of threads scores the snapshot: test
+accuracy and, optionally, rejection rates with class thresholds at `hps.percentile` of the
+correctly classified train set, and the rejection rate of an out-of-distribution test set.
+Every result is appended as a json line to `<log_dir>/eval_log.jsonl`, which the trainer
+polls (see `EvalWorker.poll`).
+
+If the worker falls behind, a pending snapshot is replaced by the newer one, so training
+never waits on evaluation.
+"""
+
+import copy
+import json
+import os
+import queue
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from utils import get_dataset
+from loaders import get_loader
+from calibration import ThresholdCalibrator
+from rejection import decide
+
+
+EVAL_LOG = 'eval_log.jsonl'
+
+
+def add_eval_worker_args(parser):
+    """Add background evaluation hyperparams to an argparse parser.
+    Args:
+        parser: argparse.ArgumentParser.
+    """
+    parser.add_argument("--eval_worker", action="store_true",
+                        help="Evaluate snapshots in a background process instead of inline after each epoch")
+    parser.add_argument("--eval_threads", type=int, default=1,
+                        help="Number of threads of the evaluation process")
+    parser.add_argument("--eval_rejection", action="store_true",
+                        help="Also report rejection rates with thresholds at --percentile")
+    parser.add_argument("--eval_ood_problem", type=str, default='',
+                        help="Out-of-distribution test set whose rejection rate is reported, empty to disable")
+
+
+def _eval_hps(hps):
+    """Copy of hps for the evaluation process: cpu, in-process loading, no background threads."""
+    eval_hps = copy.copy(hps)
+    eval_hps.device = torch.device('cpu')
+    eval_hps.num_workers = 0
+    eval_hps.background_prefetch = 0
+    eval_hps.pin_memory = False
+    return eval_hps
+
+
+@torch.no_grad()
+def _scores(model, problem, train, hps):
+    """Model outputs and labels over a whole split (no augmentation)."""
+    dataset = get_dataset(data_name=problem, data_dir=hps.data_dir, train=train, crop_flip=False,
+                          uint8=hps.uint8_inputs)
+    loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
+    outputs, targets = [], []
+    for x, y in loader:
+        outputs.append(model(x))
+        targets.append(y)
+    return torch.cat(outputs), torch.cat(targets)
+
+
+def class_thresholds(scores, targets, percentile):
+    """
+    Per class, the `percentile` quantile of the class scores of correctly classified samples.
+    :param scores: torch.Tensor, N x n_classes model outputs.
+    :param targets: torch.Tensor, N labels.
+    :param percentile: float in [0, 1).
+    :return: torch.Tensor, n_classes thresholds (-inf for a class without correct samples).
+    """
+    calibrator = ThresholdCalibrator(scores.size(1), capacity=scores.size(0), device=scores.device)
+    calibrator.update(scores, targets)
+    return calibrator.thresholds([percentile])[0]
+
+
+def rejection_rates(scores, targets, thresholds):
+    """
+    Rates of classification with rejection of the predictions scoring below their class threshold.
+    :return: dict with acc (correct and accepted), false_rate (wrong and accepted), reject_rate
+        and acc_remain (accuracy on the accepted samples), as in main.inference_rejection.
+    """
+    pred, reject = decide(scores, thresholds.view(1, -1))
+    confident = ~reject[0]
+    acc = (pred.eq(targets) & confident).double().mean().item()
+    false_rate = (pred.ne(targets) & confident).double().mean().item()
+    return {'acc': acc,
+            'false_rate': false_rate,
+            'reject_rate': 1. - confident.double().mean().item(),
+            'acc_remain': acc / max(acc + false_rate, 1e-12)}
+
+
+def evaluate_snapshot(model, hps):
+    """
+    Score a model on the test set of hps.problem.
+    :param model: torch.nn.Module in eval mode, returns class scores (e.g. SDIM log-likelihoods).
+    :param hps: hyperparameters, see `add_eval_worker_args`.
+    :return: dict, metric name -> float.
+    """
+    scores, targets = _scores(model, hps.problem, False, hps)
+    results = {'test_acc': scores.argmax(dim=1).eq(targets).double().mean().item()}
+
+    if hps.eval_rejection or hps.eval_ood_problem:
+        train_scores, train_targets = _scores(model, hps.problem, True, hps)
+        thresholds = class_thresholds(train_scores, train_targets, hps.percentile)
+
+    if hps.eval_rejection:
+        results.update(rejection_rates(scores, targets, thresholds))
+
+    if hps.eval_ood_problem:
+        ood_scores, _ = _scores(model, hps.eval_ood_problem, False, hps)
+        # mean over classes of the rate of samples below the class threshold, as in main.ood_inference.
+        results['ood_reject_rate'] = (ood_scores < thresholds).double().mean().item()
+    return results
+
+
+def _eval_loop(build_fn, hps, snapshots, log_path, n_threads):
+    torch.set_num_threads(n_threads)
+    try:
+        os.nice(10)  # training keeps priority
+    except (AttributeError, OSError):
+        pass
+    model = build_fn(hps)
+    model.eval()
+    while True:
+        item = snapshots.get()
+        if item is None:
+            return
+        epoch, step, state_dict = item
+        start = time.time()
+        model.load_state_dict(state_dict)
+        results = evaluate_snapshot(model, hps)
+        results.update({'epoch': epoch, 'step': step, 'eval_seconds': time.time() - start})
+        with open(log_path, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+
+def read_eval_log(log_dir):
+    """
+    :param log_dir: str, log dir of the run.
+    :return: list of dict, evaluation results in the order they were written.
+    """
+    log_path = os.path.join(log_dir, EVAL_LOG)
+    if not os.path.exists(log_path):
+        return []
+    results = []
+    with open(log_path) as f:
+        for line in f:
+            if line.endswith('\n'):  # skip a line still being written
+                results.append(json.loads(line))
+    return results
+
+
+def print_eval_results(results):
+    print('Eval of epoch {} (step {}): '.format(results['epoch'], results['step']) +
+          ', '.join('{}: {:.4f}'.format(k, v) for k, v in sorted(results.items()) if k not in ('epoch', 'step')))
+
+
+class EvalWorker(object):
+    """Background process scoring the snapshots submitted by the trainer.
+    """
+    def __init__(self, build_fn, hps):
+        """
+        Args:
+            build_fn: Module level function building the model from hps, called in the worker.
+            hps: hyperparameters, see `add_eval_worker_args`.
+        """
+        self.log_dir = hps.log_dir
+        self.n_read = len(read_eval_log(self.log_dir))
+        ctx = mp.get_context('spawn')
+        self.snapshots = ctx.Queue(maxsize=1)
+        self.process = ctx.Process(target=_eval_loop,
+                                   args=(build_fn, _eval_hps(hps), self.snapshots,
+                                         os.path.join(self.log_dir, EVAL_LOG), hps.eval_threads),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, model, epoch, step):
+        """Queue a snapshot of model for evaluation, replacing one still pending."""
+        state_dict = dict((k, v.detach().cpu().clone()) for k, v in model.state_dict().items())
+        try:
+            self.snapshots.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.snapshots.put_nowait((epoch, step, state_dict))
+        except queue.Full:
+            pass
+
+    def poll(self):
+        """
+        :return: list of dict, results written since the last poll.
+        """
+        results = read_eval_log(self.log_dir)
+        new, self.n_read = results[self.n_read:], len(results)
+        return new
+
+    def close(self):
+        """Wait for the pending evaluation, then stop the worker."""
+        self.snapshots.put(None)
+        self.process.join()
@@ -7,7 +7,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 from torchvision.utils import save_image
 from torch.optim import Adam
@@ -18,6 +17,7 @@ from sdim import SDIM
 import foolbox
 
 from utils import get_dataset, cal_parameters
+from loaders import get_loader, add_loader_args
 
 
 if __name__ == "__main__":
@@ -80,6 +80,7 @@ if __name__ == "__main__":
 
     # Ablation
     parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
@@ -153,7 +154,7 @@ if __name__ == "__main__":
 
     dataset = get_dataset(data_name=hps.problem, train=False, label_id=0)
     # hps.n_batch_test = 1
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
     for batch_id, (x, y) in enumerate(test_loader):
         # Note that images are scaled to [0., 1.0]
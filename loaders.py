@@ -0,0 +1,188 @@
+"""Central DataLoader factory shared by the training and evaluation entry points.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+
+def add_loader_args(parser):
+    """Add data loader hyperparams to an argparse parser.
+    Args:
+        parser: argparse.ArgumentParser.
+    """
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Number of loader worker processes, -1 to probe the best number on this machine")
+    parser.add_argument("--prefetch_factor", type=int, default=2,
+                        help="Number of batches loaded in advance by each worker")
+    parser.add_argument("--persistent_workers", action="store_true",
+                        help="Keep loader workers alive between epochs")
+    parser.add_argument("--pin_memory", action="store_true",
+                        help="Load batches into pinned memory (for faster host to GPU copies)")
+    parser.add_argument("--background_prefetch", type=int, default=0,
+                        help="Number of batches staged by a background thread, 0 to disable")
+
+
+class BackgroundPrefetcher(object):
+    """Iterates a loader in a background thread, staging the next batches in a bounded queue
+    so that loading (and the host to device copy) overlaps with model compute.
+    """
+    _end = object()
+
+    def __init__(self, loader, depth=2, device=None):
+        """
+        Args:
+            loader: Iterable over batches, usually a DataLoader.
+            depth: Maximum number of batches staged ahead.
+            device: None or torch.device, batches are moved to it in the background.
+        """
+        self.loader = loader
+        self.depth = depth
+        self.device = device
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        if self.device is None:
+            return batch
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self.device, non_blocking=True)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_device(b) for b in batch)
+        return batch
+
+    @staticmethod
+    def _put(staged, stop, item):
+        while not stop.is_set():
+            try:
+                staged.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, staged, stop):
+        try:
+            for batch in self.loader:
+                if not self._put(staged, stop, self._to_device(batch)):
+                    return
+            self._put(staged, stop, self._end)
+        except Exception as e:  # re-raised in the consumer thread
+            self._put(staged, stop, e)
+
+    def __iter__(self):
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(staged, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = staged.get()
+                if batch is self._end:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # Consumer stopped early (break / exception): let the thread exit.
+            stop.set()
+            thread.join()
+
+
+def probe_num_workers(dataset, batch_size, candidates=None, n_batches=20, record_path=None):
+    """
+    Time a few batches for several worker counts and return the fastest one.
+    :param dataset: pytorch dataset.
+    :param batch_size: int, batch size of the probed loader.
+    :param candidates: None or list of int, worker counts to try.
+    :param n_batches: int, number of batches timed for each candidate.
+    :param record_path: None or str, json file the probe results are recorded in and reused from.
+    :return: int, best number of workers.
+    """
+    n_cpus = os.cpu_count() or 1
+    key = '{}_n{}_b{}_cpu{}'.format(type(dataset).__name__, len(dataset), batch_size, n_cpus)
+
+    records = {}
+    if record_path is not None and os.path.exists(record_path):
+        with open(record_path) as f:
+            records = json.load(f)
+        if key in records:
+            return records[key]['num_workers']
+
+    if candidates is None:
+        candidates = sorted(set([0] + [n for n in (1, 2, 4, 8, 16) if n <= n_cpus]))
+
+    timings = {}
+    for num_workers in candidates:
+        loader = DataLoader(dataset=dataset, batch_size=batch_size, num_workers=num_workers,
+                            shuffle=not isinstance(dataset, IterableDataset))
+        n = 0
+        iterator = iter(loader)
+        next(iterator, None)  # exclude worker start-up from timing
+        start = time.perf_counter()
+        for _ in iterator:
+            n += 1
+            if n == n_batches:
+                break
+        timings[num_workers] = (time.perf_counter() - start) / max(n, 1)
+        del iterator
+
+    best = min(timings, key=timings.get)
+    print('==> loader probe (sec/batch): {}, using num_workers={}'.format(
+        ', '.join('{}: {:.4f}'.format(k, v) for k, v in sorted(timings.items())), best))
+
+    if record_path is not None:
+        records[key] = {'num_workers': best, 'sec_per_batch': dict((str(k), v) for k, v in timings.items())}
+        record_dir = os.path.dirname(record_path)
+        if record_dir and not os.path.exists(record_dir):
+            os.makedirs(record_dir)
+        with open(record_path, 'w') as f:
+            json.dump(records, f, indent=2)
+    return best
+
+
+def get_loader(dataset, batch_size, shuffle, hps, sampler=None, drop_last=False):
+    """
+    Build a data loader configured by the loader hyperparams in hps (see `add_loader_args`).
+    :param dataset: pytorch dataset.
+    :param batch_size: int, batch size.
+    :param shuffle: bool, whether to reshuffle the data every epoch.
+    :param hps: hyperparameters. Missing loader hyperparams fall back on DataLoader defaults.
+    :param sampler: None or torch.utils.data.Sampler, mutually exclusive with shuffle.
+    :param drop_last: bool, whether to drop the last incomplete batch.
+    :return: DataLoader, or BackgroundPrefetcher around it.
+    """
+    num_workers = getattr(hps, 'num_workers', 0)
+    if num_workers < 0:
+        record_path = os.path.join(getattr(hps, 'log_dir', './logs'), 'loader_probe.json')
+        num_workers = probe_num_workers(dataset, batch_size, record_path=record_path)
+        # probe once per run, reuse the choice for the other loaders.
+        hps.num_workers = num_workers
+
+    if isinstance(dataset, IterableDataset):
+        # Streaming datasets shuffle (and split across workers) themselves.
+        shuffle = False
+
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = getattr(hps, 'prefetch_factor', 2)
+        kwargs['persistent_workers'] = getattr(hps, 'persistent_workers', False)
+
+    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                        num_workers=num_workers, pin_memory=getattr(hps, 'pin_memory', False),
+                        drop_last=drop_last, **kwargs)
+
+    depth = getattr(hps, 'background_prefetch', 0)
+    if depth > 0:
+        return BackgroundPrefetcher(loader, depth=depth, device=getattr(hps, 'device', None))
+    return loader
@@ -9,19 +9,22 @@ import torch.nn.functional as F
 from losses.gan_losses import get_positive_expectation, get_negative_expectation
 
 
-def fenchel_dual_loss(l, m, measure=None):
+def fenchel_dual_loss(l, m, measure=None, pos_offset=0):
     '''Computes the f-divergence distance between positive and negative joint distributions.
     Note that vectors should be sent as 1x1.
     Divergences supported are Jensen-Shannon `JSD`, `GAN` (equivalent to JSD),
     Squared Hellinger `H2`, Chi-squeared `X2`, `KL`, and reverse KL `RKL`.
     Args:
         l: Local feature map.
-        m: Multiple globals feature map.
+        m: Multiple globals feature map. May hold more samples than l (e.g. globals
+            gathered from all ranks), all of them are used as negatives.
         measure: f-divergence measure.
+        pos_offset: Index in m of the global paired with the first sample of l.
     Returns:
         torch.Tensor: Loss.
     '''
     N, units, n_locals = l.size()
+    N_m = m.size(0)
     n_multis = m.size(2)
 
     # First we make the input tensors the right shape.
@@ -29,16 +32,17 @@ def fenchel_dual_loss(l, m, measure=None):
     l = l.permute(0, 2, 1)
     l = l.reshape(-1, units)
 
-    m = m.view(N, units, n_multis)
+    m = m.view(N_m, units, n_multis)
     m = m.permute(0, 2, 1)
     m = m.reshape(-1, units)
 
-    # Outer product, we want a N x N x n_local x n_multi tensor.
+    # Outer product, we want a N_m x N x n_local x n_multi tensor.
     u = torch.mm(m, l.t())
-    u = u.reshape(N, n_multis, N, n_locals).permute(0, 2, 3, 1)
+    u = u.reshape(N_m, n_multis, N, n_locals).permute(0, 2, 3, 1)
 
     # Since we have a big tensor with both positive and negative samples, we need to mask.
-    mask = torch.eye(N).to(l.device)
+    mask = torch.zeros(N_m, N, device=l.device)
+    mask[pos_offset:pos_offset + N] = torch.eye(N, device=l.device)
     n_mask = 1 - mask
 
     # Compute the positive and negative score. Average the spatial locations.
@@ -4,11 +4,40 @@ import os
 import numpy as np
 
 import torch
-from torch.utils.data import DataLoader
 from torch.optim import Adam
 
 from sdim import SDIM
 from utils import get_dataset, cal_parameters
+from loaders import get_loader, add_loader_args
+from shard_dataset import read_manifest
+from augmentation import get_batch_augmentation
+from distributed import add_distributed_args, launch, is_distributed, is_main_process, get_rank, get_world_size, \
+    convert_batchnorm, broadcast_model, average_gradients, all_reduce_mean, all_reduce_min, \
+    synchronized_batches
+from torch.utils.data import IterableDataset
+from metrics import MetricAccumulator
+from profiler import get_profiler, add_profiler_args
+from adversarial_training import get_adversary, add_adversarial_training_args
+from eval_worker import EvalWorker, add_eval_worker_args, print_eval_results
+from rejection import RejectingClassifier, decide
+from score_cache import cached_scores
+from ood_suite import run_ood_suite, default_sources, add_ood_args
+from checkpoint import AsyncCheckpointer, ResumableSampler, load_latest_checkpoint, get_rng_state, set_rng_state
+
+
+def build_model(hps):
+    model = SDIM(rep_size=hps.rep_size,
+                 n_classes=hps.n_classes,
+                 mi_units=hps.mi_units,
+                 encoder_name=hps.encoder_name,
+                 image_channel=hps.image_channel,
+                 margin=hps.margin,
+                 alpha=hps.alpha,
+                 beta=hps.beta,
+                 gamma=hps.gamma,
+                 dim_negatives=hps.dim_negatives
+                 ).to(hps.device)
+    return model
 
 
 def train(model, optimizer, hps):
@@ -17,67 +46,219 @@ def train(model, optimizer, hps):
 
     # Create log dir
     logdir = os.path.abspath(hps.log_dir) + "/"
-    if not os.path.exists(logdir):
+    if is_main_process() and not os.path.exists(logdir):
         os.mkdir(logdir)
 
-    dataset = get_dataset(data_name=hps.problem, train=True)
-    train_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_train, shuffle=True)
-    
-    dataset = get_dataset(data_name=hps.problem, train=False)
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    # With batch_augment, crop_flip is applied to whole batches instead of per sample in the dataset.
+    augment = get_batch_augmentation(hps.problem, seed=hps.seed + get_rank()) if hps.batch_augment else None
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=True, crop_flip=not hps.batch_augment,
+                          uint8=hps.uint8_inputs)
+    # The sampler order only depends on (seed, epoch), so a run can resume in the middle of an epoch.
+    # In data-parallel training every rank takes its share of the train set (streaming shards are
+    # split by the dataset itself).
+    sampler = None if isinstance(dataset, IterableDataset) else \
+        ResumableSampler(dataset, shuffle=True, seed=hps.seed, num_replicas=get_world_size(), rank=get_rank())
+    # Full batches only in data-parallel training: global DIM negatives all-gather batches of equal size.
+    train_loader = get_loader(dataset, batch_size=hps.n_batch_train, shuffle=False, hps=hps, sampler=sampler,
+                              drop_last=is_distributed())
+    # All ranks must run the same number of steps per epoch: at most the smallest loader length,
+    # and fewer if a loader yields fewer batches than its length (see synchronized_batches).
+    n_steps = all_reduce_min(len(train_loader)) if is_distributed() else None
+    # Number of micro-batches per epoch, used to size the last accumulation group (an estimate).
+    n_batches = n_steps if n_steps is not None else len(train_loader)
+
+    # Only rank 0 evaluates, on the whole test set: streaming test shards are not split across ranks.
+    test_loader = None
+    if is_main_process():
+        dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs,
+                              rank=0, world_size=1)
+        test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
+
+    checkpoint_dir = os.path.join(hps.log_dir, 'checkpoints')
+    checkpointer = AsyncCheckpointer(checkpoint_dir, keep=hps.keep_checkpoints) if is_main_process() else None
+    eval_worker = EvalWorker(build_model, hps) if hps.eval_worker and is_main_process() else None
+    profiler = get_profiler(hps)
+    adversary = get_adversary(hps)
+    # Free adversarial training takes an optimizer step per replay.
+    assert adversary is None or adversary.replays == 1 or hps.accumulation_steps == 1, \
+        'free adversarial training does not support gradient accumulation'
+
+    def resumable_state(epoch, next_batch_id, metrics):
+        return {'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'epoch': epoch,
+                'batch_id': next_batch_id,
+                'global_step': global_step,
+                'min_loss': min_loss,
+                'metrics': metrics.state_dict(),
+                'rng': get_rng_state(),
+                'augment_rng': augment.generator.get_state() if augment is not None else None}
 
     global_step = 0
     min_loss = 1e3
-    for epoch in range(1, hps.epochs+1):
+    start_epoch, start_batch_id = 1, 0
+    resume_metrics = None
+    state = load_latest_checkpoint(checkpoint_dir) if hps.resume else None
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        start_epoch, start_batch_id = state['epoch'], state['batch_id']
+        global_step, min_loss = state['global_step'], state['min_loss']
+        resume_metrics = state['metrics']
+        set_rng_state(state['rng'])
+        if augment is not None and state['augment_rng'] is not None:
+            augment.generator.set_state(state['augment_rng'])
+
+    # Gradient accumulation (--accumulation_steps K): an optimizer step averages the gradients of
+    # K micro-batches of n_batch_train samples. Only the nll term is a per-sample mean, whose
+    # accumulated gradient equals the one of a real batch of K * n_batch_train samples.
+    # The margin term is cross-sample: every sample is compared with the wrong-class
+    # log-likelihoods of every sample of its batch (SDIM.likelihood_losses), and with accumulation
+    # those pairs stay within each micro-batch. Like the DIM loss, whose negatives also stay within
+    # each micro-batch (as with local negatives in data-parallel training), it is the mean of K
+    # losses of batch size n_batch_train, not the loss of the large batch. Likewise BatchNorm
+    # normalizes with micro-batch statistics (ghost batch norm) and its running statistics are
+    # updated once per micro-batch.
+    for epoch in range(start_epoch, hps.epochs+1):
+        # Batches of this epoch consumed before the run was resumed.
+        skip = start_batch_id if epoch == start_epoch else 0
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)  # streaming shards reshuffle per epoch
+        if sampler is not None:
+            sampler.set_epoch(epoch, start=skip * hps.n_batch_train)
         model.train()
-        loss_list = []
-        mi_list = []
-        nll_list = []
-        margin_list = []
-
-        for batch_id, (x, y) in enumerate(train_loader):
-            global_step += 1
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-
-            optimizer.zero_grad()
-
-            loss, mi_loss, nll_loss, ll_margin = model.eval_losses(x, y)
-            loss.backward()
+        metrics = MetricAccumulator()
+        if skip > 0 and resume_metrics is not None:
+            metrics.load_state_dict(resume_metrics)
+
+        batches = enumerate(train_loader, start=skip)
+        if skip > 0 and sampler is None:
+            # Streaming datasets cannot seek: drop the batches consumed before resuming.
+            batches = ((batch_id + skip, batch) for batch_id, batch in enumerate(train_loader) if batch_id >= skip)
+
+        batches = synchronized_batches(batches)
+
+        profiler.reset()
+        accumulating = False  # gradients of an incomplete accumulation group pending
+        for batch_id, (x, y) in profiler.iter_phase('data', batches):
+            if batch_id == n_steps:
+                break
+            # Micro-batches batch_id - batch_id % K ... are accumulated into one optimizer step,
+            # the last group of the epoch may be smaller.
+            group_start = batch_id - batch_id % hps.accumulation_steps
+            group_size = max(1, min(hps.accumulation_steps, n_batches - group_start))
+            last_in_group = (batch_id + 1) % hps.accumulation_steps == 0 or batch_id + 1 >= n_batches
+            if not accumulating:
+                global_step += 1
+                profiler.step(global_step)
+                optimizer.zero_grad()
+            with profiler.phase('data'):
+                x = x.to(hps.device)
+                y = y.to(hps.device)
+                if augment is not None:
+                    x = augment(x)
+
+            # Free adversarial training replays every batch, see adversarial_training.py.
+            n_replays = adversary.replays if adversary is not None else 1
+            for replay in range(n_replays):
+                if replay > 0:
+                    optimizer.zero_grad()
+                x_in = x
+                if adversary is not None:
+                    with profiler.phase('attack'):
+                        x_in = adversary.perturb(model, x, y)
+
+                loss, mi_loss, nll_loss, ll_margin = model.eval_losses(x_in, y, profiler=profiler)
+                with profiler.phase('backward'):
+                    # Mean over the micro-batches of the group, see --accumulation_steps.
+                    (loss / group_size).backward()
+                if adversary is not None:
+                    adversary.update(x_in)
+                if last_in_group:
+                    with profiler.phase('grad_sync'):
+                        average_gradients(model)  # no-op unless data-parallel
+                    with profiler.phase('optimizer'):
+                        optimizer.step()
+            accumulating = not last_in_group
+
+            metrics.update('loss', loss)
+            metrics.update('mi', mi_loss)
+            metrics.update('nll', nll_loss)
+            metrics.update('ll_margin', ll_margin)
+
+            if hps.log_interval > 0 and (batch_id + 1) % hps.log_interval == 0 and is_main_process():
+                print('step {}, '.format(global_step) +
+                      ', '.join('{}: {:.4f}'.format(k, v) for k, v in metrics.compute().items()))
+
+            if hps.checkpoint_interval > 0 and global_step % hps.checkpoint_interval == 0 and last_in_group and \
+                    is_main_process():
+                checkpointer.save_checkpoint(resumable_state(epoch, batch_id + 1, metrics), global_step)
+
+        if accumulating:
+            # The loader ended inside an accumulation group (n_batches was an estimate).
+            average_gradients(model)
             optimizer.step()
 
-            loss_list.append(loss.item())
-            mi_list.append(mi_loss.item())
-            nll_list.append(nll_loss.item())
-            margin_list.append(ll_margin.item())
+        if is_main_process():
+            profiler.print_summary(epoch)
+        epoch_metrics = metrics.compute()
+        epoch_loss, epoch_mi, epoch_nll, epoch_margin = all_reduce_mean(
+            [epoch_metrics['loss'], epoch_metrics['mi'], epoch_metrics['nll'], epoch_metrics['ll_margin']])
+        if not is_main_process():
+            # Only rank 0 logs, checkpoints and evaluates.
+            continue
 
         print('===> Epoch: {}'.format(epoch + 1))
         print('loss: {:.4f}, mi: {:.4f}, nll: {:.4f}, ll_margin: {:.4f}'.format(
-            np.mean(loss_list),
-            np.mean(mi_list),
-            np.mean(nll_list),
-            np.mean(margin_list)
+            epoch_loss,
+            epoch_mi,
+            epoch_nll,
+            epoch_margin
         ))
 
-        if np.mean(loss_list) < min_loss:
-            min_loss = np.mean(loss_list)
+        if epoch_loss < min_loss:
+            min_loss = epoch_loss
             checkpoint_path = os.path.join(hps.log_dir, 'sdim_{}_{}_d{}.pth'.format(model.encoder_name,
                                                                                     hps.problem,
                                                                                     hps.rep_size))
-            torch.save(model.state_dict(), checkpoint_path)
+            checkpointer.save(model.state_dict(), checkpoint_path)
+        # Resume point: start of the next epoch.
+        checkpointer.save_checkpoint(resumable_state(epoch + 1, 0, MetricAccumulator()), global_step)
 
         model.eval()
         # Evaluate accuracy on test set.
-        if epoch > 10:
-            acc_list = []
+        if eval_worker is not None:
+            for results in eval_worker.poll():
+                print_eval_results(results)
+            if epoch > 10:
+                eval_worker.submit(model, epoch, global_step)
+        elif epoch > 10:
+            test_metrics = MetricAccumulator()
             for batch_id, (x, y) in enumerate(test_loader):
                 x = x.to(hps.device)
                 y = y.to(hps.device)
 
                 preds = model(x).argmax(dim=1)
-                acc = (preds == y).float().mean()
-                acc_list.append(acc.item())
-            print('Test accuracy: {:.3f}'.format(np.mean(acc_list)))
+                test_metrics.update('acc', (preds == y).sum(), y.size(0))
+            print('Test accuracy: {:.3f}'.format(test_metrics.compute()['acc']))
+
+    profiler.close()
+    if checkpointer is not None:
+        checkpointer.close()
+    if eval_worker is not None:
+        eval_worker.close()
+        for results in eval_worker.poll():
+            print_eval_results(results)
+
+
+def distributed_train(hps):
+    """Entry point of every process of data-parallel training, see distributed.launch."""
+    hps.device = torch.device('cpu')
+    torch.manual_seed(hps.seed)
+    model = convert_batchnorm(build_model(hps))
+    broadcast_model(model)
+    optimizer = Adam(model.parameters(), lr=hps.lr)
+    train(model, optimizer, hps)
 
 
 def inference(model, hps):
@@ -90,35 +271,14 @@ def inference(model, hps):
                                                                             hps.rep_size))
     model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
 
-    dataset = get_dataset(data_name=hps.problem, train=True)
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=True)
-
-    acc_list = []
-    for batch_id, (x, y) in enumerate(test_loader):
-        x = x.to(hps.device)
-        y = y.to(hps.device)
-
-        preds = model(x).argmax(dim=1)
-        acc = (preds == y).float().mean()
-        acc_list.append(acc.item())
-
-    print('Train accuracy: {:.4f}'.format(np.mean(acc_list)))
+    cache = cached_scores(model, hps, train=True)
+    print('Train accuracy: {:.4f}'.format(np.mean(np.argmax(cache.scores, axis=1) == cache.labels)))
 
+    cache = cached_scores(model, hps, train=False)
+    correct = np.argmax(cache.scores, axis=1) == cache.labels
     global_acc_list = []
     for label_id in range(hps.n_classes):
-        dataset = get_dataset(data_name=hps.problem, train=False, label_id=label_id)
-        test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        acc_list = []
-        for batch_id, (x, y) in enumerate(test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-
-            preds = model(x).argmax(dim=1)
-            acc = (preds == y).float().mean()
-            acc_list.append(acc.item())
-
-        acc = np.mean(acc_list)
+        acc = np.mean(correct[cache.labels == label_id])
         global_acc_list.append(acc)
         print('Class label {}, Test accuracy: {:.4f}'.format(label_id, acc))
     print('Test accracy: {:.4f}'.format(np.mean(global_acc_list)))
@@ -135,60 +295,30 @@ def inference_rejection(model, hps):
     model.eval()
 
     # Get thresholds
-    threshold_list = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            ll = model(x)
-
-            correct_idx = ll.argmax(dim=1) == y
-
-            ll_, y_ = ll[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(ll_[:, label_id].detach().cpu().numpy())
-
-        thresh_idx = int(hps.percentile * len(in_ll_list))
-        thresh = sorted(in_ll_list)[thresh_idx]
-        print('threshold_idx/total_size: {}/{}, threshold: {:.3f}'.format(thresh_idx, len(in_ll_list), thresh))
-        threshold_list.append(thresh)  # class mean as threshold
+    classifier = RejectingClassifier.calibrated(model, hps, [hps.percentile])
 
     # Evaluation
-    dataset = get_dataset(data_name=hps.problem, train=False)
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    cache = cached_scores(model, hps, train=False)
 
-    n_correct = 0
-    n_false = 0
-    n_reject = 0
+    metrics = MetricAccumulator()
 
-    thresholds = torch.tensor(threshold_list).to(hps.device)
-    result_str = ' & '.join('{:.1f}'.format(ll) for ll in threshold_list)
+    result_str = ' & '.join('{:.1f}'.format(ll) for ll in classifier.thresholds[0].tolist())
     print('thresholds: ', result_str)
 
-    for batch_id, (x, target) in enumerate(test_loader):
-        # Note that images are scaled to [-1.0, 1.0]
-        x, target = x.to(hps.device), target.to(hps.device)
-
-        with torch.no_grad():
-            log_lik = model(x)
+    for log_lik, target in cache.batches(hps.n_batch_test, hps.device):
+        pred, reject = decide(log_lik, classifier.thresholds)
+        reject_idx = reject[0]                # the ones rejected.
+        confidence_idx = ~reject_idx          # the predictions you have confidence in.
 
-        values, pred = log_lik.max(dim=1)
-        confidence_idx = values >= thresholds[pred]  # the predictions you have confidence in.
-        reject_idx = values < thresholds[pred]       # the ones rejected.
+        n = target.size(0)
+        metrics.update('acc', pred[confidence_idx].eq(target[confidence_idx]).sum(), n)
+        metrics.update('false_rate', (pred[confidence_idx] != target[confidence_idx]).sum(), n)
+        metrics.update('reject_rate', reject_idx.sum(), n)
 
-        n_correct += pred[confidence_idx].eq(target[confidence_idx]).sum().item()
-        n_false += (pred[confidence_idx] != target[confidence_idx]).sum().item()
-        n_reject += reject_idx.float().sum().item()
-
-    n = len(test_loader.dataset)
-    acc = n_correct / n
-    false_rate = n_false / n
-    reject_rate = n_reject / n
+    rates = metrics.compute()
+    acc = rates['acc']
+    false_rate = rates['false_rate']
+    reject_rate = rates['reject_rate']
 
     acc_remain = acc / (acc + false_rate)
 
@@ -197,6 +327,47 @@ def inference_rejection(model, hps):
     return acc, reject_rate, acc_remain
 
 
+def refit_head(model, hps):
+    """Refit the Gaussian head in closed form on the train set of hps.refit_problem (default hps.problem)."""
+    torch.manual_seed(hps.seed)
+    np.random.seed(hps.seed)
+
+    checkpoint_path = os.path.join(hps.log_dir, 'sdim_{}_{}_d{}.pth'.format(model.encoder_name,
+                                                                            hps.problem,
+                                                                            hps.rep_size))
+    model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
+    model.eval()
+
+    refit_problem = hps.refit_problem or hps.problem
+    dataset = get_dataset(data_name=refit_problem, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
+
+    def test_accuracy():
+        metrics = MetricAccumulator()
+        with torch.no_grad():
+            for x, y in test_loader:
+                x, y = x.to(hps.device), y.to(hps.device)
+                metrics.update('acc', (model(x).argmax(dim=1) == y).sum(), y.size(0))
+        return metrics.compute()['acc']
+
+    print('{} test accuracy before refit: {:.4f}'.format(refit_problem, test_accuracy()))
+
+    # No data augmentation(crop_flip=False) when estimating class statistics
+    dataset = get_dataset(data_name=refit_problem, data_dir=hps.data_dir, train=True, crop_flip=False,
+                          uint8=hps.uint8_inputs)
+    train_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
+    stats = model.refit_class_conditional(train_loader, correct_only=hps.refit_correct_only, device=hps.device)
+    print('samples per class: {}'.format(' '.join(str(int(n)) for n in stats.count.tolist())))
+
+    print('{} test accuracy after refit: {:.4f}'.format(refit_problem, test_accuracy()))
+    refit_path = os.path.join(hps.log_dir, 'sdim_{}_{}_d{}_refit_{}.pth'.format(model.encoder_name,
+                                                                                hps.problem,
+                                                                                hps.rep_size,
+                                                                                refit_problem))
+    torch.save(model.state_dict(), refit_path)
+    print('==> Refit model saved to {}'.format(refit_path))
+
+
 def noise_attack(model, hps):
     model.eval()
     torch.manual_seed(hps.seed)
@@ -207,8 +378,8 @@ def noise_attack(model, hps):
                                                                             hps.rep_size))
     model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
 
-    dataset = get_dataset(data_name=hps.problem, train=False)
-    test_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=True)
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs)
+    test_loader = get_loader(dataset, batch_size=1, shuffle=True, hps=hps)
 
     epsilon = 1e-2
     for batch_id, (x, y) in enumerate(test_loader):
@@ -238,61 +409,8 @@ def ood_inference(model, hps):
                                                                             hps.rep_size))
     model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
 
-    if hps.problem == 'fashion':
-        out_problem = 'mnist'
-    elif hps.problem == 'cifar10':
-        out_problem = 'svhn'
-
-    threshold_list = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            ll = model(x)
-
-            correct_idx = ll.argmax(dim=1) == y
-
-            ll_, y_ = ll[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(ll_[:, label_id].detach().cpu().numpy())
-
-        thresh_idx = int(hps.percentile * len(in_ll_list))
-        thresh = sorted(in_ll_list)[thresh_idx]
-        print('threshold_idx/total_size: {}/{}, threshold: {:.3f}'.format(thresh_idx, len(in_ll_list), thresh))
-        threshold_list.append(thresh)  # class mean as threshold
-
-    print('Inference on {}'.format(out_problem))
-    # eval on whole test set
-    dataset = get_dataset(data_name=out_problem, train=False)
-    out_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-    reject_acc_dict = dict([(str(label_id), [])for label_id in range(hps.n_classes)])
-
-    for batch_id, (x, _) in enumerate(out_test_loader):
-        x = x.to(hps.device)
-        ll = model(x)
-        for label_id in range(hps.n_classes):
-            # samples whose ll lower than threshold will be successfully rejected.
-            acc = (ll[:, label_id] < threshold_list[label_id]).float().mean().item()
-            reject_acc_dict[str(label_id)].append(acc)
-
-    print('==================== OOD Summary ====================')
-    print('In-distribution dataset: {}, Out-distribution dataset: {}'.format(hps.problem, out_problem))
-    rate_list = []
-    for label_id in range(hps.n_classes):
-        acc = np.mean(reject_acc_dict[str(label_id)])
-        rate_list.append(acc)
-        print('Label id: {}, reject success rate: {:.4f}'.format(label_id, acc))
-
-    print('Mean reject success rate: {:.4f}'.format(np.mean(rate_list)))
-    print('=====================================================')
-    # ll_checkpoint = {'fashion': in_ll_list, 'mnist': out_ll_list}
-    # torch.save(ll_checkpoint, 'ood_sdim_{}_{}_d{}.pth'.format(model.encoder_name, hps.problem, hps.rep_size))
+    classifier = RejectingClassifier.calibrated(model, hps, [hps.percentile])
+    run_ood_suite(classifier, hps, hps.ood_sources or default_sources(hps.problem))
 
 
 def noise_ood_inference(model, hps):
@@ -305,77 +423,8 @@ def noise_ood_inference(model, hps):
                                                                             hps.rep_size))
     model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
 
-    threshold_list = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            ll = model(x)
-
-            correct_idx = ll.argmax(dim=1) == y
-
-            ll_, y_ = ll[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(ll_[:, label_id].detach().cpu().numpy())
-
-        thresh_idx = int(hps.percentile * len(in_ll_list))
-        thresh = sorted(in_ll_list)[thresh_idx]
-        print('threshold_idx/total_size: {}/{}, threshold: {:.3f}'.format(thresh_idx, len(in_ll_list), thresh))
-        threshold_list.append(thresh)  # class mean as threshold
-
-    shape = x.size()
-
-    batch_size = 100
-    n_batches = 100
-
-    reject_acc_dict = dict([(str(label_id), []) for label_id in range(hps.n_classes)])
-    # Noise as out-distribution samples
-    for batch_id in range(n_batches):
-        noises = torch.randn((batch_size, shape[1], shape[2], shape[3])).uniform_(0., 1.).to(hps.device) # sample noise
-        ll = model(noises)
-
-        for label_id in range(hps.n_classes):
-            # samples whose ll lower than threshold will be successfully rejected.
-            acc = (ll[:, label_id] < threshold_list[label_id]).float().mean().item()
-            reject_acc_dict[str(label_id)].append(acc)
-
-    print('==================== Noise OOD Summary ====================')
-    print('In-distribution dataset: {}, Out-distribution dataset: Noise ~ Uniform[0, 1]'.format(hps.problem))
-    rate_list = []
-    for label_id in range(hps.n_classes):
-        acc = np.mean(reject_acc_dict[str(label_id)])
-        rate_list.append(acc)
-        print('Label id: {}, reject success rate: {:.4f}'.format(label_id, acc))
-
-    print('Mean reject success rate: {:.4f}'.format(np.mean(rate_list)))
-    print('===========================================================')
-
-    reject_acc_dict = dict([(str(label_id), []) for label_id in range(hps.n_classes)])
-    # Noise as out-distribution samples
-    for batch_id in range(n_batches):
-        noises = 0.5 + torch.randn((batch_size, shape[1], shape[2], shape[3])).clamp_(min=-0.5, max=0.5).to(hps.device)  # sample noise
-        ll = model(noises)
-
-        for label_id in range(hps.n_classes):
-            # samples whose ll lower than threshold will be successfully rejected.
-            acc = (ll[:, label_id] < threshold_list[label_id]).float().mean().item()
-            reject_acc_dict[str(label_id)].append(acc)
-
-    print('==================== Noise OOD Summary ====================')
-    print('In-distribution dataset: {}, Out-distribution dataset: Noise ~ Normal(0.5, 1) clamped to [0, 1]'.format(hps.problem))
-    rate_list = []
-    for label_id in range(hps.n_classes):
-        acc = np.mean(reject_acc_dict[str(label_id)])
-        rate_list.append(acc)
-        print('Label id: {}, reject success rate: {:.4f}'.format(label_id, acc))
-
-    print('Mean reject success rate: {:.4f}'.format(np.mean(rate_list)))
-    print('===========================================================')
+    classifier = RejectingClassifier.calibrated(model, hps, [hps.percentile])
+    run_ood_suite(classifier, hps, hps.ood_sources or ['uniform', 'gaussian'])
 
 
 if __name__ == "__main__":
@@ -398,16 +447,24 @@ if __name__ == "__main__":
                         help="Perform FGSM attack")
     parser.add_argument("--noise_attack", action="store_true",
                         help="Perform noise attack")
+    parser.add_argument("--refit_head", action="store_true",
+                        help="Refit the Gaussian class-conditional head of a trained model in closed form")
+    parser.add_argument("--refit_problem", type=str, default='',
+                        help="Dataset the head is refit on (e.g. a shifted domain), default problem")
+    parser.add_argument("--refit_correct_only", action="store_true",
+                        help="Refit on correctly classified samples only")
     parser.add_argument("--log_dir", type=str,
                         default='./logs', help="Location to save logs")
 
     # Dataset hyperparams:
     parser.add_argument("--problem", type=str, default='cifar10',
-                        help="Problem (mnist/fashion/cifar10")
+                        help="Problem (mnist/fashion/cifar10/svhn/shards)")
     parser.add_argument("--n_classes", type=int,
                         default=10, help="number of classes of dataset.")
     parser.add_argument("--data_dir", type=str, default='data',
                         help="Location of data")
+    parser.add_argument("--uint8_inputs", action="store_true",
+                        help="Load images as uint8 tensors, converted to float inside the model")
 
     # Optimization hyperparams:
     parser.add_argument("--n_batch_train", type=int,
@@ -424,12 +481,27 @@ if __name__ == "__main__":
                         help="beta")
     parser.add_argument("--gamma", type=float, default=0.33,
                         help="gamma")
+    parser.add_argument("--batch_augment", action="store_true",
+                        help="Apply crop_flip augmentation on whole batches instead of per sample")
+    parser.add_argument("--accumulation_steps", type=int, default=1,
+                        help="Number of micro-batches of n_batch_train accumulated into one optimizer step; "
+                             "the margin and DIM terms pair samples within each micro-batch only")
     parser.add_argument("--epochs", type=int, default=100,
                         help="Total number of training epochs")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume training from the latest checkpoint in <log_dir>/checkpoints")
+    parser.add_argument("--checkpoint_interval", type=int, default=0,
+                        help="Also write a resumable checkpoint every checkpoint_interval steps, 0 for epoch end only")
+    parser.add_argument("--keep_checkpoints", type=int, default=3,
+                        help="Number of most recent resumable checkpoints kept")
+    parser.add_argument("--log_interval", type=int, default=0,
+                        help="Print running training metrics every log_interval steps, 0 for epoch end only")
 
     # Inference hyperparams:
     parser.add_argument("--percentile", type=float, default=0.01,
                         help="percentile value for inference with rejection.")
+    parser.add_argument("--sketch_size", type=int, default=0,
+                        help="KLL sketch size k of the threshold calibration (e.g. 2000), 0 for exact thresholds")
 
     # Model hyperparams:
     parser.add_argument("--image_size", type=int,
@@ -447,6 +519,12 @@ if __name__ == "__main__":
 
     # Ablation
     parser.add_argument("--seed", type=int, default=1234, help="Random seed")
+    add_loader_args(parser)
+    add_eval_worker_args(parser)
+    add_ood_args(parser)
+    add_profiler_args(parser)
+    add_adversarial_training_args(parser)
+    add_distributed_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
@@ -463,16 +541,17 @@ if __name__ == "__main__":
         hps.image_channel = 1
     elif hps.problem == 'fashion':
         hps.image_channel = 1
+    elif hps.problem == 'shards':
+        hps.image_channel = 1 if read_manifest(os.path.join(hps.data_dir, 'train')).get('mode') == 'L' else 3
 
-    model = SDIM(rep_size=hps.rep_size,
-                 mi_units=hps.mi_units,
-                 encoder_name=hps.encoder_name,
-                 image_channel=hps.image_channel,
-                 margin=hps.margin,
-                 alpha=hps.alpha,
-                 beta=hps.beta,
-                 gamma=hps.gamma
-                 ).to(hps.device)
+    if hps.nproc_per_node * hps.nnodes > 1:
+        assert not (hps.noise_attack or hps.inference or hps.ood_inference or hps.rejection_inference or
+                    hps.noise_ood_inference or hps.refit_head), 'data-parallel mode is only supported for training'
+        # Every process builds its own replica.
+        launch(distributed_train, hps)
+        sys.exit(0)
+
+    model = build_model(hps)
     optimizer = Adam(model.parameters(), lr=hps.lr)
 
     print('==>  # Model parameters: {}.'.format(cal_parameters(model)))
@@ -487,5 +566,7 @@ if __name__ == "__main__":
         inference_rejection(model, hps)
     elif hps.noise_ood_inference:
         noise_ood_inference(model, hps)
+    elif hps.refit_head:
+        refit_head(model, hps)
     else:
         train(model, optimizer, hps)
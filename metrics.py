@@ -0,0 +1,61 @@
+"""Metric accumulation without per-step host synchronization.
+"""
+
+import torch
+
+
+class MetricAccumulator(object):
+    """Keeps running sums of metrics as tensors on their device.
+    Nothing is copied to the host until `compute` is called, so a training step never
+    waits for the device just for logging.
+    """
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+
+    def update(self, name, total, n=1):
+        """
+        Args:
+            name: Metric name.
+            total: Tensor (or number), sum of the metric over n items.
+            n: Number of items total sums over, e.g. 1 for a batch mean loss or the
+                batch size for a count of correct predictions.
+        """
+        if isinstance(total, torch.Tensor):
+            total = total.detach().to(torch.float64)
+        if name in self.totals:
+            self.totals[name] = self.totals[name] + total
+            self.counts[name] += n
+        else:
+            self.totals[name] = total
+            self.counts[name] = n
+
+    def compute(self):
+        """
+        Returns:
+            dict: name -> mean of the metric as a python float, with a single host sync.
+        """
+        names = list(self.totals.keys())
+        if len(names) == 0:
+            return {}
+        devices = [t.device for t in self.totals.values() if isinstance(t, torch.Tensor)]
+        device = devices[0] if len(devices) > 0 else torch.device('cpu')
+        totals = [torch.as_tensor(self.totals[name], dtype=torch.float64).to(device) for name in names]
+        totals = torch.stack(totals).tolist()
+        return dict((name, total / max(self.counts[name], 1)) for name, total in zip(names, totals))
+
+    def state_dict(self):
+        """
+        Returns:
+            dict: running totals (as floats) and counts, e.g. to resume an epoch.
+        """
+        totals = dict((name, float(total)) for name, total in self.totals.items())
+        return {'totals': totals, 'counts': dict(self.counts)}
+
+    def load_state_dict(self, state):
+        self.totals = dict(state['totals'])
+        self.counts = dict(state['counts'])
+
+    def reset(self):
+        self.totals = {}
+        self.counts = {}
@@ -0,0 +1,145 @@
+"""Streaming out-of-distribution detection metrics with fixed-bin histograms.
+
+The detection score of a sample is its highest class score (SDIM: the log-likelihood of the
+predicted class), in-distribution samples being the positives. Scores are streamed batch by
+batch into histograms over the range of the in-distribution scores, plus an underflow and an
+overflow bin, so memory does not depend on the number of samples and any number of OOD sets
+is evaluated against the same in-distribution histogram.
+
+Samples outside the in-distribution range are ranked exactly against every in-distribution
+sample; only samples falling in the same bin are treated as ties (counted half in AUROC), so
+the error of the metrics is bounded by the mass of the shared bins and vanishes as n_bins grows.
+"""
+
+import torch
+
+
+class ScoreHistogram(object):
+    """Counts of scores in n_bins equal bins over [low, high], an underflow and an overflow bin.
+    """
+    def __init__(self, low, high, n_bins=10000):
+        self.edges = torch.linspace(low, high, n_bins + 1, dtype=torch.float64)
+        self.counts = torch.zeros(n_bins + 2, dtype=torch.float64)
+
+    def update(self, scores):
+        """
+        Args:
+            scores: torch.Tensor of scores, any shape.
+        """
+        idx = torch.bucketize(scores.detach().double().flatten().cpu(), self.edges, right=True)
+        self.counts += torch.bincount(idx, minlength=self.counts.numel()).double()
+
+    def merge(self, other):
+        """Add the counts of a histogram with the same edges, e.g. from another worker."""
+        assert torch.equal(self.edges, other.edges), 'histograms must share their bins'
+        self.counts += other.counts
+
+    @property
+    def n(self):
+        return int(self.counts.sum().item())
+
+
+def detection_metrics(in_hist, out_hist, tpr_level=0.95):
+    """
+    :param in_hist: ScoreHistogram of in-distribution (positive) scores.
+    :param out_hist: ScoreHistogram of out-of-distribution scores, same bins.
+    :param tpr_level: float, true positive rate of the reported false positive rate.
+    :return: dict with auroc, aupr_in (in-distribution as positives), aupr_out (OOD as positives,
+        lower scores first), fpr (at tpr_level) and detection_error (min over thresholds of
+        the mean of the two error rates).
+    """
+    pos, neg = in_hist.counts, out_hist.counts
+    n_pos, n_neg = pos.sum().clamp(min=1), neg.sum().clamp(min=1)
+
+    # accepted with a threshold at the lower edge of each bin, from the highest bin down
+    tp = torch.flip(torch.cumsum(torch.flip(pos, [0]), 0), [0])
+    fp = torch.flip(torch.cumsum(torch.flip(neg, [0]), 0), [0])
+    tpr, fpr = tp / n_pos, fp / n_neg
+
+    auroc = ((neg * (tp - pos + 0.5 * pos)).sum() / (n_pos * n_neg)).item()
+
+    def average_precision(true_pos, false_pos, n_true):
+        # true_pos, false_pos: accepted counts for thresholds from the strictest to the loosest
+        precision = true_pos / (true_pos + false_pos).clamp(min=1)
+        recall = true_pos / n_true
+        delta = recall - torch.cat([recall.new_zeros(1), recall[:-1]])
+        return (precision * delta).sum().item()
+
+    aupr_in = average_precision(torch.flip(tp, [0]), torch.flip(fp, [0]), n_pos)
+    aupr_out = average_precision(torch.cumsum(neg, 0), torch.cumsum(pos, 0), n_neg)
+
+    reached = (tpr >= tpr_level).nonzero()
+    fpr_at_tpr = fpr[reached[-1, 0]].item() if reached.numel() > 0 else 1.
+    errors = 0.5 * (1. - tpr) + 0.5 * fpr
+    detection_error = min(errors.min().item(), 0.5)  # 0.5: nothing accepted
+    return {'auroc': auroc, 'aupr_in': aupr_in, 'aupr_out': aupr_out, 'fpr': fpr_at_tpr,
+            'detection_error': detection_error}
+
+
+def max_score(scores):
+    """Detection score of N x n_classes class scores: the score of the predicted class."""
+    return scores.max(dim=1)[0]
+
+
+class OODEvaluator(object):
+    """In-distribution histogram and one histogram per out-of-distribution set.
+    """
+    def __init__(self, low, high, n_bins=10000, score_fn=max_score):
+        """
+        Args:
+            low, high: Range of the bins, e.g. the range of the in-distribution detection scores.
+            n_bins: Number of bins.
+            score_fn: Maps N x n_classes class scores to N detection scores.
+        """
+        self.low, self.high, self.n_bins = low, high, n_bins
+        self.score_fn = score_fn
+        self.in_hist = ScoreHistogram(low, high, n_bins)
+        self.out_hists = {}
+
+    @classmethod
+    def from_in_distribution(cls, score_batches, n_bins=10000, score_fn=max_score):
+        """
+        Evaluator whose bins span the in-distribution scores, filled with them.
+        :param score_batches: callable returning a fresh iterable of N x n_classes score batches,
+            read twice (range, then counts), e.g. from a `score_cache.ScoreCache`.
+        """
+        low, high = float('inf'), float('-inf')
+        for scores in score_batches():
+            s = score_fn(scores)
+            low, high = min(low, s.min().item()), max(high, s.max().item())
+        if not low < high:  # a single score value, or no score
+            low, high = (0., 1.) if low > high else (low - 0.5, high + 0.5)
+        evaluator = cls(low, high, n_bins, score_fn)
+        for scores in score_batches():
+            evaluator.update_in(scores)
+        return evaluator
+
+    def update_in(self, scores):
+        self.in_hist.update(self.score_fn(scores))
+
+    def update(self, name, scores):
+        """Stream a batch of N x n_classes class scores of the OOD set name."""
+        if name not in self.out_hists:
+            self.out_hists[name] = ScoreHistogram(self.low, self.high, self.n_bins)
+        self.out_hists[name].update(self.score_fn(scores))
+
+    def tap(self, name, score_batches):
+        """Yields score_batches unchanged, streaming each into the histogram of name on the way."""
+        for scores in score_batches:
+            self.update(name, scores)
+            yield scores
+
+    def compute(self, tpr_level=0.95):
+        """
+        Returns:
+            dict: OOD set name -> `detection_metrics`.
+        """
+        return dict((name, detection_metrics(self.in_hist, hist, tpr_level)) for name, hist in self.out_hists.items())
+
+    def print_summary(self, tpr_level=0.95):
+        print('{:>16} {:>10} {:>8} {:>8} {:>8} {:>8} {:>9}'.format(
+            'OOD set', 'n', 'AUROC', 'AUPR-in', 'AUPR-out', 'FPR{:g}'.format(100 * tpr_level), 'Det. err'))
+        for name, metrics in self.compute(tpr_level).items():
+            print('{:>16} {:>10} {:>8.4f} {:>8.4f} {:>8.4f} {:>8.4f} {:>9.4f}'.format(
+                name, self.out_hists[name].n, metrics['auroc'], metrics['aupr_in'], metrics['aupr_out'],
+                metrics['fpr'], metrics['detection_error']))
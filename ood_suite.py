@@ -0,0 +1,149 @@
+"""Out-of-distribution benchmark suite: one classifier against a list of OOD sources.
+
+A source is either a dataset name (its test set) or a synthetic noise family generated on the
+fly (see NOISE_FAMILIES). The in-distribution scores (from the score cache) and the rejection
+thresholds are computed once; every source is then streamed through the model a single time,
+into its per-class reject rates and its detection-metric histogram (see ood_metrics.py), and
+a combined report is printed.
+"""
+
+import numpy as np
+import torch
+
+from loaders import get_loader
+from ood_metrics import OODEvaluator
+from rejection import class_reject_rates
+from score_cache import cached_scores
+from utils import get_dataset
+
+
+def _uniform(shape, generator):
+    return torch.rand(shape, generator=generator)
+
+
+def _clamped_gaussian(shape, generator):
+    return 0.5 + torch.randn(shape, generator=generator).clamp_(min=-0.5, max=0.5)
+
+
+def _bernoulli(shape, generator):
+    return (torch.rand(shape, generator=generator) < 0.5).float()
+
+
+def _constant(shape, generator):
+    return torch.rand((shape[0], shape[1], 1, 1), generator=generator).expand(shape).contiguous()
+
+
+def _smooth_uniform(shape, generator):
+    # uniform noise at 1/4 resolution, upsampled: low-frequency blobs
+    low = torch.rand((shape[0], shape[1], max(shape[2] // 4, 1), max(shape[3] // 4, 1)), generator=generator)
+    return torch.nn.functional.interpolate(low, size=shape[2:], mode='bilinear', align_corners=False)
+
+
+# name -> (description, sampler(shape, generator) of images in [0, 1])
+NOISE_FAMILIES = {
+    'uniform': ('Noise ~ Uniform[0, 1]', _uniform),
+    'gaussian': ('Noise ~ Normal(0.5, 1) clamped to [0, 1]', _clamped_gaussian),
+    'bernoulli': ('Noise ~ Bernoulli(0.5) pixels', _bernoulli),
+    'constant': ('Constant images, colour ~ Uniform[0, 1]', _constant),
+    'smooth_uniform': ('Noise ~ Uniform[0, 1] at 1/4 resolution, upsampled', _smooth_uniform),
+}
+
+
+def add_ood_args(parser):
+    """Add OOD suite hyperparams to an argparse parser.
+    Args:
+        parser: argparse.ArgumentParser.
+    """
+    parser.add_argument("--ood_sources", type=str, nargs='*', default=[],
+                        help="OOD sources: dataset names and noise families ({}); default mnist for fashion, "
+                             "svhn for cifar10, and uniform and gaussian for noise OOD inference".format(
+                                 ', '.join(NOISE_FAMILIES)))
+    parser.add_argument("--ood_bins", type=int, default=10000,
+                        help="Number of histogram bins of the streaming OOD detection metrics")
+    parser.add_argument("--n_noise_samples", type=int, default=10000,
+                        help="Number of samples of every noise family")
+
+
+def default_sources(problem):
+    if problem == 'fashion':
+        return ['mnist']
+    if problem == 'cifar10':
+        return ['svhn']
+    raise ValueError('no default out-distribution dataset for {}, set --ood_sources'.format(problem))
+
+
+def describe(source):
+    return NOISE_FAMILIES[source][0] if source in NOISE_FAMILIES else source
+
+
+def input_shape(hps):
+    """Shape (1, C, H, W) of the in-distribution inputs."""
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs)
+    x, _ = next(iter(get_loader(dataset, batch_size=1, shuffle=False, hps=hps)))
+    return x.size()
+
+
+def source_batches(source, hps, shape, batch_size=100):
+    """
+    :param source: str, dataset name or key of NOISE_FAMILIES.
+    :param shape: input shape (1, C, H, W), of the noise images.
+    :return: iterable of input batches (on the cpu).
+    """
+    if source in NOISE_FAMILIES:
+        sampler = NOISE_FAMILIES[source][1]
+        generator = torch.Generator().manual_seed(hps.seed)
+        sizes = [batch_size] * (hps.n_noise_samples // batch_size)
+        if hps.n_noise_samples % batch_size > 0:
+            sizes.append(hps.n_noise_samples % batch_size)
+        return (sampler((n,) + tuple(shape[1:]), generator) for n in sizes)
+    dataset = get_dataset(data_name=source, data_dir=hps.data_dir, train=False, uint8=hps.uint8_inputs)
+    loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
+    return (x for x, _ in loader)
+
+
+def run_ood_suite(classifier, hps, sources, score_name='model'):
+    """
+    :param classifier: rejection.RejectingClassifier, calibrated on hps.problem.
+    :param hps: hyperparameters, see `add_ood_args`.
+    :param sources: list of OOD sources.
+    :param score_name: str, identifies the scores of classifier in the score cache.
+    :return: dict, source -> dict of mean_reject_rate, class_reject_rates and `ood_metrics.detection_metrics`.
+    """
+    sources = list(dict.fromkeys(sources))  # each source once
+    in_cache = cached_scores(classifier.model, hps, train=False, score_fn=classifier.scores, score_name=score_name)
+    evaluator = OODEvaluator.from_in_distribution(lambda: (s for s, _ in in_cache.batches(hps.n_batch_test)),
+                                                  n_bins=hps.ood_bins)
+    shape = input_shape(hps) if any(source in NOISE_FAMILIES for source in sources) else None
+
+    reject_rates = {}
+    for source in sources:
+        print('Inference on {}'.format(describe(source)))
+        score_batches = (classifier(x.to(hps.device))[2] for x in source_batches(source, hps, shape))
+        reject_rates[source] = class_reject_rates(classifier, evaluator.tap(source, score_batches))
+
+    results = {}
+    for source, metrics in evaluator.compute().items():
+        results[source] = dict(metrics, class_reject_rates=reject_rates[source],
+                               mean_reject_rate=float(np.mean(reject_rates[source])))
+    print_report(results, evaluator, hps)
+    return results
+
+
+def print_report(results, evaluator, hps):
+    for source, result in results.items():
+        print('==================== OOD Summary ====================')
+        print('In-distribution dataset: {}, Out-distribution dataset: {}'.format(hps.problem, describe(source)))
+        for label_id, rate in enumerate(result['class_reject_rates']):
+            print('Label id: {}, reject success rate: {:.4f}'.format(label_id, rate))
+        print('Mean reject success rate: {:.4f}'.format(result['mean_reject_rate']))
+
+    print('==================== OOD Suite ====================')
+    print('In-distribution dataset: {} ({} test samples), thresholds at percentile {}'.format(
+        hps.problem, evaluator.in_hist.n, hps.percentile))
+    print('{:>16} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9}'.format(
+        'OOD source', 'n', 'reject', 'AUROC', 'AUPR-in', 'AUPR-out', 'FPR95', 'Det. err'))
+    for source, result in results.items():
+        print('{:>16} {:>8} {:>8.4f} {:>8.4f} {:>8.4f} {:>8.4f} {:>8.4f} {:>9.4f}'.format(
+            source, evaluator.out_hists[source].n, result['mean_reject_rate'], result['auroc'], result['aupr_in'],
+            result['aupr_out'], result['fpr'], result['detection_error']))
+    print('===================================================')
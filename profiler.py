@@ -0,0 +1,175 @@
+"""Opt-in per-phase profiling of training steps.
+
+Wall time and memory (peak allocated memory on GPU; on CPU, the growth of the resident memory
+of the process across the phase, sampled from /proc at its boundaries) are recorded for named
+phases of a step, e.g. data wait, encoder forward, DIM loss, Gaussian
+head, backward and optimizer step, and summarized per epoch. A step window can additionally
+be traced with torch.profiler, the phases showing up as named ranges in the chrome trace.
+
+Disabled profilers cost one function call per phase. On GPU, timing a phase synchronizes
+the device at its boundaries, which serializes the step: compare phases with each other,
+not the profiled step time with an unprofiled run.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+
+def add_profiler_args(parser):
+    """Add profiling hyperparams to an argparse parser.
+    Args:
+        parser: argparse.ArgumentParser.
+    """
+    parser.add_argument("--profile", action="store_true",
+                        help="Print a per-phase time and memory breakdown of training steps every epoch")
+    parser.add_argument("--profile_trace", type=str, default='',
+                        help="start:end, trace global steps [start, end) with torch.profiler into <log_dir>/profile")
+
+
+def _current_rss_mb():
+    """Current resident memory of this process in MB, None without /proc (e.g. macOS)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+class PhaseProfiler(object):
+    """Accumulates wall time and memory of named phases of training steps.
+    """
+    def __init__(self, enabled=False, device=None, trace_steps=None, trace_dir=None):
+        """
+        Args:
+            enabled: Whether phases are recorded at all.
+            device: torch.device the model runs on, cuda devices are synchronized around phases.
+            trace_steps: None or (start, end), global steps traced with torch.profiler.
+            trace_dir: Directory of the chrome traces.
+        """
+        self.enabled = enabled
+        self.cuda = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.trace_steps = trace_steps if enabled else None
+        self.trace_dir = trace_dir
+        self.torch_profiler = None
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.peaks = OrderedDict()  # peak allocated MB on GPU, max rss growth MB on CPU
+        self.n_steps = 0
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager recording the enclosed code as phase `name`."""
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        rss_start = None if self.cuda else _current_rss_mb()
+        start = time.perf_counter()
+        if self.torch_profiler is not None:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self._sync()
+        self.times[name] = self.times.get(name, 0.) + time.perf_counter() - start
+        if self.cuda:
+            peak = torch.cuda.max_memory_allocated() / 2 ** 20
+        else:
+            # ru_maxrss is the lifetime peak of the process, the same for every phase: sample the
+            # current rss instead. Memory allocated and freed within the phase is not seen.
+            rss_end = _current_rss_mb()
+            peak = rss_end - rss_start if rss_start is not None and rss_end is not None else None
+        if peak is not None:
+            self.peaks[name] = max(self.peaks.get(name, peak), peak)
+
+    def iter_phase(self, name, iterable):
+        """Iterate over iterable, recording the time spent waiting for each item as phase `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self, global_step):
+        """Mark the start of training step global_step, starting or stopping the torch.profiler window."""
+        if not self.enabled:
+            return
+        self.n_steps += 1
+        if self.trace_steps is None:
+            return
+        start, end = self.trace_steps
+        if start <= global_step < end and self.torch_profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                                         profile_memory=True)
+            self.torch_profiler.__enter__()
+        elif global_step >= end:
+            self.close()
+
+    def close(self):
+        """Stop tracing and write the trace, if a torch.profiler window is open."""
+        if self.torch_profiler is None:
+            return
+        self.torch_profiler.__exit__(None, None, None)
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        trace_path = os.path.join(self.trace_dir, 'trace_steps_{}_{}.json'.format(*self.trace_steps))
+        self.torch_profiler.export_chrome_trace(trace_path)
+        print('==> torch.profiler trace written to {}'.format(trace_path))
+        self.torch_profiler = None
+
+    def summary(self):
+        """
+        Returns:
+            OrderedDict: phase -> (total seconds, share of the profiled time, memory in MB or None), the
+            memory being the peak allocated memory on GPU and the largest rss growth over the phase on CPU.
+        """
+        total = sum(self.times.values())
+        return OrderedDict((name, (t, t / max(total, 1e-12), self.peaks.get(name))) for name, t in self.times.items())
+
+    def print_summary(self, epoch):
+        if not self.enabled or self.n_steps == 0:
+            return
+        memory = 'peak allocated MB' if self.cuda else 'max rss delta MB'
+        with_memory = len(self.peaks) > 0  # no memory column on CPU without /proc
+        print('==> Step phases of epoch {} ({} steps)'.format(epoch, self.n_steps))
+        print('{:<12} {:>10} {:>12} {:>7}'.format('phase', 'total s', 'ms/step', 'share') +
+              (' {:>18}'.format(memory) if with_memory else ''))
+        for name, (t, share, peak) in self.summary().items():
+            print('{:<12} {:>10.3f} {:>12.2f} {:>6.1f}%'.format(name, t, 1e3 * t / self.n_steps, 100 * share) +
+                  (' {:>18.1f}'.format(peak) if with_memory and peak is not None else ''))
+
+
+def get_profiler(hps):
+    """
+    :param hps: hyperparameters, see `add_profiler_args`.
+    :return: PhaseProfiler, disabled unless hps.profile.
+    """
+    trace_steps = None
+    if getattr(hps, 'profile_trace', ''):
+        start, end = hps.profile_trace.split(':')
+        trace_steps = (int(start), int(end))
+    enabled = getattr(hps, 'profile', False) or trace_steps is not None
+    return PhaseProfiler(enabled=enabled, device=getattr(hps, 'device', None),
+                         trace_steps=trace_steps, trace_dir=os.path.join(getattr(hps, 'log_dir', './logs'), 'profile'))
+
+
+NULL_PROFILER = PhaseProfiler(enabled=False)
@@ -0,0 +1,90 @@
+"""Classification with rejection.
+
+The prediction is the class of highest score (SDIM class log-likelihood, logit or probability)
+and is rejected when that score is below the threshold of the predicted class. Thresholds are
+kept as a P x n_classes buffer, one row per rejection level (e.g. percentile), so that every
+level is decided from the same forward pass.
+"""
+
+import torch
+import torch.nn as nn
+
+from calibration import load_or_calibrate
+
+
+def decide(scores, thresholds):
+    """
+    :param scores: torch.Tensor, N x n_classes.
+    :param thresholds: torch.Tensor, P x n_classes.
+    :return: (pred, reject), N predicted labels and P x N rejection mask.
+    """
+    values, pred = scores.max(dim=1)
+    return pred, values.unsqueeze(0) < thresholds[:, pred]
+
+
+class RejectingClassifier(nn.Module):
+    """Wraps a classifier (e.g. SDIM) with per-class rejection thresholds.
+    """
+    def __init__(self, model, thresholds, transform=None):
+        """
+        Args:
+            model: nn.Module returning N x n_classes scores.
+            thresholds: P x n_classes (or n_classes) thresholds.
+            transform: Optional callable applied to the model outputs, e.g. a softmax.
+        """
+        super(RejectingClassifier, self).__init__()
+        self.model = model
+        self.transform = transform
+        thresholds = torch.as_tensor(thresholds, dtype=torch.float)
+        self.register_buffer('thresholds', thresholds.reshape(-1, thresholds.size(-1)).clone())
+
+    @classmethod
+    def calibrated(cls, model, hps, percentiles, transform=None, score_name='model'):
+        """
+        Wrapper with the thresholds at percentiles, loaded or calibrated with `calibration.load_or_calibrate`.
+        """
+        score_fn = None if transform is None else (lambda x: transform(model(x)))
+        thresholds = load_or_calibrate(model, hps, percentiles, score_fn=score_fn, score_name=score_name)
+        return cls(model, thresholds, transform).to(hps.device)
+
+    def scores(self, x):
+        outs = self.model(x)
+        return outs if self.transform is None else self.transform(outs)
+
+    def forward(self, x):
+        """
+        Args:
+            x: Batch of inputs.
+        Returns:
+            (pred, reject, scores): N labels, P x N rejection mask and N x n_classes scores.
+        """
+        with torch.inference_mode():
+            scores = self.scores(x)
+            pred, reject = decide(scores, self.thresholds)
+        return pred, reject, scores
+
+    def class_rejections(self, scores):
+        """
+        Per-class rejection, e.g. of out-of-distribution samples for every class.
+        :param scores: torch.Tensor, N x n_classes.
+        :return: P x N x n_classes mask of the scores below the threshold of their class.
+        """
+        return scores.unsqueeze(0) < self.thresholds.unsqueeze(1)
+
+
+def class_reject_rates(classifier, score_batches):
+    """
+    Per class, the rate of (out-of-distribution) samples scoring below the class threshold.
+    :param classifier: RejectingClassifier.
+    :param score_batches: iterable of N x n_classes score batches, e.g. cached scores or
+        the scores returned by the classifier.
+    :return: list of n_classes rates, at the first rejection level.
+    """
+    device = classifier.thresholds.device
+    n_rejected = torch.zeros(classifier.thresholds.size(1), device=device)
+    n_samples = 0
+    for scores in score_batches:
+        # samples whose scores are lower than the threshold will be successfully rejected.
+        n_rejected += classifier.class_rejections(scores.to(device))[0].sum(dim=0)
+        n_samples += scores.size(0)
+    return (n_rejected / max(n_samples, 1)).tolist()
@@ -21,13 +21,14 @@ Reference:
 If you use this implementation in you work, please don't forget to mention the
 author, Yerlan Idelbayev.
 '''
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
 
 
 # __all__ = ['ResNet', 'resnet20', 'resnet32', 'resnet44', 'resnet56', 'resnet110', 'resnet1202']
-__all__ = ['build_resnet_32x32']
+__all__ = ['build_resnet_32x32', 'InputAdapter']
 
 
 def _weights_init(m):
@@ -46,6 +47,28 @@ class LambdaLayer(nn.Module):
         return self.lambd(x)
 
 
+class InputAdapter(nn.Module):
+    """
+    Map raw images to the float input space of the network.
+    uint8 images are scaled to [0, 1]; float images are taken to be in [0, 1] already and pass
+    through unchanged (and differentiably, as attacks need). Optionally normalize by mean and std.
+    """
+    def __init__(self, mean=None, std=None):
+        super(InputAdapter, self).__init__()
+        self.normalize = mean is not None
+        if self.normalize:
+            # Non-persistent buffers: follow .to(device) but leave checkpoints unchanged.
+            self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+            self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+
+    def forward(self, x):
+        if x.dtype == torch.uint8:
+            x = x.float().div_(255.)
+        if self.normalize:
+            x = (x - self.mean) / self.std
+        return x
+
+
 class BasicBlock(nn.Module):
     expansion = 1
 
@@ -79,8 +102,9 @@ class BasicBlock(nn.Module):
 
 
 class ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10, image_channel=1):
+    def __init__(self, block, num_blocks, num_classes=10, image_channel=1, input_mean=None, input_std=None):
         super(ResNet, self).__init__()
+        self.input_adapter = InputAdapter(input_mean, input_std)
         self.in_channel = 32
 
         multiplier = self.in_channel
@@ -112,6 +136,7 @@ class ResNet(nn.Module):
     def forward(self, x, return_full_list=False):
         out_list = []
 
+        x = self.input_adapter(x)
         out = F.relu(self.bn1(self.conv1(x)))
         out_list.append(out)
 
@@ -142,10 +167,11 @@ class ResNet(nn.Module):
             return out_list[-1]
 
 
-def build_resnet_32x32(n=26, fc_size=10, image_channel=3):
+def build_resnet_32x32(n=26, fc_size=10, image_channel=3, input_mean=None, input_std=None):
     assert (n - 2) % 8 == 0, '{} should be expressed in form of 8n+2'.format(n)
     block_depth = int((n - 2) / 8)
-    return ResNet(BasicBlock, [block_depth]*4, num_classes=fc_size, image_channel=image_channel)
+    return ResNet(BasicBlock, [block_depth]*4, num_classes=fc_size, image_channel=image_channel,
+                  input_mean=input_mean, input_std=input_std)
 
 #
 # def resnet20():
@@ -188,7 +214,6 @@ if __name__ == "__main__":
     #         #print(net_name)
     #         test(globals()[net_name]())
     #         print()
-    import torch
     x = torch.randn(5, 3, 32, 32)
     model = build_resnet_32x32(9, fc_size=10)
     o_list = model(x, return_full_list=True)
@@ -0,0 +1,123 @@
+"""Cache of the N x n_classes score matrix (and labels) of a model on a dataset split.
+
+Scores are computed once, in dataset order and without data augmentation, and stored as .npy
+files opened memory-mapped, keyed by a hash of the model weights, the dataset (name and
+location, or shard manifest), the split and the score function. Every evaluation that only needs the scores of the same checkpoint on the
+same data (accuracy, rejection, OOD rates, threshold calibration) reads them from the cache
+instead of running the model again.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+from utils import get_dataset
+from loaders import get_loader
+from shard_dataset import read_manifest
+
+
+def weights_hash(model):
+    """sha256 of the parameters and buffers of model."""
+    h = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        h.update(str(tensor.dtype).encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def dataset_fingerprint(data_name, data_dir, train):
+    """
+    Identifies the data of a dataset split beyond its name: for shards, data_dir chooses the corpus,
+    identified by the sha256 of its manifest (per-shard label counts); else the resolved data_dir.
+    """
+    if data_name == 'shards':
+        manifest = read_manifest(os.path.join(data_dir, 'train' if train else 'test'))
+        return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    return os.path.realpath(data_dir)
+
+
+class ScoreCache(object):
+    """Memory-mapped scores and labels of a dataset split.
+    """
+    def __init__(self, scores, labels):
+        """
+        Args:
+            scores: N x n_classes float32 array (np.memmap).
+            labels: N int64 array.
+        """
+        self.scores = scores
+        self.labels = labels
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def batches(self, batch_size, device=None):
+        """
+        Yields the (scores, labels) tensors of consecutive batches, in dataset order, e.g. aligned
+        with the batches of an unshuffled loader of the same batch size.
+        """
+        for start in range(0, len(self), batch_size):
+            scores = torch.from_numpy(np.array(self.scores[start:start + batch_size]))
+            labels = torch.from_numpy(np.array(self.labels[start:start + batch_size]))
+            yield scores.to(device), labels.to(device)
+
+
+def _tmp_path(path):
+    return '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+
+
+@torch.no_grad()
+def cached_scores(model, hps, data_name=None, train=False, score_fn=None, score_name='model', cache_dir=None):
+    """
+    Scores of model on a dataset split, computed on the first call and loaded on the next ones.
+    :param model: torch.nn.Module with the evaluated weights loaded, run in eval mode.
+    :param hps: hyperparameters with n_classes, n_batch_test and device (data_dir, uint8_inputs, log_dir).
+    :param data_name: str, dataset name, default hps.problem.
+    :param train: bool, train split (without data augmentation) if True, else test split.
+    :param score_fn: callable, scores of a batch, default model.
+    :param score_name: str, identifies score_fn in the cache key, e.g. 'softmax'.
+    :param cache_dir: directory of the cache, default <hps.log_dir>/score_cache.
+    :return: ScoreCache.
+    """
+    data_name = data_name or hps.problem
+    data_dir = getattr(hps, 'data_dir', 'data')
+    split = 'train' if train else 'test'
+    cache_dir = cache_dir or os.path.join(getattr(hps, 'log_dir', '.'), 'score_cache')
+    config = {'data_name': data_name, 'data': dataset_fingerprint(data_name, data_dir, train), 'split': split,
+              'score': score_name, 'n_classes': hps.n_classes, 'uint8_inputs': getattr(hps, 'uint8_inputs', False)}
+    key = hashlib.sha256((weights_hash(model) + json.dumps(config, sort_keys=True)).encode()).hexdigest()
+    prefix = os.path.join(cache_dir, '{}_{}_{}'.format(data_name, split, key[:16]))
+    scores_path, labels_path = prefix + '.scores.npy', prefix + '.labels.npy'
+
+    if not os.path.exists(scores_path):  # written last
+        print('Computing {} scores of {} {} set'.format(score_name, data_name, split))
+        dataset = get_dataset(data_name=data_name, data_dir=data_dir, train=train,
+                              crop_flip=False, uint8=getattr(hps, 'uint8_inputs', False))
+        loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
+        score_fn = score_fn or model
+        n = len(dataset)
+        os.makedirs(cache_dir, exist_ok=True)
+        # written in place batch by batch, the scores of a large split never sit in memory
+        scores = np.lib.format.open_memmap(_tmp_path(scores_path), mode='w+', dtype=np.float32,
+                                           shape=(n, hps.n_classes))
+        labels = np.lib.format.open_memmap(_tmp_path(labels_path), mode='w+', dtype=np.int64, shape=(n,))
+        was_training = model.training
+        model.eval()
+        offset = 0
+        for x, y in loader:
+            scores[offset:offset + y.size(0)] = score_fn(x.to(hps.device)).float().cpu().numpy()
+            labels[offset:offset + y.size(0)] = y.numpy()
+            offset += y.size(0)
+        model.train(was_training)
+        assert offset == n, 'the loader yielded {} samples, the dataset has {}'.format(offset, n)
+        scores.flush()
+        labels.flush()
+        del scores, labels
+        os.replace(_tmp_path(labels_path), labels_path)
+        os.replace(_tmp_path(scores_path), scores_path)
+
+    return ScoreCache(np.load(scores_path, mmap_mode='r'), np.load(labels_path, mmap_mode='r'))
@@ -8,6 +8,8 @@ import resnet
 
 from losses.dim_losses import donsker_varadhan_loss, infonce_loss, fenchel_dual_loss
 from mi_networks import MI1x1ConvNet
+from distributed import is_distributed, all_gather_with_grad
+from profiler import NULL_PROFILER
 
 
 def cal_parameters(model):
@@ -17,6 +19,41 @@ def cal_parameters(model):
     return cnt
 
 
+class ClassStatistics(object):
+    """Streaming per-class mean and variance of embeddings.
+    Batches are merged with the parallel form of Welford's algorithm (Chan et al.) in float64,
+    which stays accurate where accumulating sums of squares would cancel catastrophically.
+    """
+    def __init__(self, n_classes, embed_size, device=None):
+        self.count = torch.zeros(n_classes, dtype=torch.float64, device=device)
+        self.mean = torch.zeros(n_classes, embed_size, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(n_classes, embed_size, dtype=torch.float64, device=device)
+
+    def update(self, x, y):
+        """
+        Args:
+            x: Embeddings, N x embed_size.
+            y: Class labels, N.
+        """
+        x = x.detach().to(self.mean)
+        y = y.to(self.mean.device)
+        n_b = torch.zeros_like(self.count).index_add_(0, y, torch.ones_like(y, dtype=torch.float64))
+        sum_b = torch.zeros_like(self.mean).index_add_(0, y, x)
+        mean_b = sum_b / n_b.clamp(min=1.).unsqueeze(1)
+        m2_b = torch.zeros_like(self.m2).index_add_(0, y, (x - mean_b[y]).pow(2))
+
+        n = self.count + n_b
+        delta = mean_b - self.mean
+        weight = (n_b / n.clamp(min=1.)).unsqueeze(1)
+        self.mean += delta * weight
+        self.m2 += m2_b + delta.pow(2) * (self.count.unsqueeze(1) * weight)
+        self.count = n
+
+    def variance(self):
+        """Maximum likelihood (biased) per-class variance."""
+        return self.m2 / self.count.clamp(min=1.).unsqueeze(1)
+
+
 class ClassConditionalGaussianMixture(nn.Module):
     def __init__(self, n_classes, embed_size):
         super().__init__()
@@ -43,17 +80,50 @@ class ClassConditionalGaussianMixture(nn.Module):
         ll = self.log_lik(x, mean, log_sigma).sum(dim=-1).view(-1, self.n_classes)
         return ll
 
-
-def compute_dim_loss(l_enc, m_enc, measure, mode):
+    def add_classes(self, n_new):
+        """
+        Grow the mixture by n_new classes with ids n_classes, ..., n_classes + n_new - 1,
+        initialized to standard Gaussians. The existing classes are unchanged.
+        """
+        old = self.class_embed.weight.data
+        self.class_embed = nn.Embedding(self.n_classes + n_new, self.embed_size * 2).to(old.device)
+        with torch.no_grad():
+            self.class_embed.weight.zero_()
+            self.class_embed.weight[:self.n_classes] = old
+        self.n_classes += n_new
+
+    @torch.no_grad()
+    def refit(self, stats, min_var=1e-6):
+        """
+        Set means and log-sigmas to their maximum likelihood estimates, per class. Classes
+        without samples keep their parameters.
+        Args:
+            stats: ClassStatistics of embeddings.
+            min_var: Lower bound of the variances, for constant dimensions.
+        """
+        seen = stats.count > 0
+        mean = stats.mean.to(self.class_embed.weight)
+        log_sigma = 0.5 * torch.log(stats.variance().clamp(min=min_var)).to(self.class_embed.weight)
+        weight = self.class_embed.weight
+        weight[seen] = torch.cat([mean, log_sigma], dim=1)[seen.to(weight.device)]
+
+
+def compute_dim_loss(l_enc, m_enc, measure, mode, global_negatives=False):
     '''Computes DIM loss.
     Args:
         l_enc: Local feature map encoding.
         m_enc: Multiple globals feature map encoding.
         measure: Type of f-divergence. For use with mode `fd`
         mode: Loss mode. Fenchel-dual `fd`, NCE `nce`, or Donsker-Vadadhan `dv`.
+        global_negatives: In data-parallel training, contrast against the globals of all ranks.
     Returns:
         torch.Tensor: Loss.
     '''
+    if global_negatives and is_distributed():
+        if mode != 'fd':
+            raise ValueError('global negatives are only supported with mode fd, got {}'.format(mode))
+        m_all, offset = all_gather_with_grad(m_enc)
+        return fenchel_dual_loss(l_enc, m_all, measure=measure, pos_offset=offset)
 
     if mode == 'fd':
         loss = fenchel_dual_loss(l_enc, m_enc, measure=measure)
@@ -69,8 +139,13 @@ def compute_dim_loss(l_enc, m_enc, measure, mode):
 
 class SDIM(torch.nn.Module):
     def __init__(self, rep_size=64, n_classes=10, mi_units=128, encoder_name='resnet10', image_channel=1, margin=5,
-                 alpha=0.33, beta=0.33, gamma=0.33):
+                 alpha=0.33, beta=0.33, gamma=0.33, input_mean=None, input_std=None, dim_negatives='local',
+                 dim_mode='fd'):
         super().__init__()
+        if dim_negatives not in ('local', 'global'):
+            raise ValueError('dim_negatives must be local or global, got {}'.format(dim_negatives))
+        if dim_negatives == 'global' and dim_mode != 'fd':
+            raise ValueError('global DIM negatives are only supported with dim_mode fd, got {}'.format(dim_mode))
         self.rep_size = rep_size
         self.n_classes = n_classes
         # self.input_shape = input_shape
@@ -80,10 +155,16 @@ class SDIM(torch.nn.Module):
         self.alpha = alpha
         self.beta = beta
         self.gamma = gamma
+        # 'local' or 'global', which DIM negatives are used in data-parallel training, see distributed.py
+        self.dim_negatives = dim_negatives
+        # DIM loss mode: Fenchel-dual `fd`, NCE `nce`, or Donsker-Vadadhan `dv`, see compute_dim_loss
+        self.dim_mode = dim_mode
 
         # build encoder
         n = int(encoder_name.strip('resnet'))
-        self.encoder = resnet.build_resnet_32x32(n, fc_size=rep_size, image_channel=image_channel)  # output a representation
+        # The encoder takes uint8 images or float images in [0, 1], see resnet.InputAdapter.
+        self.encoder = resnet.build_resnet_32x32(n, fc_size=rep_size, image_channel=image_channel,
+                                                 input_mean=input_mean, input_std=input_std)  # output a representation
         print('==> # encoder parameters {}'.format(cal_parameters(self.encoder)))
 
         self.task_idx = (2, -1)
@@ -113,33 +194,80 @@ class SDIM(torch.nn.Module):
         G = G.view(N, local_units, -1)
         return L, G
 
-    def eval_losses(self, x, y, measure='JSD', mode='fd'):
-        out_list = self.encoder(x, return_full_list=True)
-        rep = out_list[-1]
-        L, G = self._T(out_list)
+    def eval_losses(self, x, y, measure='JSD', mode=None, profiler=NULL_PROFILER):
+        mode = mode or self.dim_mode
+        with profiler.phase('encoder'):
+            out_list = self.encoder(x, return_full_list=True)
+            rep = out_list[-1]
+        with profiler.phase('dim_loss'):
+            L, G = self._T(out_list)
+
+            # compute mutual infomation loss
+            mi_loss = compute_dim_loss(L, G, measure, mode, global_negatives=self.dim_negatives == 'global')
 
-        # compute mutual infomation loss
-        mi_loss = compute_dim_loss(L, G, measure, mode)
+        with profiler.phase('gaussian'):
+            # evaluate log-likelihoods as logits
+            ll = self.class_conditional(rep) / self.rep_size
 
-        # evaluate log-likelihoods as logits
-        ll = self.class_conditional(rep) / self.rep_size
+        with profiler.phase('margin'):
+            nll_loss, ll_margin = self.likelihood_losses(ll, y)
 
-        pos_mask = torch.zeros(x.size(0), self.n_classes).to(x.device).scatter(1, y.unsqueeze(dim=1), 1.)
+            # total loss
+            loss = self.alpha * mi_loss + self.beta * nll_loss + self.gamma * ll_margin
+        return loss, mi_loss, nll_loss, ll_margin
+
+    def likelihood_losses(self, ll, y):
+        """
+        Args:
+            ll: Class log-likelihoods divided by rep_size, N x n_classes.
+            y: Class labels, N.
+        Returns:
+            (torch.Tensor, torch.Tensor): nll loss and log-likelihood margin loss.
+        """
+        pos_mask = torch.zeros(ll.size(0), self.n_classes).to(ll.device).scatter(1, y.unsqueeze(dim=1), 1.)
 
         # compute nll loss
         nll_loss = -(ll * pos_mask).sum(dim=1).mean()
 
         pos_ll = torch.masked_select(ll, pos_mask.bool())
         neg_ll = torch.masked_select(ll, (1 - pos_mask).bool())
-        assert pos_ll.size(0) == x.size(0)
+        assert pos_ll.size(0) == ll.size(0)
         gap_ll = pos_ll.unsqueeze(dim=1) - neg_ll
 
         # log-likelihood margin loss
         ll_margin = F.relu(self.margin - gap_ll).mean()
-
-        # total loss
-        loss = self.alpha * mi_loss + self.beta * nll_loss + self.gamma * ll_margin
-        return loss, mi_loss, nll_loss, ll_margin
+        return nll_loss, ll_margin
+
+    def add_classes(self, n_new):
+        """Grow the Gaussian head by n_new classes, see ClassConditionalGaussianMixture.add_classes."""
+        self.class_conditional.add_classes(n_new)
+        self.n_classes = self.class_conditional.n_classes
+
+    @torch.no_grad()
+    def refit_class_conditional(self, loader, correct_only=False, device=None):
+        """
+        Re-estimate the Gaussian head in closed form with one pass over loader.
+        Args:
+            loader: Iterable of (x, y) batches.
+            correct_only: Only use the samples the current model classifies correctly, like the
+                threshold calibration of the evaluation scripts.
+            device: Device batches are moved to.
+        Returns:
+            ClassStatistics: the per-class statistics of the embeddings.
+        """
+        training = self.training
+        self.eval()
+        stats = ClassStatistics(self.n_classes, self.rep_size, device=device)
+        for x, y in loader:
+            x, y = x.to(device), y.to(device)
+            rep = self.encoder(x, return_full_list=True)[-1]
+            if correct_only:
+                keep = self.class_conditional(rep).argmax(dim=1) == y
+                rep, y = rep[keep], y[keep]
+            stats.update(rep, y)
+        self.class_conditional.refit(stats)
+        self.train(training)
+        return stats
 
     def forward(self, x, log_softmax=False):
         rep = self.encoder(x, return_full_list=True)[-1]
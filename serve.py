@@ -0,0 +1,293 @@
+"""HTTP inference server of the SDIM rejection classifier, with dynamic micro-batching.
+
+    python serve.py --problem cifar10 --log_dir ./logs --port 8000 --max_batch 64 --max_wait_ms 5
+
+POST /predict with a batch of images, N x C x H x W, either as a .npy body
+(Content-Type: application/x-npy, uint8 in [0, 255] or float in [0, 1]) or as json
+{"images": nested lists of floats in [0, 1]}. The response is the json
+{"labels": [N ints], "reject": [N bools], "log_likelihoods": [N x n_classes floats]}.
+
+Requests are queued and coalesced by a single inference thread: a micro-batch is closed when
+it holds max_batch images or max_wait_ms after its first request arrived, whichever comes first.
+GET /metrics returns request latency and queueing percentiles (KLL sketches, bounded memory)
+and the histogram of micro-batch sizes. Thresholds are loaded (or calibrated once) with
+calibration.load_or_calibrate. See benchmark_serve.py to drive the server on localhost.
+"""
+
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from calibration import KLLSketch
+from loaders import add_loader_args
+from rejection import RejectingClassifier
+
+
+class ServerStats(object):
+    """Latency sketches and micro-batch size histogram, shared by the handler and inference threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = KLLSketch(k=400)  # seconds, request received -> response ready
+        self.queueing = KLLSketch(k=400)  # seconds, request received -> its micro-batch starts
+        self.batch_sizes = {}
+        self.n_requests = 0
+        self.n_samples = 0
+        self.start = None  # first request
+
+    def record_batch(self, batch_size, queueing):
+        with self.lock:
+            self.batch_sizes[batch_size] = self.batch_sizes.get(batch_size, 0) + 1
+            self.queueing.update(queueing)
+
+    def record_request(self, n, latency):
+        with self.lock:
+            if self.start is None:
+                self.start = time.time() - latency
+            self.n_requests += 1
+            self.n_samples += n
+            self.latency.update([latency])
+
+    def summary(self, percentiles=(0.5, 0.9, 0.99)):
+        with self.lock:
+            def ms(sketch):
+                if sketch.n == 0:
+                    return {}
+                return dict(('p{:g}'.format(100 * p), 1000 * q)
+                            for p, q in zip(percentiles, sketch.quantiles(list(percentiles)).tolist()))
+            elapsed = time.time() - self.start if self.start is not None else 0.
+            return {'n_requests': self.n_requests,
+                    'n_samples': self.n_samples,
+                    'samples_per_second': self.n_samples / max(elapsed, 1e-9),
+                    'latency_ms': ms(self.latency),
+                    'queueing_ms': ms(self.queueing),
+                    'batch_sizes': dict((str(k), v) for k, v in sorted(self.batch_sizes.items()))}
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent requests into micro-batches run by one inference thread.
+    """
+    def __init__(self, classifier, input_shape, max_batch=64, max_wait=0.005, device=None, stats=None):
+        """
+        Args:
+            classifier: RejectingClassifier.
+            input_shape: (C, H, W) of the model inputs, requests of other shapes are refused by `submit`.
+            max_batch: Maximum number of images of a micro-batch (a larger request runs alone).
+            max_wait: Seconds a micro-batch waits for more requests after its first one.
+            device: Device of the classifier.
+            stats: ServerStats.
+        """
+        self.classifier = classifier
+        self.input_shape = tuple(input_shape)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.device = device
+        self.stats = stats or ServerStats()
+        self.requests = queue.Queue()
+        self.pending = None  # request taken from the queue that did not fit in the last micro-batch
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, x):
+        """
+        Args:
+            x: N x C x H x W float tensor in [0, 1].
+        Returns:
+            Future of (labels, reject, log_likelihoods) tensors.
+        Raises:
+            ValueError: if the images are not of input_shape, before they can join a micro-batch.
+        """
+        if tuple(x.shape[1:]) != self.input_shape:
+            raise ValueError('expected N x {} images, got shape {}'.format(
+                ' x '.join(str(d) for d in self.input_shape), tuple(x.shape)))
+        future = Future()
+        self.requests.put((x, future, time.perf_counter()))
+        return future
+
+    def _next_batch(self):
+        first = self.pending if self.pending is not None else self.requests.get()
+        self.pending = None
+        batch, size = [first], first[0].size(0)
+        deadline = first[2] + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if size + request[0].size(0) > self.max_batch:
+                self.pending = request
+                break
+            batch.append(request)
+            size += request[0].size(0)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            self.stats.record_batch(sum(x.size(0) for x, _, _ in batch), [start - received for _, _, received in batch])
+            try:
+                x = torch.cat([x for x, _, _ in batch]).to(self.device)
+                labels, reject, ll = self.classifier(x)
+                labels, reject, ll = labels.cpu(), reject[0].cpu(), ll.cpu()
+            except Exception as e:  # inference failed, fail the requests of the batch
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for x, future, _ in batch:
+                n = x.size(0)
+                future.set_result((labels[offset:offset + n], reject[offset:offset + n], ll[offset:offset + n]))
+                offset += n
+
+
+def parse_images(body, content_type):
+    """
+    :param body: bytes of the request.
+    :param content_type: str, application/x-npy or application/json.
+    :return: N x C x H x W float tensor in [0, 1].
+    """
+    if content_type.startswith('application/x-npy'):
+        images = np.load(io.BytesIO(body), allow_pickle=False)
+    else:
+        images = np.asarray(json.loads(body.decode())['images'], dtype=np.float32)
+    if images.ndim == 3:
+        images = images[None]
+    if images.ndim != 4 or images.shape[0] == 0:
+        raise ValueError('expected N x C x H x W images, N > 0, got shape {}'.format(images.shape))
+    if images.dtype == np.uint8:
+        return torch.from_numpy(images).float().div_(255.)
+    return torch.from_numpy(images.astype(np.float32))
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, batcher.stats.summary())
+            elif self.path == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+            received = time.perf_counter()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                x = parse_images(body, self.headers.get('Content-Type', 'application/json'))
+                future = batcher.submit(x)
+            except Exception as e:  # malformed request
+                self._reply(400, {'error': str(e)})
+                return
+            try:
+                labels, reject, ll = future.result()
+            except Exception as e:  # inference failed
+                self._reply(500, {'error': str(e)})
+                return
+            batcher.stats.record_request(x.size(0), time.perf_counter() - received)
+            self._reply(200, {'labels': labels.tolist(), 'reject': reject.tolist(), 'log_likelihoods': ll.tolist()})
+
+        def log_message(self, format, *args):
+            pass  # one line per request would dominate the cost of small requests
+
+    return Handler
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the default 5 drops bursts of connections, which clients retry after a second
+
+
+def add_model_args(parser):
+    """Add the hyperparams of the served SDIM checkpoint and its thresholds to an argparse parser.
+    Args:
+        parser: argparse.ArgumentParser.
+    """
+    parser.add_argument("--problem", type=str, default='cifar10', help="Problem (mnist/fashion/cifar10/svhn/shards)")
+    parser.add_argument("--data_dir", type=str, default='data', help="Location of data, to calibrate thresholds")
+    parser.add_argument("--log_dir", type=str, default='./logs', help="Location of the checkpoint and thresholds")
+    parser.add_argument("--uint8_inputs", action="store_true",
+                        help="Calibrate on uint8 images, converted to float inside the model")
+    parser.add_argument("--n_classes", type=int, default=10, help="number of classes of dataset.")
+    parser.add_argument("--image_channel", type=int, default=3, help="Number of image channels")
+    parser.add_argument("--image_size", type=int, default=32, help="Height and width of the model inputs")
+    parser.add_argument("--n_batch_test", type=int, default=200, help="Minibatch size of the calibration")
+    parser.add_argument("--encoder_name", type=str, default='resnet18', help="encoder name: resnet#")
+    parser.add_argument("--rep_size", type=int, default=64, help="size of the global representation from encoder")
+    parser.add_argument("--mi_units", type=int, default=256,
+                        help="output size of 1x1 conv network for mutual information estimation")
+    parser.add_argument("--margin", type=float, default=5, help="likelihood margin.")
+    parser.add_argument("--alpha", type=float, default=0.33, help="coefficient for mutual information loss")
+    parser.add_argument("--beta", type=float, default=0.33, help="coefficient for nll loss")
+    parser.add_argument("--gamma", type=float, default=0.33, help="coefficient for likelihood margin loss")
+    parser.add_argument("--dim_negatives", type=str, default='local', help="DIM negatives, see distributed.py")
+    parser.add_argument("--percentile", type=float, default=0.01, help="percentile of the rejection thresholds.")
+    parser.add_argument("--sketch_size", type=int, default=0,
+                        help="KLL sketch size k of the threshold calibration, 0 for exact thresholds")
+    parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
+
+
+def load_classifier(hps):
+    """
+    RejectingClassifier of the SDIM checkpoint in hps.log_dir, thresholds at hps.percentile.
+    :return: (classifier, checkpoint_path).
+    """
+    from main import build_model
+    model = build_model(hps)
+    checkpoint_path = os.path.join(hps.log_dir, 'sdim_{}_{}_d{}.pth'.format(hps.encoder_name, hps.problem,
+                                                                            hps.rep_size))
+    model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage))
+    model.eval()
+    return RejectingClassifier.calibrated(model, hps, [hps.percentile]), checkpoint_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="Address the server listens on")
+    parser.add_argument("--port", type=int, default=8000, help="Port the server listens on")
+    parser.add_argument("--max_batch", type=int, default=64, help="Maximum number of images of a micro-batch")
+    parser.add_argument("--max_wait_ms", type=float, default=5.,
+                        help="Milliseconds a micro-batch waits for more requests after its first one")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads(), help="Number of cpu threads")
+    add_model_args(parser)
+    hps = parser.parse_args()
+    hps.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.set_num_threads(hps.threads)
+
+    classifier, checkpoint_path = load_classifier(hps)
+
+    batcher = MicroBatcher(classifier, (hps.image_channel, hps.image_size, hps.image_size), max_batch=hps.max_batch,
+                           max_wait=hps.max_wait_ms / 1000., device=hps.device)
+    server = Server((hps.host, hps.port), make_handler(batcher))
+    print('Serving {} on http://{}:{} (max_batch {}, max_wait {}ms)'.format(
+        checkpoint_path, hps.host, hps.port, hps.max_batch, hps.max_wait_ms))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
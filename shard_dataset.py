@@ -0,0 +1,306 @@
+"""Streaming dataset over tar shards, for image corpora that do not fit in memory.
+
+A shard directory holds tar files and a `manifest.json`. Each sample of a shard is a
+pair of members `<key>.png` (encoded image) and `<key>.cls` (label as text), stored
+next to each other, so that a shard is read strictly sequentially:
+
+    data_dir/train/shard-000000.tar
+    data_dir/train/shard-000001.tar
+    data_dir/train/manifest.json   {"mode": "RGB", "shards": {"shard-000000.tar": {"0": 5012, ...}, ...}}
+
+The manifest records per-shard label counts, which gives dataset lengths without a pass.
+Per-class views (`select_label`) read only the images of their class: a class index of the byte
+range of every image in the (uncompressed) shards, built once from the tar headers, is cached
+next to the manifest as `class_index.npz`.
+"""
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import tarfile
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from PIL import Image
+
+
+MANIFEST = 'manifest.json'
+CLASS_INDEX = 'class_index.npz'
+
+
+def read_manifest(shard_dir):
+    """
+    :param shard_dir: str, directory holding the shards.
+    :return: dict, content of the shard manifest.
+    """
+    with open(os.path.join(shard_dir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def _iter_tar_samples(path):
+    """Yields (key, {extension: bytes}) for the samples of a tar shard, reading it sequentially."""
+    current_key, sample = None, {}
+    with tarfile.open(path, mode='r|*') as stream:
+        for member in stream:
+            if not member.isfile():
+                continue
+            key, ext = os.path.splitext(member.name)
+            if key != current_key and sample:
+                yield current_key, sample
+                sample = {}
+            current_key = key
+            sample[ext.lstrip('.')] = stream.extractfile(member).read()
+    if sample:
+        yield current_key, sample
+
+
+def build_class_index(shards):
+    """
+    Label, byte offset and size of the image of every sample of uncompressed tar shards. Only the
+    tar headers and the label members are read, the images are seeked over.
+    :param shards: list of paths of tar shards.
+    :return: dict of int64 arrays 'shard' (position in shards), 'label', 'offset' and 'size'.
+    """
+    columns = {'shard': [], 'label': [], 'offset': [], 'size': []}
+    for shard_id, path in enumerate(shards):
+        images, labels = {}, {}
+        with tarfile.open(path, mode='r:') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, ext = os.path.splitext(member.name)
+                if ext == '.png':
+                    images[key] = (member.offset_data, member.size)
+                elif ext == '.cls':
+                    labels[key] = int(tar.extractfile(member).read())
+        for key, (offset, size) in images.items():
+            columns['shard'].append(shard_id)
+            columns['label'].append(labels[key])
+            columns['offset'].append(offset)
+            columns['size'].append(size)
+    return dict((name, np.asarray(values, dtype=np.int64)) for name, values in columns.items())
+
+
+def get_class_index(shard_dir, shards, manifest):
+    """
+    Load `build_class_index` of the shards from its cache in shard_dir, or build and cache it. The
+    cache is rebuilt when the manifest changed.
+    :return: dict of int64 arrays, or None if the shards are compressed (no byte offsets).
+    """
+    checksum = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    cache_path = os.path.join(shard_dir, CLASS_INDEX)
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if str(cache['checksum']) == checksum:
+            return dict((name, cache[name]) for name in ('shard', 'label', 'offset', 'size'))
+    try:
+        index = build_class_index(shards)
+    except tarfile.ReadError:
+        return None
+    np.savez(cache_path, checksum=checksum, **index)
+    return index
+
+
+class ShardedImageDataset(IterableDataset):
+    """Iterable dataset streaming (image, label) pairs from tar shards.
+
+    Shards are split deterministically: first across distributed ranks, then across the
+    loader workers of each rank. Samples are shuffled within a bounded buffer, so memory
+    does not grow with the dataset size.
+    """
+    def __init__(self, shard_dir, transform=None, shuffle_buffer=0, seed=0, label_id=None,
+                 rank=None, world_size=None, class_index=None):
+        """
+        Args:
+            shard_dir: Directory holding the tar shards and their manifest.
+            transform: Transform applied to the decoded PIL image.
+            shuffle_buffer: Size of the shuffle buffer, 0 to keep the stored order.
+            seed: Seed of the shard order and buffer shuffling, combined with the epoch.
+            label_id: None or int, only yield samples with this label.
+            rank: None or int, distributed rank. Taken from torch.distributed at construction if None.
+            world_size: None or int, number of ranks. Taken from torch.distributed at construction if None.
+            class_index: None or the rows of `get_class_index` with label_id, to read only their images.
+        """
+        super().__init__()
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.label_id = label_id
+        if rank is None or world_size is None:
+            # Resolved here, in the process of the process group: loader workers are not part of it.
+            rank, world_size = self._distributed_context()
+        self.rank = rank
+        self.world_size = world_size
+        self.class_index = class_index
+        # Shared with the loader workers, which keep their own copy of the dataset with persistent workers.
+        self._epoch = multiprocessing.Value('l', 0)
+
+        self.manifest = read_manifest(shard_dir)
+        self.mode = self.manifest.get('mode', 'RGB')
+        self.shards = sorted(glob.glob(os.path.join(shard_dir, '*.tar')))
+        if len(self.shards) == 0:
+            raise RuntimeError('No tar shards found in {}'.format(shard_dir))
+
+    @property
+    def epoch(self):
+        return self._epoch.value
+
+    def set_epoch(self, epoch):
+        """Change the shard order and shuffling of the next iteration."""
+        self._epoch.value = epoch
+
+    def select_label(self, label_id):
+        """
+        Args:
+            label_id: int, label to keep.
+        Returns:
+            ShardedImageDataset: view of the same shards yielding only samples of label_id.
+        """
+        if not hasattr(self, '_full_class_index'):
+            # built or loaded once, shared by the views of every label
+            self._full_class_index = get_class_index(self.shard_dir, self.shards, self.manifest)
+        class_index = None
+        if self._full_class_index is not None:
+            rows = self._full_class_index['label'] == label_id
+            class_index = dict((name, column[rows]) for name, column in self._full_class_index.items())
+        return ShardedImageDataset(self.shard_dir, transform=self.transform, shuffle_buffer=self.shuffle_buffer,
+                                   seed=self.seed, label_id=label_id, rank=self.rank, world_size=self.world_size,
+                                   class_index=class_index)
+
+    @staticmethod
+    def _distributed_context():
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def _rank_shards(self):
+        shards = list(self.shards)
+        if self.shuffle_buffer > 0:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[self.rank::self.world_size]
+
+    def _count(self, shard):
+        counts = self.manifest['shards'][os.path.basename(shard)]
+        if self.label_id is None:
+            return sum(counts.values())
+        return counts.get(str(self.label_id), 0)
+
+    def __len__(self):
+        return sum(self._count(shard) for shard in self._rank_shards())
+
+    def _decode(self, sample):
+        image = Image.open(io.BytesIO(sample['png'])).convert(self.mode)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(sample['cls'])
+
+    def _iter_indexed_samples(self, shard):
+        """Samples of label_id of a shard, reading only their images at the offsets of the class index."""
+        rows = self.class_index['shard'] == self.shards.index(shard)
+        offsets, sizes = self.class_index['offset'][rows], self.class_index['size'][rows]
+        order = np.argsort(offsets)  # forward reads
+        with open(shard, 'rb') as f:
+            for offset, size in zip(offsets[order], sizes[order]):
+                f.seek(int(offset))
+                yield {'png': f.read(int(size)), 'cls': str(self.label_id).encode()}
+
+    def _iter_samples(self, shards):
+        if self.label_id is not None:
+            # the manifest counts skip the shards without the label
+            shards = [shard for shard in shards if self._count(shard) > 0]
+        for shard in shards:
+            if self.class_index is not None:
+                yield from self._iter_indexed_samples(shard)
+                continue
+            for key, sample in _iter_tar_samples(shard):
+                if self.label_id is not None and int(sample['cls']) != self.label_id:
+                    continue
+                yield sample
+
+    def __iter__(self):
+        shards = self._rank_shards()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        shards = shards[worker_id::num_workers]
+
+        if self.shuffle_buffer <= 0:
+            for sample in self._iter_samples(shards):
+                yield self._decode(sample)
+            return
+
+        rng = random.Random((self.seed + self.epoch) * 1000003 + worker_id)
+        buffer = []
+        for sample in self._iter_samples(shards):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            # Decoding is done lazily, only for the sample that leaves the buffer.
+            out, buffer[idx] = buffer[idx], sample
+            yield self._decode(out)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(sample)
+
+
+def write_shards(dataset, out_dir, samples_per_shard=10000, mode='RGB'):
+    """
+    Write a map-style dataset of (PIL image, label) pairs into tar shards and a manifest.
+    :param dataset: pytorch dataset without transform, yielding PIL images.
+    :param out_dir: str, output directory.
+    :param samples_per_shard: int, number of samples per tar file.
+    :param mode: str, PIL mode images are decoded to when read back.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    manifest = {'mode': mode, 'shards': {}}
+    n = len(dataset)
+    for shard_id, start in enumerate(range(0, n, samples_per_shard)):
+        name = 'shard-{:06d}.tar'.format(shard_id)
+        counts = {}
+        with tarfile.open(os.path.join(out_dir, name), mode='w') as tar:
+            for idx in range(start, min(start + samples_per_shard, n)):
+                image, label = dataset[idx]
+                label = int(label)
+                counts[str(label)] = counts.get(str(label), 0) + 1
+
+                buf = io.BytesIO()
+                image.save(buf, format='PNG')
+                for ext, payload in (('png', buf.getvalue()), ('cls', str(label).encode())):
+                    info = tarfile.TarInfo('{:09d}.{}'.format(idx, ext))
+                    info.size = len(payload)
+                    tar.addfile(info, io.BytesIO(payload))
+        manifest['shards'][name] = counts
+        print('==> wrote {} ({} samples)'.format(name, sum(counts.values())))
+
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+if __name__ == '__main__':
+    from utils import get_dataset
+
+    parser = argparse.ArgumentParser(description='Convert a dataset to tar shards')
+    parser.add_argument("--problem", type=str, default='cifar10',
+                        help="Problem (mnist/fashion/cifar10/svhn)")
+    parser.add_argument("--data_dir", type=str, default='data',
+                        help="Location of data")
+    parser.add_argument("--out_dir", type=str, required=True,
+                        help="Output directory, shards go to <out_dir>/train and <out_dir>/test")
+    parser.add_argument("--samples_per_shard", type=int, default=10000,
+                        help="Number of samples per shard")
+    hps = parser.parse_args()
+
+    for train, split in ((True, 'train'), (False, 'test')):
+        dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=train, crop_flip=False)
+        dataset.transform = None
+        mode = 'L' if hps.problem in ('mnist', 'fashion') else 'RGB'
+        write_shards(dataset, os.path.join(hps.out_dir, split), hps.samples_per_shard, mode=mode)
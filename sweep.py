@@ -0,0 +1,276 @@
+"""Asynchronous successive halving (ASHA) sweep over the SDIM loss weights and sizes.
+
+Trials sample alpha, beta, gamma, margin, rep_size and mi_units and are trained in a pool of
+worker processes. A trial first trains for min_epochs; rung k trains up to min_epochs * eta^k
+epochs (at most max_epochs), continuing from the trial checkpoint of the previous rung. A worker
+that becomes free promotes the best trial of the highest rung it can (top 1/eta of the trials
+that reached that rung) and otherwise starts a new trial, so losers stop after their first
+rung without waiting for whole rungs to finish.
+
+Trials are scored on a validation split held out of the train set by the accuracy of
+classification with rejection (correctly classified and not rejected, thresholds at
+--percentile of a calibration subset of the train split), which rewards accuracy and
+penalizes the reject rate. The train split is loaded once as uint8 tensors in shared memory
+and used by every worker.
+
+    python sweep.py --problem cifar10 --n_trials 27 --min_epochs 1 --max_epochs 27 --eta 3 --n_workers 4
+
+Every finished job is appended to <sweep_dir>/results.jsonl.
+"""
+
+import argparse
+import copy
+import json
+import math
+import os
+import random
+import time
+from collections import OrderedDict
+
+import torch
+import torch.multiprocessing as mp
+from torch.optim import Adam
+
+from augmentation import get_batch_augmentation
+from checkpoint import atomic_save
+from eval_worker import class_thresholds, rejection_rates
+from loaders import get_loader
+from utils import get_dataset
+
+
+# name -> ('log', low, high) for log-uniform floats, or ('choice', values)
+SEARCH_SPACE = OrderedDict([
+    ('alpha', ('log', 0.03, 1.)),
+    ('beta', ('log', 0.03, 1.)),
+    ('gamma', ('log', 0.03, 1.)),
+    ('margin', ('choice', [1., 2., 5., 10.])),
+    ('rep_size', ('choice', [32, 64, 128])),
+    ('mi_units', ('choice', [32, 64, 128])),
+])
+
+
+def sample_config(rng):
+    config = OrderedDict()
+    for name, space in SEARCH_SPACE.items():
+        if space[0] == 'log':
+            config[name] = math.exp(rng.uniform(math.log(space[1]), math.log(space[2])))
+        else:
+            config[name] = rng.choice(space[1])
+    return config
+
+
+class SuccessiveHalving(object):
+    """Asynchronous successive halving scheduler (Li et al. 2018, "Massively parallel hyperparameter tuning").
+    """
+    def __init__(self, n_trials, min_epochs, max_epochs, eta, seed=0):
+        self.n_trials = n_trials
+        self.eta = eta
+        self.rung_epochs = [min_epochs]
+        while self.rung_epochs[-1] * eta <= max_epochs:
+            self.rung_epochs.append(self.rung_epochs[-1] * eta)
+        self.scores = [dict() for _ in self.rung_epochs]  # rung -> trial_id -> score
+        self.promoted = [set() for _ in self.rung_epochs]
+        self.configs = OrderedDict()
+        self.rng = random.Random(seed)
+
+    def next_job(self):
+        """
+        :return: (trial_id, rung) to run next, or None if nothing can run before more results come in.
+        """
+        for rung in reversed(range(len(self.rung_epochs) - 1)):
+            scores = self.scores[rung]
+            ranked = sorted(scores, key=lambda t: scores[t], reverse=True)[:len(scores) // self.eta]
+            # failed trials (score -inf) are never promoted
+            candidates = [t for t in ranked if t not in self.promoted[rung] and scores[t] > float('-inf')]
+            if len(candidates) > 0:
+                self.promoted[rung].add(candidates[0])
+                return candidates[0], rung + 1
+        if len(self.configs) < self.n_trials:
+            trial_id = len(self.configs)
+            self.configs[trial_id] = sample_config(self.rng)
+            return trial_id, 0
+        return None
+
+    def report(self, trial_id, rung, score):
+        self.scores[rung][trial_id] = score
+
+    def leaderboard(self):
+        """
+        :return: list of (trial_id, highest rung reached, score there), best first.
+        """
+        best = {}
+        for rung, scores in enumerate(self.scores):
+            for trial_id, score in scores.items():
+                best[trial_id] = (rung, score)
+        return sorted(((t, r, s) for t, (r, s) in best.items()), key=lambda e: (e[1], e[2]), reverse=True)
+
+
+_shared = {}
+
+
+def _init_worker(data, hps):
+    torch.set_num_threads(hps.threads_per_trial)
+    _shared['data'] = data
+    _shared['hps'] = hps
+
+
+@torch.no_grad()
+def _scores(model, x, n_batch):
+    return torch.cat([model(batch) for batch in x.split(n_batch)])
+
+
+def _run_job(trial_id, config, rung, epochs):
+    """Train trial trial_id up to `epochs` epochs (resuming its checkpoint) and score it."""
+    from main import build_model
+
+    data, hps = _shared['data'], _shared['hps']
+    trial_hps = copy.copy(hps)
+    for name, value in config.items():
+        setattr(trial_hps, name, value)
+    torch.manual_seed(hps.seed + trial_id)
+
+    start = time.time()
+    trial_path = os.path.join(hps.sweep_dir, 'trial_{}.pth'.format(trial_id))
+    augment = get_batch_augmentation(hps.problem, seed=hps.seed + trial_id) if hps.batch_augment else None
+    train_x, train_y = data['train_x'], data['train_y']
+    try:
+        model = build_model(trial_hps)
+        optimizer = Adam(model.parameters(), lr=hps.lr)
+        done_epochs = 0
+        if os.path.exists(trial_path):
+            state = torch.load(trial_path, map_location=lambda storage, loc: storage)
+            model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            done_epochs = state['epochs']
+
+        for epoch in range(done_epochs, epochs):
+            model.train()
+            for idx in torch.randperm(train_y.size(0)).split(hps.n_batch_train):
+                x, y = train_x[idx], train_y[idx]
+                if augment is not None:
+                    x = augment(x)
+                optimizer.zero_grad()
+                loss = model.eval_losses(x, y)[0]
+                if not torch.isfinite(loss):
+                    raise FloatingPointError('loss diverged at epoch {}'.format(epoch + 1))
+                loss.backward()
+                optimizer.step()
+    except (FloatingPointError, RuntimeError) as e:  # diverged or invalid configuration: the trial loses
+        return {'trial': trial_id, 'rung': rung, 'epochs': epochs, 'score': float('-inf'), 'error': str(e),
+                'config': config, 'seconds': time.time() - start}
+
+    atomic_save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epochs': epochs}, trial_path)
+
+    model.eval()
+    calib_scores = _scores(model, train_x[:hps.n_calib], hps.n_batch_test)
+    thresholds = class_thresholds(calib_scores, train_y[:hps.n_calib], hps.percentile)
+    val_scores = _scores(model, data['val_x'], hps.n_batch_test)
+    rates = rejection_rates(val_scores, data['val_y'], thresholds)
+    val_acc = val_scores.argmax(dim=1).eq(data['val_y']).double().mean().item()
+    return {'trial': trial_id, 'rung': rung, 'epochs': epochs, 'score': rates['acc'], 'val_acc': val_acc,
+            'reject_rate': rates['reject_rate'], 'acc_remain': rates['acc_remain'], 'config': config,
+            'seconds': time.time() - start}
+
+
+def load_split_tensors(hps):
+    """Train split of hps.problem as uint8 tensors in shared memory, split into train and validation."""
+    dataset = get_dataset(data_name=hps.problem, data_dir=hps.data_dir, train=True, crop_flip=False, uint8=True)
+    xs, ys = [], []
+    for x, y in get_loader(dataset, batch_size=1000, shuffle=False, hps=hps):
+        xs.append(x)
+        ys.append(y)
+    x, y = torch.cat(xs), torch.cat(ys)
+    g = torch.Generator()
+    g.manual_seed(hps.seed)
+    perm = torch.randperm(y.size(0), generator=g)
+    val_idx, train_idx = perm[:hps.val_size], perm[hps.val_size:]
+    data = {'train_x': x[train_idx], 'train_y': y[train_idx], 'val_x': x[val_idx], 'val_y': y[val_idx]}
+    for t in data.values():
+        t.share_memory_()
+    return data
+
+
+def sweep(hps):
+    if not os.path.exists(hps.sweep_dir):
+        os.makedirs(hps.sweep_dir)
+    data = load_split_tensors(hps)
+    print('==> {} train / {} validation samples'.format(data['train_y'].size(0), data['val_y'].size(0)))
+
+    scheduler = SuccessiveHalving(hps.n_trials, hps.min_epochs, hps.max_epochs, hps.eta, seed=hps.seed)
+    print('==> rungs (epochs): {}'.format(scheduler.rung_epochs))
+    ctx = mp.get_context('spawn')
+    pool = ctx.Pool(hps.n_workers, initializer=_init_worker, initargs=(data, hps))
+    running = []
+    results_path = os.path.join(hps.sweep_dir, 'results.jsonl')
+    total_epochs = 0
+    while True:
+        while len(running) < hps.n_workers:
+            job = scheduler.next_job()
+            if job is None:
+                break
+            trial_id, rung = job
+            args = (trial_id, scheduler.configs[trial_id], rung, scheduler.rung_epochs[rung])
+            running.append(pool.apply_async(_run_job, args))
+        if len(running) == 0:
+            break
+
+        finished = [r for r in running if r.ready()]
+        if len(finished) == 0:
+            time.sleep(0.5)
+            continue
+        for r in finished:
+            running.remove(r)
+            result = r.get()
+            scheduler.report(result['trial'], result['rung'], result['score'])
+            total_epochs += result['epochs'] - (scheduler.rung_epochs[result['rung'] - 1] if result['rung'] > 0 else 0)
+            with open(results_path, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+            print('trial {} rung {} ({} epochs): score {:.4f} in {:.0f}s{}'.format(
+                result['trial'], result['rung'], result['epochs'], result['score'], result['seconds'],
+                ', failed: ' + result['error'] if 'error' in result else ''))
+    pool.close()
+    pool.join()
+
+    print('==================== Sweep Summary ====================')
+    print('{} trials, {} trial-epochs ({:.1%} of training every trial for {} epochs)'.format(
+        len(scheduler.configs), total_epochs, total_epochs / float(len(scheduler.configs) * hps.max_epochs),
+        hps.max_epochs))
+    for trial_id, rung, score in scheduler.leaderboard()[:5]:
+        config = ', '.join('{}: {:.3g}'.format(k, v) for k, v in scheduler.configs[trial_id].items())
+        print('trial {}, {} epochs, score {:.4f}: {}'.format(trial_id, scheduler.rung_epochs[rung], score, config))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep_dir", type=str, default='./sweep', help="Location of trial checkpoints and results")
+    parser.add_argument("--n_trials", type=int, default=27, help="Number of sampled configurations")
+    parser.add_argument("--min_epochs", type=int, default=1, help="Epochs of the first rung")
+    parser.add_argument("--max_epochs", type=int, default=27, help="Maximum epochs of a trial")
+    parser.add_argument("--eta", type=int, default=3, help="Reduction factor: top 1/eta of a rung is promoted")
+    parser.add_argument("--n_workers", type=int, default=2, help="Number of trials trained in parallel")
+    parser.add_argument("--threads_per_trial", type=int, default=1, help="Number of cpu threads of every trial")
+    parser.add_argument("--val_size", type=int, default=5000, help="Number of train samples held out for validation")
+    parser.add_argument("--n_calib", type=int, default=5000,
+                        help="Number of train samples the rejection thresholds are computed on")
+
+    parser.add_argument("--problem", type=str, default='cifar10', help="Problem (mnist/fashion/cifar10/svhn/shards)")
+    parser.add_argument("--data_dir", type=str, default='data', help="Location of data")
+    parser.add_argument("--n_classes", type=int, default=10, help="number of classes of dataset.")
+    parser.add_argument("--n_batch_train", type=int, default=128, help="Minibatch size")
+    parser.add_argument("--n_batch_test", type=int, default=200, help="Minibatch size")
+    parser.add_argument("--lr", type=float, default=0.001, help="Base learning rate")
+    parser.add_argument("--batch_augment", action="store_true",
+                        help="Apply crop_flip augmentation on whole batches")
+    parser.add_argument("--percentile", type=float, default=0.01,
+                        help="percentile value for inference with rejection.")
+    parser.add_argument("--encoder_name", type=str, default='resnet10', help="encoder name: resnet#")
+    parser.add_argument("--dim_negatives", type=str, default='local', help="DIM negatives, see distributed.py")
+    parser.add_argument("--seed", type=int, default=1234, help="Random seed")
+    hps = parser.parse_args()
+    hps.device = torch.device('cpu')
+    hps.image_channel = 1 if hps.problem in ('mnist', 'fashion') else 3
+    if hps.problem == 'shards':
+        from shard_dataset import read_manifest
+        hps.image_channel = 1 if read_manifest(os.path.join(hps.data_dir, 'train')).get('mode') == 'L' else 3
+
+    sweep(hps)
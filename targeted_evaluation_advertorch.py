@@ -5,13 +5,14 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 
 from resnet import build_resnet_32x32
 from sdim import SDIM
 
-from utils import get_dataset, cal_parameters
+from utils import get_dataset, get_class_datasets, cal_parameters
+from loaders import get_loader, add_loader_args
+from rejection import RejectingClassifier
 
 from advertorch.attacks import CarliniWagnerL2Attack, LocalSearchAttack
 import numpy as np
@@ -28,32 +29,7 @@ def attack_run_rejection_policy(model, adversary, hps):
     model.eval()
 
     # Get thresholds
-    threshold_list1 = []
-    threshold_list2 = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            ll = model(x)
-
-            correct_idx = ll.argmax(dim=1) == y
-
-            ll_, y_ = ll[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(ll_[:, label_id].detach().cpu().numpy())
-
-        thresh_idx = int(0.01 * len(in_ll_list))
-        thresh1 = sorted(in_ll_list)[thresh_idx]
-        thresh_idx = int(0.02 * len(in_ll_list))
-        thresh2 = sorted(in_ll_list)[thresh_idx]
-        threshold_list1.append(thresh1)  # class mean as threshold
-        threshold_list2.append(thresh2)  # class mean as threshold
-        print('1st & 2nd percentile thresholds: {:.3f}, {:.3f}'.format(thresh1, thresh2))
+    classifier = RejectingClassifier.calibrated(model, hps, [0.01, 0.02])
 
     # Evaluation
     n_total = 0   # total number of correct classified samples by clean classifier
@@ -65,23 +41,17 @@ def attack_run_rejection_policy(model, adversary, hps):
     if not os.path.exists(attack_path):
         os.mkdir(attack_path)
 
-    thresholds1 = torch.tensor(threshold_list1).to(hps.device)
-    thresholds2 = torch.tensor(threshold_list2).to(hps.device)
-
     l2_distortion_list = []
     n_eval = 0
 
     hps.n_batch_test = 20
+    class_datasets = get_class_datasets(data_name=hps.problem, train=False, n_classes=hps.n_classes)
     for label_id in range(hps.n_classes):
-        dataset = get_dataset(data_name=hps.problem, train=False, label_id=label_id)
-        test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+        test_loader = get_loader(class_datasets[label_id], batch_size=hps.n_batch_test, shuffle=False, hps=hps)
         for batch_id, (x, y) in enumerate(test_loader):
             # Note that images are scaled to [0., 1.0]
             x, y = x.to(hps.device), y.to(hps.device)
-            with torch.no_grad():
-                output = model(x)
-
-            pred = output.argmax(dim=1)
+            pred, _, _ = classifier(x)
             correct_idx = pred == y  # Only evaluate on the correct classified samples by clean classifier.
             x, y = x[correct_idx], y[correct_idx]
 
@@ -93,10 +63,7 @@ def attack_run_rejection_policy(model, adversary, hps):
                     y_cur = torch.LongTensor([id] * x.size(0)).to(hps.device)
                     adv_x = adversary.perturb(x, y_cur)
 
-                    with torch.no_grad():
-                        output = model(adv_x)
-
-                    logits, preds = output.max(dim=1)
+                    preds, reject, _ = classifier(adv_x)
 
                     success_idx = preds == y_cur
                     n_successful_adv += success_idx.sum().item()
@@ -105,10 +72,8 @@ def attack_run_rejection_policy(model, adversary, hps):
                     l2_distortion = diff.norm(p=2, dim=-1).mean().item()  # mean l2 distortion
                     l2_distortion_list.append(l2_distortion)
 
-                    rej_idx1 = logits < thresholds1[preds]
+                    rej_idx1, rej_idx2 = reject
                     n_rejected_adv1 += rej_idx1.sum().item()
-
-                    rej_idx2 = logits < thresholds2[preds]
                     n_rejected_adv2 += rej_idx2.sum().item()
 
             break  # only one batch
@@ -135,7 +100,7 @@ def targeted_cw(model, adversary, hps):
     model.eval()
     dataset = get_dataset(data_name=hps.problem, train=False, label_id=0)
     hps.n_batch_test = 1
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
     import os
     for batch_id, (x, y) in enumerate(test_loader):
@@ -266,6 +231,7 @@ if __name__ == '__main__':
 
     # Ablation
     parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
@@ -290,7 +290,7 @@ def attack_run_rejection_policy(model, adversary, hps):
     # Evaluation
     dataset = get_dataset(data_name=hps.problem, train=False)
     hps.n_batch_test = 1
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
     # n_correct = 0   # total number of correct classified samples by clean classifier
     # n_successful_adv = 0  # total number of successful adversarial examples generated
@@ -361,13 +361,13 @@ if __name__ == '__main__':
     import torch
     import torch.nn as nn
     import torch.nn.functional as F
-    from torch.utils.data import DataLoader
     from torchvision.utils import save_image
 
     from resnet import build_resnet_32x32
     from sdim import SDIM
 
     from utils import get_dataset, cal_parameters
+    from loaders import get_loader, add_loader_args
 
 
     # This enables a ctr-C without triggering errors
@@ -435,6 +435,7 @@ if __name__ == '__main__':
 
     # Ablation
     parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
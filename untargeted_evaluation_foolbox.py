@@ -5,13 +5,15 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 
 from resnet import build_resnet_32x32
 from sdim import SDIM
 
 from utils import get_dataset, cal_parameters
+from loaders import get_loader, add_loader_args
+from rejection import RejectingClassifier
+from score_cache import cached_scores
 
 from foolbox.attacks import BoundaryAttack, SpatialAttack, DeepFoolL2Attack, LocalSearchAttack
 import numpy as np
@@ -30,32 +32,7 @@ def attack_run_rejection_policy(model, hps):
     model.eval()
 
     # Get thresholds
-    threshold_list1 = []
-    threshold_list2 = []
-    for label_id in range(hps.n_classes):
-        # No data augmentation(crop_flip=False) when getting in-distribution thresholds
-        dataset = get_dataset(data_name=hps.problem, train=True, label_id=label_id, crop_flip=False)
-        in_test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
-
-        print('Inference on {}, label_id {}'.format(hps.problem, label_id))
-        in_ll_list = []
-        for batch_id, (x, y) in enumerate(in_test_loader):
-            x = x.to(hps.device)
-            y = y.to(hps.device)
-            ll = model(x)
-
-            correct_idx = ll.argmax(dim=1) == y
-
-            ll_, y_ = ll[correct_idx], y[correct_idx]  # choose samples are classified correctly
-            in_ll_list += list(ll_[:, label_id].detach().cpu().numpy())
-
-        thresh_idx = int(0.01 * len(in_ll_list))
-        thresh1 = sorted(in_ll_list)[thresh_idx]
-        thresh_idx = int(0.02 * len(in_ll_list))
-        thresh2 = sorted(in_ll_list)[thresh_idx]
-        threshold_list1.append(thresh1)  # class mean as threshold
-        threshold_list2.append(thresh2)  # class mean as threshold
-        print('1st & 2nd percentile thresholds: {:.3f}, {:.3f}'.format(thresh1, thresh2))
+    classifier = RejectingClassifier.calibrated(model, hps, [0.01, 0.02])
 
     # Evaluation
     n_eval = 0   # total number of correct classified samples by clean classifier
@@ -67,24 +44,21 @@ def attack_run_rejection_policy(model, hps):
     if not os.path.exists(attack_path):
         os.mkdir(attack_path)
 
-    thresholds1 = torch.tensor(threshold_list1).to(hps.device)
-    thresholds2 = torch.tensor(threshold_list2).to(hps.device)
-
     l2_distortion_list = []
 
     fmodel = foolbox.models.PyTorchModel(model, bounds=(0, 1.), num_classes=10)
 
+    # clean predictions from the cached test scores, in the order of test_loader
+    clean_cache = cached_scores(model, hps, train=False)
+
     hps.n_batch_test = 1
     dataset = get_dataset(data_name=hps.problem, train=False)
-    test_loader = DataLoader(dataset=dataset, batch_size=hps.n_batch_test, shuffle=False)
+    test_loader = get_loader(dataset, batch_size=hps.n_batch_test, shuffle=False, hps=hps)
 
-    for batch_id, (x, y) in enumerate(test_loader):
+    for batch_id, ((x, y), (clean_ll, _)) in enumerate(zip(test_loader, clean_cache.batches(1, hps.device))):
         # Note that images are scaled to [0., 1.0]
         x, y = x.to(hps.device), y.to(hps.device)
-        with torch.no_grad():
-            output = model(x)
-
-        pred = output.argmax(dim=1)
+        pred = clean_ll.argmax(dim=1)
         if pred != y:
             continue
 
@@ -111,10 +85,7 @@ def attack_run_rejection_policy(model, hps):
 
         adv_x = torch.tensor(adv_x).unsqueeze(dim=0).to(hps.device)
 
-        with torch.no_grad():
-            output = model(adv_x)
-
-        logit, pred = output.max(dim=1)
+        pred, reject, _ = classifier(adv_x)
 
         if pred != label:
             n_successful_adv += 1
@@ -123,11 +94,8 @@ def attack_run_rejection_policy(model, hps):
         l2_distortion = diff.norm(p=2, dim=-1).mean().item()  # mean l2 distortion
         l2_distortion_list.append(l2_distortion)
 
-        if logit < thresholds1[pred]:
-            n_rejected_adv1 += 1
-
-        if logit < thresholds2[pred]:
-            n_rejected_adv2 += 1
+        n_rejected_adv1 += reject[0].sum().item()
+        n_rejected_adv2 += reject[1].sum().item()
 
         if batch_id == 100:
             print('Evaluating on {}-th batch ...'.format(batch_id))
@@ -215,6 +183,7 @@ if __name__ == '__main__':
 
     # Ablation
     parser.add_argument("--seed", type=int, default=123, help="Random seed")
+    add_loader_args(parser)
     hps = parser.parse_args()  # So error if typo
 
     use_cuda = not hps.no_cuda and torch.cuda.is_available()
@@ -1,42 +1,62 @@
+import os
+import zlib
+
 from torchvision import datasets, transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import torch
 import numpy as np
 
+from verified_datasets import VerifiedCIFAR10, VerifiedSVHN
+from shard_dataset import ShardedImageDataset, read_manifest
+
+
+# Number of samples held in the shuffle buffer when streaming train shards.
+SHARD_SHUFFLE_BUFFER = 10000
+
 
-def get_dataset(data_name='mnist', data_dir='data', train=True, label_id=None, crop_flip=True):
+def get_dataset(data_name='mnist', data_dir='data', train=True, label_id=None, crop_flip=True, download=True,
+                uint8=False, rank=None, world_size=None):
     """
     Get a dataset.
     :param data_name: str, name of dataset.
     :param data_dir: str, base directory of data.
     :param train: bool, return train set if True, or test set if False.
-    :param label_id: None or int, return data with particular label_id.
+    :param label_id: None or int, return a view of the data with particular label_id.
     :param crop_flip: bool, whether use crop_flip as data augmentation.
+    :param download: bool, download the data if it is missing. With False, the data is opened offline
+        and must already be in data_dir.
+    :param uint8: bool, return images as uint8 tensors in [0, 255] instead of float tensors in [0, 1].
+        Models convert them in their input adapter (see resnet.InputAdapter).
+    :param rank: None or int, streaming shards only: rank of the shards split across ranks, from
+        torch.distributed if None. rank=0 and world_size=1 read all the shards in data-parallel training.
+    :param world_size: None or int, streaming shards only: number of ranks the shards are split across.
     :return: pytorch dataset.
     """
+    to_tensor = transforms.PILToTensor() if uint8 else transforms.ToTensor()
+
     transform_1d_crop_flip = transforms.Compose([
                                             transforms.Resize((32, 32)),
                                             transforms.RandomCrop(32, padding=4),
                                             transforms.RandomHorizontalFlip(),
-                                            transforms.ToTensor(),
+                                            to_tensor,
                                             # transforms.Normalize((0.5,), (0.5,))  # 1-channel, scale to [-1, 1]
                                         ])
 
     transform_1d = transforms.Compose([
                 transforms.Resize((32, 32)),
-                transforms.ToTensor(),
+                to_tensor,
                 #transforms.Normalize((0.5,), (0.5, ))
             ])
 
     transform_3d_crop_flip = transforms.Compose([
         transforms.RandomCrop(32, padding=4),
         transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
+        to_tensor,
         #transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
     ])
 
     transform_3d = transforms.Compose([
-        transforms.ToTensor(),
+        to_tensor,
         #transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
     ])
 
@@ -47,7 +67,7 @@ def get_dataset(data_name='mnist', data_dir='data', train=True, label_id=None, c
         #else:
         #    transform = transform_1d
 
-        dataset = datasets.MNIST(data_dir, train=train, download=True, transform=transform_1d)
+        dataset = datasets.MNIST(data_dir, train=train, download=download, transform=transform_1d)
 
     elif data_name == 'fashion':
         if train:
@@ -56,7 +76,7 @@ def get_dataset(data_name='mnist', data_dir='data', train=True, label_id=None, c
         else:
             transform = transform_1d
 
-        dataset = datasets.FashionMNIST(data_dir, train=train, download=True, transform=transform)
+        dataset = datasets.FashionMNIST(data_dir, train=train, download=download, transform=transform)
 
     elif data_name == 'cifar10':
         if train:
@@ -65,7 +85,7 @@ def get_dataset(data_name='mnist', data_dir='data', train=True, label_id=None, c
         else:
             transform = transform_3d
 
-        dataset = datasets.CIFAR10(data_dir, train=train, download=True, transform=transform)
+        dataset = VerifiedCIFAR10(data_dir, train=train, download=download, transform=transform)
     elif data_name == 'svhn':
         if train:
             # when train is True, we use transform_1d_crop_flip by default unless crop_flip is set to False
@@ -75,32 +95,105 @@ def get_dataset(data_name='mnist', data_dir='data', train=True, label_id=None, c
             transform = transform_3d
             split = 'test'
 
-        dataset = datasets.SVHN(data_dir, split=split, download=True, transform=transform)
+        dataset = VerifiedSVHN(data_dir, split=split, download=download, transform=transform)
+    elif data_name == 'shards':
+        # data_dir holds train/ and test/ directories of tar shards, see shard_dataset.py
+        shard_dir = os.path.join(data_dir, 'train' if train else 'test')
+        if read_manifest(shard_dir).get('mode', 'RGB') == 'L':
+            transform = transform_1d_crop_flip if train and crop_flip else transform_1d
+        else:
+            transform = transform_3d_crop_flip if train and crop_flip else transform_3d
+        # shuffled within a bounded buffer, a loader over it must not shuffle.
+        dataset = ShardedImageDataset(shard_dir, transform=transform,
+                                      shuffle_buffer=SHARD_SHUFFLE_BUFFER if train else 0,
+                                      rank=rank, world_size=world_size)
     else:
         print('dataset {} is not available'.format(data_name))
 
-    if label_id is not None:
+    if label_id is not None and isinstance(dataset, ShardedImageDataset):
+        # streamed, select samples with particular label on the fly
+        dataset = dataset.select_label(label_id)
+    elif label_id is not None:
         # select samples with particular label
-        if data_name == 'cifar10': #isinstance(dataset.targets, list):
-            # for cifar10
-            targets = np.array(dataset.targets)
-            idx = targets == label_id
-            dataset.targets = list(targets[idx])
-            dataset.data = dataset.data[idx]
-        elif data_name == 'svhn':
-            idx = dataset.labels == label_id
-            dataset.labels = dataset.labels[idx]
-            dataset.data = dataset.data[idx]
-        else:
-            # for MNIST and FashionMNIST
-            targets = dataset.targets
-            data = dataset.data
-            idx = targets == label_id
-            dataset.targets = targets[idx]
-            dataset.data = data[idx]
+        class_index = get_class_index(dataset, cache_path=_class_index_path(data_name, data_dir, train))
+        dataset = Subset(dataset, class_index.get(label_id, np.array([], dtype=np.int64)))
     return dataset
 
 
+def get_targets(dataset):
+    """
+    Get labels of all samples of a dataset without decoding any image.
+    :param dataset: torchvision dataset (targets in `targets`, or `labels` for SVHN).
+    :return: numpy array of int64 labels.
+    """
+    if hasattr(dataset, 'labels'):
+        targets = dataset.labels
+    else:
+        targets = dataset.targets
+    if isinstance(targets, torch.Tensor):
+        targets = targets.numpy()
+    return np.asarray(targets, dtype=np.int64)
+
+
+def _class_index_path(data_name, data_dir, train):
+    return os.path.join(data_dir, '{}_{}_class_index.npz'.format(data_name, 'train' if train else 'test'))
+
+
+def get_class_index(dataset, cache_path=None):
+    """
+    Build (or load from cache) the mapping label -> sorted sample indices of a dataset.
+    :param dataset: torchvision dataset.
+    :param cache_path: None or str, npz file the index is cached in. The cache is
+        rebuilt when the labels of dataset do not match the ones it was built from.
+    :return: dict, label (int) -> numpy array of sample indices in ascending order.
+    """
+    targets = get_targets(dataset)
+    checksum = zlib.crc32(targets.tobytes())
+
+    if cache_path is not None and os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if int(cache['checksum']) == checksum and int(cache['n_samples']) == len(targets):
+            labels, counts, order = cache['labels'], cache['counts'], cache['order']
+            splits = np.split(order, np.cumsum(counts)[:-1])
+            return dict((int(label), idx) for label, idx in zip(labels, splits))
+
+    # Stable sort keeps the indices of every class in ascending order.
+    order = np.argsort(targets, kind='stable')
+    labels, counts = np.unique(targets, return_counts=True)
+
+    if cache_path is not None:
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.savez(cache_path, labels=labels, counts=counts, order=order,
+                 checksum=checksum, n_samples=len(targets))
+
+    splits = np.split(order, np.cumsum(counts)[:-1])
+    return dict((int(label), idx) for label, idx in zip(labels, splits))
+
+
+def get_class_datasets(data_name='mnist', data_dir='data', train=True, crop_flip=True, n_classes=10, download=True,
+                       uint8=False):
+    """
+    Get per-class views of a dataset, constructing the underlying dataset only once.
+    :param data_name: str, name of dataset.
+    :param data_dir: str, base directory of data.
+    :param train: bool, return views of train set if True, or test set if False.
+    :param crop_flip: bool, whether use crop_flip as data augmentation.
+    :param n_classes: int, number of classes.
+    :param download: bool, download the data if it is missing.
+    :param uint8: bool, return images as uint8 tensors.
+    :return: list of torch.utils.data.Subset, the i-th one holds the samples with label i.
+    """
+    dataset = get_dataset(data_name=data_name, data_dir=data_dir, train=train, crop_flip=crop_flip,
+                          download=download, uint8=uint8)
+    if isinstance(dataset, ShardedImageDataset):
+        return [dataset.select_label(label_id) for label_id in range(n_classes)]
+    class_index = get_class_index(dataset, cache_path=_class_index_path(data_name, data_dir, train))
+    return [Subset(dataset, class_index.get(label_id, np.array([], dtype=np.int64)))
+            for label_id in range(n_classes)]
+
+
 def cal_parameters(model):
     """
     Calculate the number of parameters of a Pytorch model.
@@ -0,0 +1,85 @@
+"""Torchvision datasets whose MD5 integrity check runs once per data directory.
+
+torchvision hashes the archive files of CIFAR10 and SVHN every time a dataset is
+constructed (twice with download=True). Here the first successful verification is
+recorded in a marker file holding size, mtime and md5 of every checked file; later
+opens trust the marker as long as size and mtime are unchanged, and never touch
+the network.
+"""
+
+import json
+import os
+
+from torchvision import datasets
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class VerifiedOnceMixin(object):
+    """Mixin replacing `_check_integrity` of a torchvision dataset by a marker lookup.
+    Subclasses implement `_integrity_files`.
+    """
+    def _integrity_files(self):
+        """
+        Returns:
+            list: (path, md5) of all files checked by the original `_check_integrity`.
+        """
+        raise NotImplementedError
+
+    @property
+    def _marker_path(self):
+        return os.path.join(self.root, '.verified_{}.json'.format(self.__class__.__name__))
+
+    def _marker_is_valid(self):
+        if not os.path.exists(self._marker_path):
+            return False
+        with open(self._marker_path) as f:
+            marker = json.load(f)
+
+        for path, md5 in self._integrity_files():
+            entry = marker.get(os.path.relpath(path, self.root))
+            if entry is None or entry['md5'] != md5 or not os.path.exists(path):
+                return False
+            if tuple(_file_signature(path)) != (entry['size'], entry['mtime_ns']):
+                return False
+        return True
+
+    def _write_marker(self):
+        marker = {}
+        for path, md5 in self._integrity_files():
+            size, mtime_ns = _file_signature(path)
+            marker[os.path.relpath(path, self.root)] = {'size': size, 'mtime_ns': mtime_ns, 'md5': md5}
+
+        # Write-then-rename so that concurrent readers never see a partial marker.
+        tmp_path = '{}.{}.tmp'.format(self._marker_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(marker, f, indent=2)
+        os.replace(tmp_path, self._marker_path)
+
+    def _check_integrity(self):
+        if self._marker_is_valid():
+            return True
+        # Fall back on the full md5 verification, and remember it when it passes.
+        verified = super()._check_integrity()
+        if verified:
+            self._write_marker()
+        return verified
+
+    def download(self):
+        if self._check_integrity():
+            return
+        super().download()
+
+
+class VerifiedCIFAR10(VerifiedOnceMixin, datasets.CIFAR10):
+    def _integrity_files(self):
+        return [(os.path.join(self.root, self.base_folder, filename), md5)
+                for filename, md5 in self.train_list + self.test_list]
+
+
+class VerifiedSVHN(VerifiedOnceMixin, datasets.SVHN):
+    def _integrity_files(self):
+        return [(os.path.join(self.root, self.filename), self.split_list[self.split][2])]